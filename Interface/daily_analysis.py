@@ -1,16 +1,26 @@
 from pyoperant import analysis
 import os
-from datetime import datetime, timedelta
+import multiprocessing
 import logging, traceback
 import sys
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 """
 Script to analyze bird data and compile into single file per bird
-Primarily used to make data more accessible by then moving the output to a Box folder 
+Primarily used to make data more accessible by then moving the output to a Box folder
+
+Export is incremental: the byte offset reached in each trial data file is saved in a watermark file, and each run
+only reads trials added since then and appends them to the bird's csv. Birds with no new data are skipped, so their
+output file isn't touched at all. A bird's csv is rewritten in full only if it has no watermark yet, its export is
+missing, or one of its trial data files shrank or disappeared.
 """
 
 # region Error Handling
-"""Since this is run through a cron job, need to catch errors and put them somewhere else. Otherwise they get emailed 
+"""Since this is run through a cron job, need to catch errors and put them somewhere else. Otherwise they get emailed
 every time there's an error, which is annoying since this script runs daily"""
 
 
@@ -44,41 +54,129 @@ def log_config():
 
 # endregion
 
-
-log_config()
 dataDir = '/home/rouse/bird/data'
-days_prior = 5
-
-folderList = []
-
-# Get list of folders in data directory
-targetDateTime = datetime.today() - timedelta(days=days_prior)
-for i in os.listdir(dataDir):
-    currFolder = os.path.join(dataDir, i)
-
-    # check that current folder is actually a data folder
-    currFolderDataPath = os.path.join(currFolder, 'trialdata')
-    if os.path.exists(currFolderDataPath):
-        if i == 'test':  # skip test folder
-            pass
-        elif days_prior < 0:  # if days_prior is -1, ignore modification dates and just export all
-            folderList.append(i)
-        else:  # Retain only folders that have been modified in previous days_prior days
-            folderInfo = os.stat(currFolderDataPath)
-            folderModTime = datetime.fromtimestamp(folderInfo.st_mtime)
-            if folderModTime > targetDateTime:
-                folderList.append(i)
-
 outputFolder = '/home/rouse/Desktop/daily_summary'
+# Kept with the logs rather than in outputFolder so it isn't synced
+watermarkFile = os.path.join(os.getcwd(), 'daily_analysis_watermarks.json')
+
+
+# region Watermarks
+def load_watermarks(path):
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return json.load(f)
+    return {}
+
+
+def save_watermarks(path, watermarks):
+    # write to temp file then rename, so a crash mid-write can't leave a truncated file
+    tempFile = path + '.tmp'
+    with open(tempFile, 'wb') as f:
+        json.dump(watermarks, f, sort_keys=True, indent=2)
+    os.rename(tempFile, path)
+
+
+def file_sizes(bird_folder):
+    dataPath = os.path.join(bird_folder, 'trialdata')
+    return dict((fileName, os.path.getsize(os.path.join(dataPath, fileName))) for fileName in os.listdir(dataPath))
+
+
+# endregion
+
 
-birdCount = len(folderList)
-if birdCount > 0:
-    # print("Exporting data for %d birds" % birdCount)
-    currNum = 0
-    for a in folderList:
-        currNum = currNum + 1
-        # print("  Exporting %s... (%d/%d)" % (a, currNum, len(folderList)))
-        outputPath = os.path.join(outputFolder, a + '.csv')
-        dataPath = os.path.join(dataDir, a)
-        data = analysis.Performance(dataPath)
-        data.raw_trial_data.to_csv(str(outputPath), mode='w+')
+def export_bird(bird, bird_folder, output_path, watermark):
+    """
+    Appends a bird's new trials to its export csv. Returns the bird's updated watermark, or None if nothing changed
+    watermark -- dict with 'files' (file name: byte offset already exported), 'columns' (export column order), and
+    'last_block'/'last_block_number' (to continue block numbering across runs). Empty to export from scratch
+    """
+    log = logging.getLogger(__name__)
+    sizes = file_sizes(bird_folder)
+    exportedOffsets = watermark.get('files', {})
+
+    fullExport = ('files' not in watermark or not os.path.exists(output_path) or
+                  any(fileName not in sizes or sizes[fileName] < offset
+                      for fileName, offset in exportedOffsets.items()))
+    if fullExport:
+        exportedOffsets = {}
+    elif all(sizes[fileName] == exportedOffsets.get(fileName) for fileName in sizes):
+        return None  # untouched
+
+    data = analysis.Performance(bird_folder, file_offsets=exportedOffsets)
+    newTrials = data.raw_trial_data.reset_index()
+
+    newWatermark = {'files': data.file_offsets,
+                    'columns': watermark.get('columns') if not fullExport else None,
+                    'last_block': watermark.get('last_block'),
+                    'last_block_number': watermark.get('last_block_number', 0)}
+    if fullExport:
+        newWatermark['last_block'] = None
+        newWatermark['last_block_number'] = 0
+
+    if len(newTrials) > 0:
+        # Block numbers restart at 1 within each read, so continue on from the last exported block
+        blockOffset = newWatermark['last_block_number']
+        if newTrials['Block'].iloc[0] == newWatermark['last_block']:
+            blockOffset -= 1
+        newTrials['Block Number'] = newTrials['Block Number'].astype(int) + blockOffset
+        newWatermark['last_block'] = newTrials['Block'].iloc[-1]
+        newWatermark['last_block_number'] = int(newTrials['Block Number'].iloc[-1])
+
+        if newWatermark['columns'] is None:
+            newWatermark['columns'] = list(newTrials.columns)
+            newTrials.to_csv(str(output_path), mode='w', index=False, columns=newWatermark['columns'])
+        else:
+            newTrials.to_csv(str(output_path), mode='a', index=False, header=False,
+                             columns=newWatermark['columns'])
+        log.info('%s: exported %d new trials%s' % (bird, len(newTrials), ' (full export)' if fullExport else ''))
+    elif fullExport:
+        # no trials at all, but still create the file so the next run can append to it
+        with open(output_path, 'wb') as f:
+            f.write('')
+
+    return newWatermark
+
+
+def _export_bird(job):
+    # multiprocessing entry point, so an error in one bird doesn't stop the others
+    bird, bird_folder, output_path, watermark = job
+    try:
+        return bird, export_bird(bird, bird_folder, output_path, watermark)
+    except Exception:
+        logging.error('export failed for %s: %s' % (bird, traceback.format_exc()))
+        return bird, None
+
+
+def main(data_dir=dataDir, output_folder=outputFolder, watermark_file=watermarkFile, processes=None):
+    watermarks = load_watermarks(watermark_file)
+
+    # Get list of bird folders in data directory
+    jobs = []
+    for i in sorted(os.listdir(data_dir)):
+        currFolder = os.path.join(data_dir, i)
+
+        # check that current folder is actually a data folder
+        currFolderDataPath = os.path.join(currFolder, 'trialdata')
+        if os.path.exists(currFolderDataPath) and i != 'test':  # skip test folder
+            jobs.append((i, currFolder, os.path.join(output_folder, i + '.csv'), watermarks.get(i, {})))
+
+    if len(jobs) > 0:
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(_export_bird, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        changed = False
+        for bird, newWatermark in results:
+            if newWatermark is not None:
+                watermarks[bird] = newWatermark
+                changed = True
+        if changed:
+            save_watermarks(watermark_file, watermarks)
+
+
+if __name__ == '__main__':
+    log_config()
+    main()
@@ -6,8 +6,8 @@ import os
 import subprocess  # So pyoperant can run for each box without blocking the rest of the GUI
 import serial  # To connect directly to Teensys for water control
 import time
-import threading  # Support subprocess, allow error messages to be passed out of the subprocess
-import Queue  # Support subprocess, allow error messages to be passed out of the subprocess
+import copy
+import socket  # status channel errors
 import pyudev  # device monitoring to identify connected Teensys
 import re  # Regex, for parsing device names returned from pyudev to identify connected Teensys
 import argparse  # Parse command line arguments for GUI, primarily to enable debug mode
@@ -20,13 +20,14 @@ import io  # for copying cells from analysis table
 from contextlib import contextmanager  # facilitates simple implementation of 'waiting' mouse cursor when loading
 import gc  # garbage collection, to help prevent memory leak
 
-import pyaudio  # soundcheck functionality
-import wave  # soundcheck functionality
-import numpy  # calculating rms
-import scipy  # calculating specific frequencies
-from scipy.io import wavfile
+import numpy  # sorting analysis tables
 
 from pyoperant import analysis, utils  # Analysis creates the data summary tables
+from pyoperant import status  # Live box status pushed from running pyoperant processes
+from pyoperant import supervisor  # Starts/stops box processes without blocking the GUI
+from pyoperant import calibration  # Sound check
+from pyoperant import devices  # Cached audio device lookup
+from pyoperant.errors import AnalysisCancelled
 import csv  # For exporting data summaries as csv files
 
 try:
@@ -59,9 +60,22 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
     - Alternatively it gets set to 1 if the box should be set to 'sleep' mode, meaning pyoperant should be stopped
     temporarily and restarted in the morning. This was added to help combat the intermittent and unexplained instances
     of Teensys ceasing to respond to computer input
+    - Box status (summary and errors) is pushed by each pyoperant process through pyoperant.status and received on a
+    StatusReceiver thread. Until a box has sent status, its summary file is read in refreshall instead
     """
 
+    # Summary fields shown in each part of the box status display, so only the parts with changed fields are redrawn
+    STATUS_DISPLAY_FIELDS = {
+        'phase': ['phase'],
+        'time': ['last_trial_time'],
+        'totals': ['trials', 'probe_trials', 'feeds'],
+        'counts': ['correct_responses', 'false_alarms', 'probe_hit', 'probe_FA', 'misses', 'splus_nr',
+                   'correct_rejections', 'sminus_nr', 'probe_miss', 'probe_miss_nr', 'probe_CR', 'probe_CR_nr'],
+        'stats': ['dprime', 'dprime_NR', 'bias', 'bias_NR', 'bias_description', 'bias_description_NR'],
+    }
+
     teensy_emit = QtCore.pyqtSignal(int, str)
+    box_event = QtCore.pyqtSignal(int, str, object)  # box index, BoxSupervisor event, detail
 
     class DeviceInfo:
         # Extracts device info from pyudev output: box number, device ID, USB device number
@@ -154,8 +168,12 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
             self.ui_options['autosleep_all'].setChecked(True)
             self.ui_options['autosleep_all'].triggered.connect(self.auto_sleep_set_all)
 
+            soundCheckAllAction = QtGui.QAction("Sound Check (all)", self)
+            soundCheckAllAction.triggered.connect(self.sound_check_all)
+
             globalOptionsMenu.addAction(viewGuiLogAction)
             globalOptionsMenu.addAction(viewGuiErrorAction)
+            globalOptionsMenu.addAction(soundCheckAllAction)
 
             globalOptionsMenu.addSeparator()
             globalOptionsMenu.addMenu(autosleepMenu)
@@ -173,10 +191,31 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
             self.timer.timeout.connect(self.refreshall)
             self.timer.start(5000)
 
-            self.idleTime = 1.5  # max idle time in hours before restarting pyoperant process
+            self.idleTime = 1.5  # max time in hours without a trial during a session before restarting pyoperant
 
             self.log_config()
 
+            self.analysisWorkers = []  # AnalysisWorkers still running (kept so they aren't garbage collected)
+
+            # region Live box status
+            self.statusReceivedList = [False] * self.numberOfBoxes  # whether status has been pushed by each box
+            self.statusModelList = [None] * self.numberOfBoxes  # count table model for each box
+            try:
+                self.statusReceiver = StatusReceiver(status.StatusListener('gui-{:d}'.format(os.getpid())))
+            except (socket.error, OSError) as err:
+                # GUI still works without it, by reading summary files
+                self.log.error('Could not listen for box status: {}'.format(err))
+                self.statusReceiver = None
+            else:
+                self.statusReceiver.status_changed.connect(self.apply_status)
+                self.statusReceiver.start()
+            # endregion
+
+            # Box processes are started, stopped, and restarted (when they crash or stall) on supervisor threads,
+            # which report back through box_event
+            self.supervisor = supervisor.BoxSupervisor(self.box_event.emit, idle_timeout=self.idleTime * 3600)
+            self.box_event.connect(self.box_event_received)
+
             # region Monitor when USB devices are connected/disconnected
             context = pyudev.Context()
             monitor = pyudev.Monitor.from_netlink(context)
@@ -185,13 +224,19 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
             observer.daemon = True
             observer.start()
 
+            # Sound cards changing invalidates the cached audio device lookups
+            soundMonitor = pyudev.Monitor.from_netlink(context)
+            soundMonitor.filter_by(subsystem='sound')
+            soundObserver = pyudev.MonitorObserver(soundMonitor, self.sound_device_monitor, name='sound-observer')
+            soundObserver.daemon = True
+            soundObserver.start()
+
             self.teensy_emit.connect(
                 (lambda triggered_boxnumber, parameter: self.teensy_control(triggered_boxnumber, parameter)))
             # endregion
 
-            # arrays for queues and threads
-            self.qList = [0] * self.numberOfBoxes
-            self.tList = [0] * self.numberOfBoxes
+            # stderr of all running boxes is read by one thread, keeping only recent lines of each
+            self.outputReader = supervisor.OutputReader()
             # self.qReadList = [0] * self.numberOfBoxes  # list of queues for inputs to subprocesses
             # self.tReadList = [0] * self.numberOfBoxes  # list of queues for inputs to subprocesses
 
@@ -343,9 +388,6 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
                 self.lastStartList.append(None)
                 self.lastTrialList.append(None)
 
-                # Queue for running subprocesses and pulling outputs without blocking main script
-                self.qList[boxIndex] = Queue.Queue()
-
                 # Device-specific vars
                 self.deviceIDList.append(None)
                 self.deviceLocationList.append(None)
@@ -558,21 +600,9 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
     # region Pyoperant stop/start functions
     def stop_box(self, boxnumber, error_mode=False, sleep_mode=False):
         # stop selected box
-        if not self.subprocessBox[boxnumber] == 0:  # Only operate if box is running
-            while True:  # Empty queue so process can end gracefully
-                try:
-                    self.qList[boxnumber].get(False)
-                except Queue.Empty:
-                    break
-        # self.tList[boxnumber].terminate()
         # self.subprocessBox[boxnumber].stderr.close()
         # self.subprocessBox[boxnumber].stdout.close()
-        try:
-            self.subprocessBox[boxnumber].terminate()
-        except OSError:
-            pass  # OSError is probably that the process is already terminated
-        except AttributeError:
-            pass  # Subprocess is stopped and already set to 0
+        self.supervisor.stop(boxnumber)  # terminates (or kills) process in the background; no-op if not running
 
         if sleep_mode:
             self.subprocessBox[boxnumber] = 1
@@ -583,7 +613,8 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
             self.sleepScheduleList[boxnumber] = None
             self.box_button_control(boxnumber, 'stop')
 
-        self.refreshfile(boxnumber)  # one last time to display any errors sent to the summaryDAT file
+        if not self.statusReceivedList[boxnumber]:
+            self.refreshfile(boxnumber)  # one last time to display any errors sent to the summaryDAT file
 
         # set icon if error
         if error_mode:
@@ -616,7 +647,7 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
             error = "Error: Teensy {:02d} not detected.".format(actualboxnumber)
             self.display_message(boxnumber, error, target='status')
         else:
-            with wait_cursor():  # set mouse cursor to 'waiting' while connecting to Teensy
+            with wait_cursor():  # set mouse cursor to 'waiting' while launching
                 try:
                     from pyoperant.local import DATAPATH
                 except ImportError:
@@ -631,41 +662,65 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
                                      '-S', '{0}'.format(birdName),
                                      '{0}'.format(self.behaviorField.currentText()),
                                      '-c', '{0}'.format(jsonPath)]
-                    self.subprocessBox[boxnumber] = subprocess.Popen(
-                        commandString, stdin=open(os.devnull), stderr=subprocess.PIPE, stdout=open(os.devnull),
+                    # Returns as soon as the process is launched; box_event_received is called once it's ready or
+                    # has failed. Without a status channel there's no startup handshake, so it's ready if it stays up
+                    self.subprocessBox[boxnumber] = self.supervisor.start(
+                        boxnumber, commandString, handshake=self.statusReceiver is not None, restart=True,
+                        stdin=open(os.devnull), stderr=subprocess.PIPE, stdout=open(os.devnull),
                         shell=self.args['debug']
                     )
-
-                    # Thread for reading error messages
-                    self.tList[boxnumber] = threading.Thread(target=self.read_output_box,
-                                                             args=(boxnumber, self.subprocessBox[boxnumber].stderr,
-                                                                   self.qList[boxnumber]))
-                    self.tList[boxnumber].daemon = True
-
-                    self.tList[boxnumber].start()
-
-                    error = self.get_error(boxnumber)
-                    # error = ''
-
-                    if error and not error[0:4] == "ALSA" and not error[0:5] == 'pydev' and not error[0:5] == 'debug':
-                        print error
-                        self.log.info(error)
-                        self.display_message(boxnumber, error, target='status')
-                        self.stop_box(boxnumber, error_mode=True)
-
-                    else:  # Successfully started
-                        self.box_button_control(boxnumber, "start")  # UI modifications while box is running
-                        self.log.debug("Setting status icon to 'start'")
-                        self.status_icon(boxnumber, 'start')
-                        self.lastStartList[boxnumber] = dt.datetime.now()
-                        self.sleepScheduleList[boxnumber] = self.defaultSleepSchedule
+                    self.process_started(boxnumber)
+
+                    # UI modifications while box is running (so it can also be stopped while starting up)
+                    self.box_button_control(boxnumber, "start")
+                    self.display_message(boxnumber, 'Starting...', target='status')
+                    self.lastStartList[boxnumber] = dt.datetime.now()
+                    self.sleepScheduleList[boxnumber] = self.defaultSleepSchedule
+
+    def process_started(self, boxnumber):
+        # set up for a newly launched (or relaunched) box process
+        self.statusReceivedList[boxnumber] = False  # read summary file until new process sends status
+        self.outputReader.add(boxnumber, self.subprocessBox[boxnumber].stderr)  # for error messages
+
+    def box_event_received(self, boxnumber, event, detail):
+        # Result of a BoxSupervisor operation (see pyoperant/supervisor.py), passed to the GUI thread by box_event.
+        # Crashed and stalled boxes are restarted by the supervisor, with increasing delays if they keep failing
+        event = str(event)
+        if event == 'ready':  # Successfully started
+            self.log.debug("Box {:02d} ready (pid {}), setting status icon to 'start'".format(boxnumber + 1, detail))
+            self.status_icon(boxnumber, 'start')
+            self.lastStartList[boxnumber] = dt.datetime.now()
+        elif event in ('failed', 'exited', 'stalled'):
+            error = self.get_error(boxnumber)
+            if not error.strip():
+                error = 'Error: box {} ({})'.format(event, detail)
+            print error
+            self.log.info(error)
+            self.display_message(boxnumber, error, target='status')
+            self.status_icon(boxnumber, 'error')
+        elif event == 'restarting':
+            self.log.info('Restarting box {:02d} in {:g} s'.format(boxnumber + 1, detail))
+        elif event == 'restarted':
+            self.subprocessBox[boxnumber] = detail
+            self.process_started(boxnumber)
+            self.lastStartList[boxnumber] = dt.datetime.now()
+        elif event == 'gave_up':
+            error = 'Error: box stopped after repeated failures ({})'.format(detail)
+            self.log.error(error)
+            self.stop_box(boxnumber, error_mode=True)
+            self.display_message(boxnumber, error, target='status')
+        elif event == 'stopped':
+            self.log.debug('Box {:02d} process stopped (exit code {})'.format(boxnumber + 1, detail))
+        elif event == 'done':
+            self.log.debug('Box {:02d}: {} done'.format(boxnumber + 1, detail))
+        elif event == 'error':
+            self.display_message(boxnumber, 'Error: {}'.format(detail), target='status')
 
     def start_all(self):
-        # start all checked boxes
+        # start all checked boxes. Each one starts up in its own process, so there's no need to wait between them
         for boxnumber in self.boxList:
             if self.subprocessBox[boxnumber] == 0 and self.checkActiveBoxList[boxnumber].checkState():
                 self.start_box(boxnumber)
-                time.sleep(3)
 
     def stop_all(self):
         # stop all running boxes
@@ -673,57 +728,31 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
             if not self.subprocessBox[boxnumber] == 0:
                 self.stop_box(boxnumber)
 
-    def read_output_box(self, boxnumber, pipe, q):
-
-        while True:
-            output = pipe.readline()
-            q.put(output)
-
-            # Added the following so that the queue stops when the parent thread stops
-            # (so it doesn't take off and inflate memory usage)
-            try:
-                running = self.subprocessBox[boxnumber].poll()  # Tried this on 10/22/18
-            except AttributeError:
-                # If subprocess was already stopped, and the subprocessBox value was already cleared,
-                # then poll() will throw an error
-                running = 1
-            # running = self.subprocessBox[boxnumber]
-            if running is not None:
-                break
-
     def sleep_box(self, boxnumber):
-        # Turn off house light
-        boxnumber = boxnumber + 1
-        print("Box {:d} going to sleep".format(boxnumber))
-        self.log.info("Box {:d} going to sleep".format(boxnumber))
-        device_name = '/dev/teensy{:02d}'.format(boxnumber)
-        device = serial.Serial(port=device_name, baudrate=19200, timeout=5)
-        if device is None:
-            print 'Could not open serial device {}'.format(device_name)
-            self.log.info('Could not open serial device {}'.format(device_name))
-            raise 'Could not open serial device {}'.format(device_name)
-        else:
-            device.readline()
-            device.flushInput()
-            device.write("".join([chr(3), chr(3)]))  # set channel 3 (house light) as output
-            device.write("".join([chr(3), chr(1)]))  # turn off house lights
-            device.close()  # close connection
+        # Turn off house light. Connecting to the Teensy can take several seconds, so it's done on a supervisor thread
+        # (after the box's process has exited, so the serial port is free)
+        print("Box {:d} going to sleep".format(boxnumber + 1))
+        self.log.info("Box {:d} going to sleep".format(boxnumber + 1))
+        self.supervisor.run_task(boxnumber, 'sleep', self.set_house_light, boxnumber, False)
 
     def wake_box(self, boxnumber):
-        print("Box {:d} waking up".format(boxnumber))
-        self.log.info("Box {:d} waking up".format(boxnumber))
-        device_name = '/dev/teensy{:02d}'.format(boxnumber)
-        device = serial.Serial(port=device_name,
-                               baudrate=19200,
-                               timeout=5)
-        if device is None:
-            self.log.error('Could not open serial device {}'.format(device_name))
-            raise 'Could not open serial device {}'.format(device_name)
-        else:
+        print("Box {:d} waking up".format(boxnumber + 1))
+        self.log.info("Box {:d} waking up".format(boxnumber + 1))
+        self.supervisor.run_task(boxnumber, 'wake', self.set_house_light, boxnumber, True)
+
+    def set_house_light(self, boxnumber, on):
+        # Runs on a supervisor thread, so no GUI calls in here
+        device_name = '/dev/teensy{:02d}'.format(boxnumber + 1)
+        device = serial.Serial(port=device_name, baudrate=19200, timeout=5)  # raises SerialException on failure
+        try:
             device.readline()
             device.flushInput()
             device.write("".join([chr(3), chr(3)]))  # set channel 3 (house light) as output
-            device.write("".join([chr(3), chr(2)]))  # turn on house lights
+            if on:
+                device.write("".join([chr(3), chr(2)]))  # turn on house lights
+            else:
+                device.write("".join([chr(3), chr(1)]))  # turn off house lights
+        finally:
             device.close()  # close connection
 
     # endregion
@@ -762,6 +791,11 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
                     self.deviceIDList[boxIndex] = None
                     self.check_teensy(boxIndex, False)
 
+    def sound_device_monitor(self, action, device):
+        if action in ('add', 'remove', 'change'):
+            self.log.debug('Sound device {:s}: {:s}'.format(action, device.sys_name))
+            devices.registry.invalidate()
+
     def check_teensy(self, boxindex=None, connect=False):
         # device_path is result from device_paths of device that was connected/disconnected
         # It needs to be parsed to get the actual box number
@@ -799,206 +833,70 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
                 gc.collect()
             elif parameter == 'purge':
                 self.log.info("Purging water system in box {:d} for {:d} s".format(boxnumber, purge_time))
-                device_name = '/dev/teensy{:02d}'.format(boxnumber)
-                device = serial.Serial(port=device_name, baudrate=19200, timeout=5)
-                if device is None:
-                    self.log.error('Water error: Could not open serial device {}'.format(device_name))
-                    raise 'Could not open serial device {}'.format(device_name)
-
-                device.readline()
-                device.flushInput()
-                self.log.debug("Successfully opened device {}".format(device_name))
-                device.write("".join([chr(16), chr(3)]))  # set channel 16 (solenoid) as output
-                # device.write("".join([chr(16), chr(2)]))  # close solenoid, just in case
-                device.write("".join([chr(16), chr(1)]))  # open solenoid
-                startTime = time.time()
-
-                while True:
-                    elapsedTime = time.time() - startTime
-                    if purge_time <= elapsedTime:
-                        break
-
-                device.write("".join([chr(16), chr(2)]))  # close solenoid
-                device.close()  # close connection
-                print "Purged box {:02d}".format(boxnumber)
-                self.log.info("Purged box {:02d}".format(boxnumber))
+                # on a supervisor thread, so the GUI isn't frozen for the whole purge
+                self.supervisor.run_task(boxindex, 'purge', self.purge_water, boxnumber, purge_time)
         else:
             print "Cannot open solenoid: Box {0} is currently running".format(str(boxnumber))
             self.log.error("Water error: Cannot open solenoid: Box {0} is currently running".format(str(boxnumber)))
 
+    def purge_water(self, boxnumber, purge_time):
+        # Runs on a supervisor thread, so no GUI calls in here
+        device_name = '/dev/teensy{:02d}'.format(boxnumber)
+        device = serial.Serial(port=device_name, baudrate=19200, timeout=5)  # raises SerialException on failure
+        try:
+            device.readline()
+            device.flushInput()
+            self.log.debug("Successfully opened device {}".format(device_name))
+            device.write("".join([chr(16), chr(3)]))  # set channel 16 (solenoid) as output
+            # device.write("".join([chr(16), chr(2)]))  # close solenoid, just in case
+            device.write("".join([chr(16), chr(1)]))  # open solenoid
+            time.sleep(purge_time)
+        finally:
+            device.write("".join([chr(16), chr(2)]))  # close solenoid
+            device.close()  # close connection
+        print "Purged box {:02d}".format(boxnumber)
+        self.log.info("Purged box {:02d}".format(boxnumber))
+
     # endregion
 
     # region Sound check
     def sound_check(self, boxindex):
-
-        def callback(in_data, frame_count, time_info, status):
-            # necessary for pyaudio to play in non-blocking mode
-            data = self.wf.readframes(frame_count)
-            return data, pyaudio.paContinue
-
-        def rms_calc(block):
-            # rms is sqrt((mean level)^2)
-            blockValues = numpy.fromstring(block, dtype=numpy.int16)
-            blockMS = numpy.mean(blockValues ** 2)
-            # print(blockMS)
-            blockRMS = numpy.sqrt(blockMS)
-            return blockRMS
-
-        playSound = True
-        recordSound = True
-
+        # Play test tone and measure its level through the box's microphone. Runs on a worker thread, so the GUI
+        # stays responsive and several boxes can be checked at once
         boxNumber = boxindex + 1
         testFile = '/home/rouse/bird/stim/440 test tone.wav'
-        soundOut = pyaudio.PyAudio()
-        soundIn = pyaudio.PyAudio()
-        tempRecording = 'Box {:02d} cal.wav'.format(boxNumber)
-
-        # Get actual device indices
-        deviceNameOut = 'Board{:02d}: USB Audio'.format(boxNumber)
-        deviceIndexOut = None
-        for index in range(soundOut.get_device_count()):
-            truncName = soundOut.get_device_info_by_index(index)['name']
-            if deviceNameOut[:18] == truncName[:18]:  # only check the first 7 characters
-                deviceIndexOut = index
-                break
-            else:
-                deviceIndexOut = None
-        if deviceIndexOut is None:
-            raise NameError('could not find pyaudio device %s' % deviceNameOut)
-
-        # get input device index
-        # Complicated because ALSA number doesn't necessarily correspond with pyaudio's device index,
-        # and there doesn't seem to be a good way of simply renaming the devices in a way that pyaudio can read.
-        # Therefore the process is:
-        #   1. Name the ALSA card (with udev rules) by USB port (since the devices are all identical and don't have a
-        #   unique serial number)
-        #   2. Find the card number of a particular named card
-        #   3. Pyaudio can read card numbers, so get the pyaudio device with the matching card number
-        deviceNameIn = 'sound%02i' % boxNumber
-        deviceIndexIn = None
-
-        # First get list of cards on computer
-        cardFile = '/proc/asound/cards'  # cards file contains list of all cards
-        f = open(cardFile, 'r')
-        fl = f.readlines()
-        f.close()
-        # cards file is formatted "number [deviceName     ] so pull values before the matching name to get card number
-        matchString = '^(.+?)\s\[' + deviceNameIn
-        deviceCardIn = []
-        for x in fl:
-            m = re.search(matchString, x)
-            if m is not None:
-                deviceCardIn = int(m.groups()[0])
-                # print("ALSA Card number: %d" % deviceCardIn)
-                break
-        if not deviceCardIn:
-            raise NameError('could not find input device %s' % deviceNameIn)
-
-        # now use ALSA card number to find pyaudio device index
-
-        for index in range(soundIn.get_device_count()):
-            pyaudioInputIndex = []
-            try:
-                pyaudioInputIndex = re.split('hw:', soundIn.get_device_info_by_index(index)['name'])[1]
-            except IndexError:
-                pass
-            if pyaudioInputIndex:
-                # if hw number returned, compare with ALSA card
-                pyaudioInputIndex = int(re.split(',', pyaudioInputIndex)[0])
-
-                if pyaudioInputIndex == deviceCardIn:
-                    deviceIndexIn = int(index)
-                    break
-
-        if deviceIndexIn is None:
-            raise NameError('could not find pyaudio device %s' % self.device_name)
-
-        # open wav file
-        self.wf = wave.open(testFile)
-
-        # create stream object for output
-        streamOut = soundOut.open(format=soundOut.get_format_from_width(self.wf.getsampwidth()),
-                                  channels=1,  # fixed to 1 for single-channel (mono) stimuli
-                                  rate=self.wf.getframerate(),
-                                  output=True,
-                                  output_device_index=deviceIndexOut,
-                                  start=False,
-                                  stream_callback=callback)
-
-        # create stream object for input
-        CHUNK = 4096  # recording chunk size
-        RATE = 44100  # recording sampling rate
-        SECONDS = 2  # how long to record
-        FORMAT = soundIn.get_format_from_width(self.wf.getsampwidth())
-
-        streamIn = soundIn.open(format=FORMAT,
-                                channels=1,
-                                rate=RATE,
-                                input=True,
-                                input_device_index=deviceIndexIn,
-                                frames_per_buffer=CHUNK
-                                )
-
-        recordingFrames = []  # Initialize it first just in case the record function fails
-
-        def record():
-            streamIn.start_stream()
-            nFrames = 10  # 1.5 seconds
-            # recording for SECONDS seconds
-            frames = []
-            # print("starting recording")
-            maxrms = 0
-            for i in range(0, int(RATE / CHUNK * SECONDS)):
-                data = streamIn.read(CHUNK)
-                # Check rms for each chunk
-                newrms = rms_calc(data)
-                if newrms > maxrms:
-                    maxrms = newrms
-                frames.append(data)
-            # frames = streamIn.read(CHUNK*nFrames)
-            # # create temporary wav file
-            #
-            # # print("recording finished")
-            # TODO: check if wave library does autoscaling and find way to disable if present
-            wavFile = wave.open(tempRecording, 'wb')
-            wavFile.setnchannels(1)
-            wavFile.setsampwidth(soundIn.get_sample_size(FORMAT))
-            wavFile.setframerate(RATE)
-            wavFile.writeframes(b''.join(frames))
-            wavFile.close()
-
-            # # print("file closed")
-            return frames
-
-        # play sound, then start recording
-        if playSound:
-            streamOut.start_stream()
-        if recordSound:
-            recordingFrames = record()
-
-        # stop recording
-        try:
-            streamIn.close()
-        except AttributeError:
-            streamIn = None
-        try:
-            streamOut.close()
-        except AttributeError:
-            streamOut = None
-
-        # get dB value from recording
-        # wavFs, readWav = wavfile.read(tempRecording, 'rb')
-        #
-        # wavRms = numpy.sqrt(numpy.mean(readWav ** 2))
-        recording = numpy.fromstring(b''.join(recordingFrames), dtype=numpy.int16)
-        recordingRMS = numpy.sqrt(numpy.mean(recording) ** 2)
-        recordingdB = 20 * numpy.log10(recordingRMS)
-
-        # report peak level
-        messageOut = "Box %s level: %f rms (raw) \ndBFS: %f" % (boxNumber, recordingRMS, recordingdB)
+        self.display_message(boxindex, 'Box {:d} sound check...'.format(boxNumber))
+
+        worker = AnalysisWorker(lambda progress: calibration.sound_check(boxNumber, testFile), self)
+        worker.result_ready.connect(lambda result, b=boxindex: self.sound_check_done(b, result))
+        worker.failed.connect(lambda error, b=boxindex: self.display_message(
+            b, 'Sound check failed:\n{}'.format(str(error).strip().splitlines()[-1])))
+        worker.finished.connect(lambda w=worker: self.analysisWorkers.remove(w))
+        self.analysisWorkers.append(worker)
+        worker.start()
+
+    def sound_check_all(self):
+        # check every active box that isn't running (a running box has its sound device open)
+        for boxnumber in self.boxList:
+            if self.subprocessBox[boxnumber] == 0 and self.checkActiveBoxList[boxnumber].isChecked():
+                self.sound_check(boxnumber)
+
+    def sound_check_done(self, boxindex, result):
+        # Show and save sound check result, with change since last check
+        history = calibration.CalibrationHistory()
+        previous = history.last(result['box'])
+        history.add(result)
+
+        def level(value):
+            return 'silent' if value is None else '{:.1f} dBFS'.format(value)
+
+        messageOut = "Box {:d} level: {} rms, {} peak\nLoudest frequency: {:.0f} Hz".format(
+            result['box'], level(result['rms_dbfs']), level(result['peak_dbfs']), result['dominant_frequency'] or 0)
+        if previous is not None and previous['rms_dbfs'] is not None and result['rms_dbfs'] is not None:
+            messageOut += "\nChange since {}: {:+.1f} dB".format(
+                time.strftime('%x', time.localtime(previous['time'])), result['rms_dbfs'] - previous['rms_dbfs'])
+        self.log.info(messageOut.replace('\n', '; '))
         self.display_message(boxindex, messageOut)
-        soundOut.terminate()
-        soundIn.terminate()
 
     # endregion
 
@@ -1025,44 +923,14 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
                             # Box not asleep, make it sleep
                             self.stop_box(boxnumber, sleep_mode=True)
 
-                # Check if subprocess is still running, not sleeping
+                # Crashes, stalls and idle boxes are handled by the supervisor (see box_event_received)
                 if self.subprocessBox[boxnumber] != 1:  # subprocessBox set to 1 when sleeping, so don't check that
                     # Box should be active, not sleeping
                     poll = self.subprocessBox[boxnumber].poll()  # poll() == None means the subprocess is still running
-                    if poll is None:  # or self.args['debug'] is not False:
+                    if poll is None and not self.statusReceivedList[boxnumber]:
+                        # box hasn't pushed any status (yet), so read its files instead
                         self.refreshfile(boxnumber)
 
-                        # Restart if last trial was more than 2 hours ago
-                        try:
-                            timeDeltaSinceTrial = (dt.datetime.now() - self.lastTrialList[boxnumber])
-                            timeSinceTrial = timeDeltaSinceTrial.total_seconds() / 3600
-                        except TypeError:
-                            timeSinceTrial = 10  # if last trial time isn't available, then assume it's very large
-
-                        timeDeltaSinceStart = dt.datetime.now() - self.lastStartList[boxnumber]  # also ensure box has
-                        # been running for at least two hours
-                        timeSinceStart = timeDeltaSinceStart.total_seconds() / 3600
-
-                        if timeSinceStart > self.idleTime and timeSinceTrial > self.idleTime:
-                            # restart box
-                            self.stop_box(boxnumber, error_mode=False)  # stop box
-                            self.log.info('Restarting box {:02d}'.format(boxnumber + 1))
-                            time.sleep(2)  # wait a second
-                            self.start_box(boxnumber)  # restart box
-                    else:
-                        self.stop_box(boxnumber, error_mode=True)
-                        # Box stopped on error, if soon after box wakeup time, try restarting
-                        # This should only fire once after a failed startup, since the code can only get to this else
-                        # statement if the box is supposed to be running and isn't
-                        # added because box 04 fails to wake up properly, but is not giving any errors, and starts
-                        # fine if the button is clicked manually
-                        # Seems the thread crashes, but pyoperant doesn't log anything unusual
-                        waketimeStr = self.sleepScheduleList[boxnumber][0][0]
-                        waketime = dt.datetime.strptime(waketimeStr, "%H:%M")
-                        if dt.datetime.now().hour == waketime.hour:
-                            time.sleep(10)
-                            self.start_box(boxnumber)  # try again
-
     def refreshfile(self, boxnumber):
 
         if self.debug:
@@ -1115,71 +983,130 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
                 errorSuccess = False
 
             if errorSuccess and len(errorData) > 1:  # If error file correctly opened and there is an error
+                errorText = ''.join(errorData)
+            else:
+                errorText = ''
+            self.display_status(boxnumber, logData, logFull, errorText)
+        else:
+            print "{0}{1}".format("Unable to open file for ", birdName)
+            self.log.info("{0}{1}".format("Unable to open file for ", birdName))
+
+    def apply_status(self, box_status, changed):
+        # Display status pushed by a pyoperant process (received by StatusReceiver)
+        boxnumber = self.status_box(box_status)
+        if boxnumber is None:
+            return
+        self.statusReceivedList[boxnumber] = True
+        self.supervisor.handle_status(boxnumber, box_status, changed)  # startup handshake and heartbeats
+        if changed is not None and not changed - {'ready', 'heartbeat'}:
+            return  # nothing to display
+
+        state = box_status['state']
+        errorText = '\n'.join(box_status['errors'])
+        if not state and not errorText:
+            return
+        if 'message' in state:
+            self.display_status(boxnumber, state['message'], False, errorText, changed)
+        else:
+            self.display_status(boxnumber, state, True, errorText, changed)
+
+    def status_box(self, box_status):
+        # Returns index of the box that box_status came from, or None if it isn't from a box that's running that bird
+        try:
+            boxnumber = int(box_status['panel']) - 1
+        except (TypeError, ValueError):
+            return None
+        if boxnumber not in self.boxList:
+            return None
+        if str(self.birdEntryBoxList[boxnumber].toPlainText()) != box_status['subject']:
+            return None
+        return boxnumber
+
+    def display_status(self, boxnumber, log_data, log_full, error_text, changed=None):
+        """
+        Shows a box's status
+        log_data -- summary dict (if log_full) or message to display
+        error_text -- error messages, shown instead of the summary if there are any
+        changed -- set of summary fields that changed since status was last shown, so only those parts of the display
+        are redrawn. None to redraw everything
+        """
+        def needs_update(part):
+            return changed is None or any(field in changed for field in self.STATUS_DISPLAY_FIELDS[part])
+
+        if error_text:  # If there is an error
+            if changed is None or 'errors' in changed:
                 # print "error log"
                 # self.log.info("error log")
-                self.display_message(boxnumber, errorData, target='status')
-            else:
-                if logFull:
-                    # self.display_message(boxnumber, logData)
-                    self.display_message(boxnumber, logData['phase'], target='phase')
-                    self.display_message(boxnumber, 'Last Trial: ' + logData['last_trial_time'], target='time')
+                self.display_message(boxnumber, error_text, target='status')
+        elif log_full:
+            logData = log_data
+            if needs_update('phase'):
+                # self.display_message(boxnumber, logData)
+                self.display_message(boxnumber, logData['phase'], target='phase')
 
+            if needs_update('time'):
+                self.display_message(boxnumber, 'Last Trial: ' + logData['last_trial_time'], target='time')
+
+                try:
+                    self.lastTrialList[boxnumber] = dt.datetime.strptime(str(logData['last_trial_time']), '%c')
+                except ValueError:
                     try:
-                        self.lastTrialList[boxnumber] = dt.datetime.strptime(str(logData['last_trial_time']), '%c')
+                        self.lastTrialList[boxnumber] = dt.datetime.strptime(str(logData['last_trial_time']),
+                                                                             '%a %b %d %H:%M:%S %Y')
                     except ValueError:
-                        try:
-                            self.lastTrialList[boxnumber] = dt.datetime.strptime(str(logData['last_trial_time']),
-                                                                                 '%a %b %d %H:%M:%S %Y')
-                        except ValueError:
-                            self.log.error('Last Trial datetime not parsed properly')
-
-                    logTotalsMessage = "Training Trials: {trials}   Probe trials: {probe_trials}\n" \
-                                       "Rf'd responses: {feeds}".format(**logData)
-                    logTotalsMessage.encode('utf8')
-                    self.display_message(boxnumber, logTotalsMessage, target='status')
-
-                    self.logRawCounts = QtGui.QStandardItemModel(self)
-                    self.logRawCounts.setHorizontalHeaderLabels(["S+", "S-", "Prb+", "Prb-"])
-                    self.logRawCounts.setVerticalHeaderLabels(["RspSw", "TrlSw"])
-
-                    rawCounts = [
-                        [
-                            str(logData["correct_responses"]),
-                            str(logData["false_alarms"]),
-                            str(logData["probe_hit"]),
-                            str(logData["probe_FA"])
-                        ],
-                        [
-                            ("{0} ({1})".format(logData["misses"], logData["splus_nr"])),
-                            ("{0} ({1})".format(logData["correct_rejections"], logData["sminus_nr"])),
-                            ("{0} ({1})".format(logData["probe_miss"], logData["probe_miss_nr"])),
-                            ("{0} ({1})".format(logData["probe_CR"], logData["probe_CR_nr"]))
-                        ]
-                    ]
-                    for row in range(len(rawCounts)):
-                        for column in range(len(rawCounts[row])):
-                            self.logRawCounts.setItem(row, column, QtGui.QStandardItem(rawCounts[row][column]))
-
-                    self.statusTableBoxList[boxnumber].setModel(self.logRawCounts)
+                        self.log.error('Last Trial datetime not parsed properly')
+
+            if needs_update('totals'):
+                logTotalsMessage = "Training Trials: {trials}   Probe trials: {probe_trials}\n" \
+                                   "Rf'd responses: {feeds}".format(**logData)
+                logTotalsMessage.encode('utf8')
+                self.display_message(boxnumber, logTotalsMessage, target='status')
+
+            if needs_update('counts'):
+                if self.statusModelList[boxnumber] is None:
+                    # create table once per box, then just update its values
+                    logRawCounts = QtGui.QStandardItemModel(self)
+                    logRawCounts.setHorizontalHeaderLabels(["S+", "S-", "Prb+", "Prb-"])
+                    logRawCounts.setVerticalHeaderLabels(["RspSw", "TrlSw"])
+                    self.statusModelList[boxnumber] = logRawCounts
+
+                    self.statusTableBoxList[boxnumber].setModel(logRawCounts)
                     self.statusTableBoxList[boxnumber].horizontalHeader().setResizeMode(
                         QtGui.QHeaderView.ResizeToContents)
                     self.statusTableBoxList[boxnumber].horizontalHeader().setStretchLastSection(True)
                     self.statusTableBoxList[boxnumber].verticalHeader().setResizeMode(
                         QtGui.QHeaderView.Stretch)
 
-                    if self.useNRList[boxnumber].isChecked():
-                        logStats = "d' (NR): {dprime_NR:1.2f}      " + \
-                                   "Beta (NR): {bias_NR:1.2f} {bias_description_NR}".format(**logData)
-                    else:
-                        logStats = "d': {dprime:1.2f}      Beta: {bias:1.2f} {bias_description}".format(**logData)
-                    logStats.decode('utf8')
-                    self.display_message(boxnumber, logStats, target='statusStats')
-
+                rawCounts = [
+                    [
+                        str(logData["correct_responses"]),
+                        str(logData["false_alarms"]),
+                        str(logData["probe_hit"]),
+                        str(logData["probe_FA"])
+                    ],
+                    [
+                        ("{0} ({1})".format(logData["misses"], logData["splus_nr"])),
+                        ("{0} ({1})".format(logData["correct_rejections"], logData["sminus_nr"])),
+                        ("{0} ({1})".format(logData["probe_miss"], logData["probe_miss_nr"])),
+                        ("{0} ({1})".format(logData["probe_CR"], logData["probe_CR_nr"]))
+                    ]
+                ]
+                for row in range(len(rawCounts)):
+                    for column in range(len(rawCounts[row])):
+                        self.statusModelList[boxnumber].setItem(row, column,
+                                                                QtGui.QStandardItem(rawCounts[row][column]))
+
+            if needs_update('stats'):
+                if self.useNRList[boxnumber].isChecked():
+                    logStats = "d' (NR): {dprime_NR:1.2f}      " + \
+                               "Beta (NR): {bias_NR:1.2f} {bias_description_NR}".format(**logData)
                 else:
-                    self.display_message(boxnumber, logData, target='status')
-        else:
-            print "{0}{1}".format("Unable to open file for ", birdName)
-            self.log.info("{0}{1}".format("Unable to open file for ", birdName))
+                    logStats = "d': {dprime:1.2f}      Beta: {bias:1.2f} {bias_description}".format(**logData)
+                logStats.decode('utf8')
+                self.display_message(boxnumber, logStats, target='statusStats')
+
+        elif changed is None or 'message' in changed:
+            self.display_message(boxnumber, log_data, target='status')
 
     # endregion
 
@@ -1241,14 +1168,8 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
 
     # region Error handling
     def get_error(self, boxnumber):
-        # Check output for any errors
-        while True:  # Loop through error codes generated, if any
-            error = ""
-            try:
-                error = '{0}\n{1}'.format(error, self.qList[boxnumber].get(False))
-            except Queue.Empty:
-                break
-        return error
+        # Check output for any errors (known noise, like ALSA warnings, is left out by the OutputReader)
+        return '\n'.join(self.outputReader.errors(boxnumber))
 
     # def error_handler(self, boxnumber):
     #     # Take any errors and stop box, if necessary
@@ -1338,10 +1259,22 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
     def get_raw_trial_data(self, boxnumber):
         bird_name = str(self.birdEntryBoxList[boxnumber].toPlainText())
         dataFolder = os.path.join(self.experimentPath, bird_name)
-        performance = analysis.Performance(dataFolder)
         output_path = QtGui.QFileDialog.getSaveFileName(self, "Save As...", dataFolder, "CSV Files (*.csv)")
         if output_path:
-            performance.raw_trial_data.to_csv(str(output_path))
+            output_path = str(output_path)
+
+            def export_raw_data(progress):
+                performance = analysis.Performance(dataFolder, progress=progress)
+                performance.raw_trial_data.to_csv(output_path)
+                return output_path
+
+            # Load and export on a worker thread so boxes keep being monitored
+            worker = AnalysisWorker(export_raw_data, self)
+            worker.result_ready.connect(lambda path: self.log.info('Raw trial data saved to {}'.format(path)))
+            worker.failed.connect(lambda error: self.log.error('Raw trial data export failed: {}'.format(error)))
+            worker.finished.connect(lambda w=worker: self.analysisWorkers.remove(w))
+            self.analysisWorkers.append(worker)
+            worker.start()
 
     # endregion
 
@@ -1443,6 +1376,15 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
             self.log.debug("Checked device {:d}".format(int(boxnumber + 1)))
         # Stop running sessions
         self.stop_all()
+        self.supervisor.shutdown()  # wait for them to exit, since the supervisor's threads won't outlive the GUI
+        self.outputReader.close()
+        devices.registry.close()
+
+        if self.statusReceiver is not None:
+            self.statusReceiver.stop()
+        for worker in list(self.analysisWorkers):
+            worker.cancel()
+            worker.wait()
 
         event.accept()  # Accept GUI closing
 
@@ -1459,6 +1401,68 @@ class PyoperantGui(QtGui.QMainWindow, pyoperant_gui_layout.UiMainWindow):
     # endregion
 
 
+class AnalysisWorker(QtCore.QThread):
+    """
+    Runs an analysis task on its own thread, so the GUI (and monitoring of running boxes) isn't blocked while trial
+    data is loaded or analyzed
+    task is called as task(progress), where progress is a callback for analysis.Performance. The task's return value
+    is sent with result_ready, or the traceback with failed if it raises an error. cancel() stops the task at its next
+    progress update, and no result is sent
+    """
+    progress = QtCore.pyqtSignal(int, int)
+    result_ready = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, task, parent=None):
+        super(AnalysisWorker, self).__init__(parent)
+        self.task = task
+        self.cancelled = False
+
+    def run(self):
+        try:
+            result = self.task(self.report_progress)
+        except AnalysisCancelled:
+            return
+        except Exception:
+            self.failed.emit(traceback.format_exc())
+            return
+        if not self.cancelled:
+            self.result_ready.emit(result)
+
+    def report_progress(self, done, total):
+        if self.cancelled:
+            raise AnalysisCancelled()
+        self.progress.emit(done, total)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class StatusReceiver(QtCore.QThread):
+    """
+    Receives box status pushed by running pyoperant processes (see pyoperant/status.py) on its own thread, so the GUI
+    thread doesn't have to do any file reading to keep box status up to date. Each change is passed to the GUI thread
+    with the status_changed signal: (status dict, set of changed fields or None if all fields may have changed)
+    """
+    status_changed = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, listener, parent=None):
+        super(StatusReceiver, self).__init__(parent)
+        self.listener = listener
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for key, boxStatus, changed in self.listener.receive(timeout=1.0):
+                # copy, since the listener keeps updating its own status dicts on this thread
+                self.status_changed.emit(copy.deepcopy(boxStatus), changed)
+
+    def stop(self):
+        self.running = False
+        self.wait()
+        self.listener.close()
+
+
 class SolenoidGui(QtGui.QDialog, pyoperant_gui_layout.UiSolenoidControl):
     """
     Code for creating and managing dialog that can open and close the solenoid for a given box manually
@@ -1562,12 +1566,14 @@ class StatsGui(QtGui.QDialog, pyoperant_gui_layout.StatsWindow):
     Code for creating and managing dialog that displays bird's performance stats
     Added 11/30/18 by AR
     This is probably done all very very wrong:
-        - Pyqt can't easily display a DataFrame with multiple indices per axis, so the whole
-        DataFrame is exported to a csv and that file is then imported directly into the QTableView.
-        - Importing the data from the CSV uses hard-coded column numbers, because dynamically assigning them was
-        drastically slower than hardcoded values (2 seconds vs 15 seconds). God help you if the pyoperant output csv
-        changes column order at any point (although adding new columns at the end shouldn't affect existing column
-        indices)
+        - Pyqt can't easily display a DataFrame with multiple indices per axis, so the table's DataFrameModel shows the
+        DataFrame's index levels as leading columns (the same layout the exported csv has). The model reads cells from
+        the DataFrame as they're displayed, so even raw trial views don't create an item per cell.
+        - Trial data is loaded once per bird selection and held by an analysis.AnalysisSession, which caches results
+        by filter/grouping so repeated recalculations don't reread or regroup the data. CSV files are only written
+        when the user exports.
+        - Loading and recalculating run on an AnalysisWorker thread, so the main window keeps monitoring boxes. Only
+        the latest request matters: a new one cancels the one running, and starts once that has stopped.
         - It was frustratingly hard to get in-place filtering of the csv data (without completely removing or
         adding new columns), because QTableView uses a model, so all columns have to be referenced by index rather
         than name. Therefore all filtering, grouping, and column selection is done within pandas in the analysis.py
@@ -1624,6 +1630,7 @@ class StatsGui(QtGui.QDialog, pyoperant_gui_layout.StatsWindow):
             self.create_grouping_checkbox('Tempo')
             self.create_grouping_checkbox('Trial Type')
             self.create_grouping_checkbox('Stimulus')
+            self.create_grouping_checkbox('Family')
             self.create_grouping_checkbox('Class')
             self.create_grouping_checkbox('Response Type')
             self.create_grouping_checkbox('Response')
@@ -1648,6 +1655,11 @@ class StatsGui(QtGui.QDialog, pyoperant_gui_layout.StatsWindow):
             self.dataGroups = []
             self.filters = []
 
+            self.session = None  # set once trial data is loaded
+            self.analysisWorker = None
+            self.queuedAnalysis = None  # request to run when the current worker stops
+            self.recalculatePending = False  # recalculation requested while trial data was still loading
+
             self.fieldManagement = analysis.FieldList().build_dict()
 
             self.create_filter_objects()
@@ -1692,38 +1704,18 @@ class StatsGui(QtGui.QDialog, pyoperant_gui_layout.StatsWindow):
             print 'saved to {}'.format(output_path)
             self.outputFolder = os.path.split(output_path)[0]
 
-    def refresh_table(self, output_path):
+    def refresh_table(self):
         """
         Refresh the data table with new values produced by the recalculate() method
         Called as part of recalculate()
-        This process reimports the data from a csv because moving directly from dataframe is a pain and doesn't support
-        multiple headers, e.g. if the data is grouped by more than one field (which the data usually is)
+        Index levels (e.g. the grouping fields when data is grouped by more than one field) are shown as leading
+        columns, matching the layout of the exported csv
         """
 
-        # Pull csv data into model, then put model into table - apparently proper way of doing it in Pyqt
-        self.model = QtGui.QStandardItemModel(self)
-
-        with open(output_path, 'rb') as inputFile:
-            i = 1
-            for row in csv.reader(inputFile):
-                if i == 1:  # set headers of table
-                    for column in range(len(row)):
-                        # reencode each item in header list as utf-8 so beta can be displayed properly
-                        row[column] = row[column].decode('utf-8')
-                        # row[column] = row[column].replace(' (NR)', '\n(NR)')
-
-                    self.model.setHorizontalHeaderLabels(row)
+        # Model reads values straight from the dataframe as they're displayed, and sorts itself (no proxy model needed)
+        self.model = DataFrameModel(self.outputData, self)
 
-                else:  # set items in rows of table
-                    items = [QtGui.QStandardItem(field) for field in row]
-                    self.model.appendRow(items)
-                i += 1
-
-        # ProxyModel allows sorting
-        self.proxyModel = QtGui.QSortFilterProxyModel()
-        self.proxyModel.setSourceModel(self.model)
-
-        self.performance_Table.setModel(self.proxyModel)  # apply constructed model to tableview object
+        self.performance_Table.setModel(self.model)  # apply constructed model to tableview object
         self.performance_Table.setSortingEnabled(True)
 
         self.recheck_fields()
@@ -2114,11 +2106,7 @@ class StatsGui(QtGui.QDialog, pyoperant_gui_layout.StatsWindow):
                     self.model.headerData(column, QtCore.Qt.Horizontal).toString())  # .replace('\n(NR)',
                 # ' (NR)')
                 if self.fieldManagement[columnName]['filter']['type'] == 'list':
-                    valueList = []
-                    for row in xrange(self.model.rowCount()):
-                        valueIndex = self.model.index(row, column)
-                        valueList.append(str(self.model.data(valueIndex).toString()))
-                    valueList = list(set(valueList))
+                    valueList = [str(value) for value in self.model.unique_values(column)]
                     if 'valueList' in self.fieldManagement[columnName]:
                         valueList = valueList + self.fieldManagement[columnName]['valueList']
                     self.fieldManagement[columnName]['valueList'] = list(set(valueList))
@@ -2234,36 +2222,190 @@ class StatsGui(QtGui.QDialog, pyoperant_gui_layout.StatsWindow):
     # region Analysis methods
 
     def get_raw_data(self):
-        perform = analysis.Performance(self.data_folder)
-        self.rawTrialData = perform.raw_trial_data
-        return perform
+        # Loads trial data for the selected bird(s) in the background; table is recalculated once it's loaded
+        self.session = None
+        dataFolder = self.data_folder
+        self.start_analysis(lambda progress: analysis.AnalysisSession(dataFolder, progress=progress),
+                            self.raw_data_loaded, 'Loading')
+
+    def raw_data_loaded(self, session):
+        self.session = session
+        self.rawTrialData = self.session.raw_trial_data
+        if self.recalculatePending:
+            self.recalculatePending = False
+            self.recalculate(override=True)
 
     def recalculate(self, override=False):
         if override is True or self.hold_Checkbox.isChecked() is True:
-            with wait_cursor():  # set mouse cursor to 'waiting'
-                dropCols = []
-                for x in self.fieldManagement:
-                    if not self.fieldManagement[x]['itemWidget'].checkState():
-                        dropCols.append(x)
-                # dropCols = [col.replace(' (NR)', '\n(NR)') for col in dropCols]
-                self.group_by()
-                perform = analysis.Performance(self.data_folder)
-                perform.filter_data(filters=self.filters)
-                perform.summarize('filt')
-                self.outputData = perform.analyze(perform.summaryData, groupBy=self.dataGroups, dropCols=dropCols)
-
-                outputFile = 'performanceSummary.csv'
-                if isinstance(self.data_folder, list):
-                    output_path = os.path.join(self.data_folder[0], outputFile)
-                else:
-                    output_path = os.path.join(self.data_folder, outputFile)
-                self.outputData.to_csv(str(output_path), encoding='utf-8')
-                self.refresh_table(output_path)
+            if self.session is None:
+                self.recalculatePending = True  # still loading, so recalculate when done (see raw_data_loaded)
+                return
+            dropCols = []
+            for x in self.fieldManagement:
+                if not self.fieldManagement[x]['itemWidget'].checkState():
+                    dropCols.append(x)
+            # dropCols = [col.replace(' (NR)', '\n(NR)') for col in dropCols]
+            self.group_by()
+            # copies, since the worker uses them after this returns
+            session = self.session
+            filters = copy.deepcopy(self.filters)
+            dataGroups = copy.deepcopy(self.dataGroups)
+            self.start_analysis(lambda progress: session.analyze(filters=filters, groupBy=dataGroups,
+                                                                 dropCols=dropCols),
+                                self.analysis_ready, 'Calculating')
+
+    def analysis_ready(self, output_data):
+        self.outputData = output_data
+        self.refresh_table()
+
+    def start_analysis(self, task, on_result, description):
+        """
+        Runs task (called with a progress callback) on an AnalysisWorker, then passes its result to on_result
+        If a worker is already running, it's cancelled and task runs once it stops
+        """
+        if self.analysisWorker is not None and self.analysisWorker.isRunning():
+            self.analysisWorker.cancel()
+            self.queuedAnalysis = (task, on_result, description)
+            return
+
+        worker = AnalysisWorker(task, self)
+        # result of a worker cancelled after it finished (but before its result arrived) is ignored too
+        worker.result_ready.connect(lambda result, w=worker: None if w.cancelled else on_result(result))
+        worker.progress.connect(lambda done, total, d=description: self.analysis_progress(d, done, total))
+        worker.failed.connect(self.analysis_failed)
+        worker.finished.connect(lambda w=worker: self.analysis_finished(w))
+        self.analysisWorker = worker
+
+        self.setCursor(QtCore.Qt.BusyCursor)
+        self.setWindowTitle(str("Performance Data - {}...".format(description)))
+        worker.start()
+
+    def analysis_progress(self, description, done, total):
+        self.setWindowTitle(str("Performance Data - {} ({:d}/{:d} files)".format(description, done, total)))
+
+    def analysis_failed(self, error):
+        self.log.error('Analysis failed: {}'.format(error))
+        QtGui.QMessageBox.warning(self, 'Analysis failed', error.strip().split('\n')[-1])
+
+    def analysis_finished(self, worker):
+        if worker is not self.analysisWorker:
+            return  # an earlier worker, already replaced
+        self.unsetCursor()
+        self.setWindowTitle(str("Performance Data"))
+        if self.queuedAnalysis is not None:
+            queued = self.queuedAnalysis
+            self.queuedAnalysis = None
+            self.start_analysis(*queued)
+
+    def done(self, result):
+        # Stop any analysis before the dialog (and the worker's parent) is deleted
+        self.queuedAnalysis = None
+        if self.analysisWorker is not None:
+            self.analysisWorker.cancel()
+            self.analysisWorker.wait()
+        super(StatsGui, self).done(result)
 
     # endregion Analysis methods
 
 
 # region Reimplemented methods
+class DataFrameModel(QtCore.QAbstractTableModel):
+    """
+    Read-only table model for a pandas DataFrame. Cells are read from the DataFrame (and formatted) only when the view
+    asks for them, so no item is created per cell however big the table is
+    - Index levels are shown as leading columns, named as DataFrame.reset_index() would name them
+    - MultiIndex column names are shown with one line per level
+    - Sorting only reorders an array of row numbers (numpy argsort), rather than the data
+    """
+
+    def __init__(self, data_frame, parent=None):
+        super(DataFrameModel, self).__init__(parent)
+        self.headers = []
+        self.columns = []
+        self.values = []
+        self.rowOrder = numpy.arange(0)
+        self.set_data_frame(data_frame)
+
+    def set_data_frame(self, data_frame):
+        self.beginResetModel()
+        headers = []
+        columns = []
+        index = data_frame.index
+        for level in xrange(index.nlevels):
+            levelName = index.names[level]
+            if levelName is None:
+                levelName = 'index' if index.nlevels == 1 else 'level_{:d}'.format(level)
+            headers.append(levelName)
+            columns.append(index.get_level_values(level))
+        for columnIndex, columnName in enumerate(data_frame.columns):
+            headers.append(columnName)
+            columns.append(data_frame.iloc[:, columnIndex])
+
+        # Datetimes are stored as numpy datetime64, which doesn't print like the csv does, so convert those columns
+        # (only) to Timestamp objects
+        columns = [column.astype(object) if column.dtype.kind in 'Mm' else column for column in columns]
+
+        self.headers = headers
+        self.columns = columns
+        self.values = [column.values for column in columns]
+        self.rowOrder = numpy.arange(len(data_frame))
+        self.endResetModel()
+
+    @staticmethod
+    def header_text(header):
+        if isinstance(header, tuple):
+            return u'\n'.join(format_table_value(level) for level in header if level != '')
+        return format_table_value(header)
+
+    # noinspection PyPep8Naming
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rowOrder)
+
+    # noinspection PyPep8Naming
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return QtCore.QVariant()
+        value = self.values[index.column()][self.rowOrder[index.row()]]
+        return QtCore.QVariant(format_table_value(value))
+
+    # noinspection PyPep8Naming
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole:
+            return QtCore.QVariant()
+        if orientation == QtCore.Qt.Horizontal:
+            return QtCore.QVariant(self.header_text(self.headers[section]))
+        return QtCore.QVariant(int(self.rowOrder[section]) + 1)  # original row number, like a sort proxy shows
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        values = self.values[column]
+        sortKeys = values.codes if hasattr(values, 'codes') else values  # categorical columns sort by code
+        descending = order == QtCore.Qt.DescendingOrder
+        try:
+            newOrder = stable_argsort(sortKeys, descending)
+        except TypeError:
+            # values that can't be compared with each other, so sort by displayed text
+            newOrder = stable_argsort(numpy.array([format_table_value(value) for value in values], dtype=object),
+                                      descending)
+
+        self.layoutAboutToBeChanged.emit()
+        # keep selections etc. on the same data rows
+        newRows = numpy.empty(len(newOrder), dtype=int)
+        newRows[newOrder] = numpy.arange(len(newOrder))
+        oldIndexes = self.persistentIndexList()
+        newIndexes = [self.index(int(newRows[self.rowOrder[oldIndex.row()]]), oldIndex.column())
+                      for oldIndex in oldIndexes]
+        self.rowOrder = newOrder
+        self.changePersistentIndexList(oldIndexes, newIndexes)
+        self.layoutChanged.emit()
+
+    def unique_values(self, column):
+        # Displayed text of each distinct value in a column, read from the dataframe rather than cell by cell
+        return list(set(format_table_value(value) for value in self.columns[column].unique()))
+
+
 # noinspection PyBroadException
 class CheckableDirModel(QtGui.QFileSystemModel):
     """
@@ -2412,6 +2554,28 @@ def wait_cursor():
         QtGui.QApplication.restoreOverrideCursor()
 
 
+def stable_argsort(keys, descending=False):
+    """
+    Returns the indices that sort keys (a numpy array), keeping equal keys in their original order in either direction
+    """
+    if descending:
+        # sorting the reversed keys puts equal keys last to first, so reversing the result puts them first to last
+        return len(keys) - 1 - numpy.argsort(keys[::-1], kind='mergesort')[::-1]
+    return numpy.argsort(keys, kind='mergesort')
+
+
+def format_table_value(value):
+    """
+    Converts a single dataframe value to the text shown in the stats table, matching how to_csv writes it (missing
+    values are left blank)
+    """
+    if value is None or (isinstance(value, float) and numpy.isnan(value)):
+        return u''
+    elif isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
 def commonprefix(args, sep='/'):
     """
     Fix of os.path.commonprefix()
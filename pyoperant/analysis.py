@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import io
 import csv
-# import copy
+import copy
 import datetime as dt  # Pycharm thinks this is unused but it does get used in the filter building section
 import numpy as np
-from scipy.stats import norm
-from scipy.stats import beta
-import pandas as pd
 import re
 import logging, traceback
+from pyoperant import triallog
+from pyoperant.utils import LazyModule
 # import string
 import collections  # for orderedDict
 
@@ -18,6 +18,10 @@ try:
 except ImportError:
     import json
 
+# pandas and scipy take most of a box process's start up time, and are only needed once trials are analyzed
+pd = LazyModule('pandas')
+stats = LazyModule('scipy.stats')
+special = LazyModule('scipy.special')
 
 # from matplotlib import mlab
 
@@ -60,7 +64,7 @@ def dprime(confusion_matrix):
         if fa_rate <= 0:
             fa_rate = 0 + nudge_fa
 
-        dp = norm.ppf(hit_rate) - norm.ppf(fa_rate)
+        dp = special.ndtri(hit_rate) - special.ndtri(fa_rate)  # ndtri is the normal quantile (z) function
         return dp
 
 
@@ -93,7 +97,7 @@ def bias(confusion_matrix):
         if fa_rate <= 0:
             fa_rate = 0 + nudge_fa
 
-        bias_c = -0.5 * (norm.ppf(hit_rate) + norm.ppf(fa_rate))
+        bias_c = -0.5 * (special.ndtri(hit_rate) + special.ndtri(fa_rate))
 
         dp = dprime(confusion_matrix)
 
@@ -122,7 +126,7 @@ def acc_ci(confusion_matrix, alpha=0.05):
     x = confusion_matrix.diagonal().sum()
     N = confusion_matrix.sum()
 
-    ci = beta.interval(1 - alpha, x, N - x)
+    ci = stats.beta.interval(1 - alpha, x, N - x)
     return ci
 
 
@@ -192,6 +196,423 @@ def create_conf_matrix_summary(matrix):
 # endregion
 
 
+def divide_by_zero(numerator, denominator, roundto=3):
+    # error catching for ZeroDivisionError so I don't have to catch the exception every single time manually
+    try:
+        result = round(float(numerator) / float(denominator), roundto)
+    except ZeroDivisionError:
+        result = None
+    return result
+
+
+def group_stats(groupData):
+    """
+    Calculates the 'group' fields (d', beta, proportion correct, etc.) for each row of a dataframe of summed response
+    counts, as produced by grouping trial data in Performance.analyze. Calculated columns are added to groupData,
+    which is also returned
+    """
+    groupCount = len(groupData)
+
+    # region Variable init
+    dprimes = []
+    dprimes_NR = []
+    betas = []
+    betas_NR = []
+    sPlus_correct = []
+    sPlus_NR_correct = []
+    sMinus_correct = []
+    sMinus_NR_correct = []
+    total_correct = []
+    total_NR_correct = []
+    probeDprimes = []
+    probeDprimes_NR = []
+    probeBetas = []
+    probeBetas_NR = []
+    probePlus_correct = []
+    probePlus_NR_correct = []
+    probeMinus_correct = []
+    probeMinus_NR_correct = []
+    total_probe_correct = []
+    total_probe_NR_correct = []
+    resetRatio = []
+    # endregion
+
+    # region Calculate stats for each summary group
+    for k in xrange(groupCount):
+        hitCount = float(groupData['Hit'][k])
+        missCount = float(groupData['Miss'][k])
+        missNRCount = float(groupData['Miss (NR)'][k])
+        FACount = float(groupData['FA'][k])
+        CRCount = float(groupData['CR'][k])
+        CRNRCount = float(groupData['CR (NR)'][k])
+        totalTrials = float(groupData['Trials'][k])
+        probeHitCount = float(groupData['Probe Hit'][k])
+        probeMissCount = float(groupData['Probe Miss'][k])
+        probeMissNRCount = float(groupData['Probe Miss (NR)'][k])
+        probeFACount = float(groupData['Probe FA'][k])
+        probeCRCount = float(groupData['Probe CR'][k])
+        probeCRNRCount = float(groupData['Probe CR (NR)'][k])
+        probeTotalTrials = float(groupData['Probe Trials'][k])
+
+        dayDprime = round(Analysis([[hitCount, missCount], [FACount, CRCount]]).dprime(), 3)
+        dprimes.append(dayDprime)
+
+        # region Training trial stats
+        dayDprime_NR = round(Analysis([[hitCount, (missCount + missNRCount)],
+                                       [FACount, (CRCount + CRNRCount)]]).dprime(), 3)
+        dprimes_NR.append(dayDprime_NR)
+
+        if totalTrials < 10:
+            dayBeta = 'n/a'
+        else:
+            dayBeta = round(Analysis([[hitCount, missCount], [FACount, CRCount]]).bias(), 3)
+        betas.append(dayBeta)
+
+        if totalTrials < 10:
+            dayBeta_NR = 'n/a'
+        else:
+            dayBeta_NR = round(Analysis([[hitCount, (missCount + missNRCount)],
+                                         [FACount, (CRCount + CRNRCount)]]).bias(), 3)
+        betas_NR.append(dayBeta_NR)
+
+        resetRatio.append(divide_by_zero(CRCount, (CRCount + CRNRCount), 5))
+
+        # endregion
+
+        # region Probe trial stats
+        dayProbeDprime = round(Analysis([[probeHitCount, probeMissCount],
+                                         [probeFACount, probeCRCount]]).dprime(), 3)
+        probeDprimes.append(dayProbeDprime)
+
+        dayProbeDprime_NR = round(Analysis([[probeHitCount, (probeMissCount + probeMissNRCount)],
+                                            [probeFACount, (probeCRCount + probeCRNRCount)]]).dprime(), 3)
+        probeDprimes_NR.append(dayProbeDprime_NR)
+
+        if probeTotalTrials < 10:
+            dayProbeBeta = 'n/a'
+        else:
+            dayProbeBeta = round(
+                Analysis([[probeHitCount, probeMissCount], [probeFACount, probeCRCount]]).bias(),
+                3)
+        probeBetas.append(dayProbeBeta)
+
+        if probeTotalTrials < 10:
+            dayProbeBeta_NR = 'n/a'
+        else:
+            dayProbeBeta_NR = round(Analysis([[probeHitCount, (probeMissCount + probeMissNRCount)],
+                                              [probeFACount, (probeCRCount + probeCRNRCount)]]).bias(), 3)
+        probeBetas_NR.append(dayProbeBeta_NR)
+        # endregion
+
+        if missCount == float(0):
+            missCount = 0.001
+        if missNRCount == float(0):
+            missNRCount = 0.001
+        if FACount == float(0):
+            FACount = 0.001
+
+        sPlus_correct.append(divide_by_zero(hitCount, (hitCount + missCount), 5))
+        sPlus_NR_correct.append(divide_by_zero(hitCount, (hitCount + missCount + missNRCount), 5))
+        sMinus_correct.append(divide_by_zero(CRCount, (CRCount + FACount), 5))
+        sMinus_NR_correct.append(divide_by_zero((CRCount + CRNRCount), (FACount + CRCount + CRNRCount), 5))
+        total_correct.append(divide_by_zero((hitCount + CRCount),
+                                                 (hitCount + CRCount + missCount + FACount), 5))
+        total_NR_correct.append(divide_by_zero((hitCount + CRCount + CRNRCount), totalTrials, 5))
+
+        probePlus_correct.append(divide_by_zero(probeHitCount, (probeHitCount + probeMissCount), 5))
+        probePlus_NR_correct.append(divide_by_zero(probeHitCount,
+                                                        (probeHitCount + probeMissCount + probeMissNRCount), 5))
+        probeMinus_correct.append(divide_by_zero(probeCRCount, (probeCRCount + probeFACount), 5))
+        probeMinus_NR_correct.append(divide_by_zero((probeCRCount + probeCRNRCount),
+                                                         (probeFACount + probeCRCount + probeCRNRCount), 5))
+        total_probe_correct.append(
+            divide_by_zero((probeHitCount + probeCRCount),
+                                (probeHitCount + probeCRCount + probeMissCount + probeFACount), 5))
+        total_probe_NR_correct.append(divide_by_zero((probeHitCount + probeCRCount + probeCRNRCount),
+                                                          probeTotalTrials, 5))
+    # endregion
+
+    # region Add calculated stats to summarized dataframe
+    groupData["d'"] = dprimes
+    groupData["d' (NR)"] = dprimes_NR
+    groupData['Beta'] = betas
+    groupData['Beta (NR)'] = betas_NR
+    groupData['S+ Rate'] = sPlus_correct
+    groupData['S+ (NR) Rate'] = sPlus_NR_correct
+    groupData['S- Rate'] = sMinus_correct
+    groupData['S- (NR) Rate'] = sMinus_NR_correct
+    groupData['Total Corr'] = total_correct
+    groupData['Total Corr (NR)'] = total_NR_correct
+    groupData["Probe d'"] = probeDprimes
+    groupData["Probe d' (NR)"] = probeDprimes_NR
+    groupData['Probe Beta'] = probeBetas
+    groupData['Probe Beta (NR)'] = probeBetas_NR
+    groupData['Probe S+ Rate'] = probePlus_correct
+    groupData['Probe S+ (NR) Rate'] = probePlus_NR_correct
+    groupData['Probe S- Rate'] = probeMinus_correct
+    groupData['Probe S- (NR) Rate'] = probeMinus_NR_correct
+    groupData['Probe Tot Corr'] = total_probe_correct
+    groupData['Probe Tot Corr (NR)'] = total_probe_NR_correct
+    groupData['Prop CR Resets'] = resetRatio
+
+    # endregion
+
+    return groupData
+
+
+def classify_response(response=None, trial_class=None):
+    # Preset so the variables don't arrive to the return section with no value
+
+    trial_type = None
+
+    if response == 'ERR':
+        pass
+    elif trial_class == 'probePlus':
+        if response == 'sPlus':
+            trial_type = 'probe_hit'
+        elif response == 'sMinus':
+            trial_type = 'probe_Miss'
+        else:
+            # No response
+            trial_type = 'probe_Miss_NR'
+
+    elif trial_class == 'probeMinus':
+        if response == 'sPlus':
+            trial_type = 'probe_FA'
+        elif response == 'sMinus':
+            trial_type = 'probe_CR'
+        else:
+            # No response
+            trial_type = 'probe_CR_NR'
+
+    elif trial_class == 'sPlus':
+        if response == 'sPlus':
+            trial_type = 'response_hit'
+        elif response == 'sMinus':
+            trial_type = 'response_Miss'
+        else:
+            # No response
+            trial_type = 'response_Miss_NR'
+
+    elif trial_class == 'sMinus':
+        if response == 'sPlus':
+            trial_type = 'response_FA'
+        elif response == 'sMinus':
+            trial_type = 'response_CR'
+        else:
+            # No response
+            trial_type = 'response_CR_NR'
+
+    return trial_type
+
+
+# Count columns incremented by each response type (see classify_response)
+RESPONSE_COUNT_COLUMNS = {
+    'response_hit': ['Trials', 'Hit', 'S+ Trials', 'S+ (NR) Trials'],
+    'response_Miss': ['Trials', 'Miss', 'S+ Trials', 'S+ (NR) Trials'],
+    'response_Miss_NR': ['Trials', 'Miss (NR)', 'S+ (NR) Trials'],
+    'response_FA': ['Trials', 'FA', 'S- Trials', 'S- (NR) Trials'],
+    'response_CR': ['Trials', 'CR', 'S- Trials', 'S- (NR) Trials'],
+    'response_CR_NR': ['Trials', 'CR (NR)', 'S- (NR) Trials'],
+    'probe_hit': ['Probe Trials', 'Probe Hit', 'Probe S+ Trials', 'Probe S+ (NR) Trials'],
+    'probe_Miss': ['Probe Trials', 'Probe Miss', 'Probe S+ Trials', 'Probe S+ (NR) Trials'],
+    'probe_Miss_NR': ['Probe Trials', 'Probe Miss (NR)', 'Probe S+ (NR) Trials'],
+    'probe_FA': ['Probe Trials', 'Probe FA', 'Probe S- Trials', 'Probe S- (NR) Trials'],
+    'probe_CR': ['Probe Trials', 'Probe CR', 'Probe S- Trials', 'Probe S- (NR) Trials'],
+    'probe_CR_NR': ['Probe Trials', 'Probe CR (NR)', 'Probe S- (NR) Trials'],
+}
+COUNT_COLUMNS = ['Trials', 'Hit', 'Miss', 'Miss (NR)', 'FA', 'CR', 'CR (NR)', 'S+ Trials', 'S+ (NR) Trials',
+                 'S- Trials', 'S- (NR) Trials', 'Probe Trials', 'Probe Hit', 'Probe Miss', 'Probe Miss (NR)',
+                 'Probe FA', 'Probe CR', 'Probe CR (NR)', 'Probe S+ Trials', 'Probe S+ (NR) Trials',
+                 'Probe S- Trials', 'Probe S- (NR) Trials']
+
+
+def check_criteria(trialdata, criteria=None, verbose=False, log=None):
+    # parse criteria for: number of days prior to check, which block, dprime threshold, etc
+    # returns True if criteria met on all days, otherwise False
+    # trialdata = dataframe of summarized, filtered, analyzed data to check
+    # criteria = dict of criteria settings
+    # log = logger for debug messages (defaults to module logger)
+    # Start with assumption that each day is True, then reject if any criteria are not met
+    if log is None:
+        log = logging.getLogger(__name__)
+    if not isinstance(trialdata, pd.DataFrame):
+        return 'Error: not dataframe'
+    if criteria is None:
+        return False
+
+    rowcount = len(trialdata.index)
+    criteria_result = [True] * rowcount  # List of whether each row meets criteria
+    i = 0
+
+    if 'NR' in criteria:
+        use_NR = criteria['NR']
+    else:
+        use_NR = True
+
+    for index, row in trialdata.iterrows():
+        if criteria_result[i] is not False:  # skip next check if already failed previous criteria
+            if 'trialcount' in criteria:  # minimum trial count of specific trial type or overall
+                if 'mintrials' in criteria['trialcount']:
+                    trialThreshold = criteria['trialcount']['mintrials']
+                    if 'type' in criteria['trialcount']:
+                        ntrials = row[criteria['trialcount']['type']]
+                    elif use_NR:
+                        ntrials = row['Trials']  # if type not specified, just compare to total trialcount
+                    else:
+                        ntrials = row['Trials']  # if type not specified, just compare to total trialcount
+
+                    if ntrials < trialThreshold:
+                        criteria_result[i] = False
+
+                        message = 'Record {:d} does not meet trial count criteria ({:d} trials vs {:d} minimum)' \
+                            .format(i, ntrials, trialThreshold)
+                        if verbose:
+                            print message
+                        log.debug(message)
+
+        if criteria_result[i] is not False:  # skip next check if already failed previous criteria
+            if 'dprime' in criteria:
+                if use_NR:
+                    dprime_actual = row["d' (NR)"]
+                    dprime_min = criteria["d' (NR)"]
+                else:
+                    dprime_actual = row["d'"]
+                    dprime_min = criteria["d'"]
+
+                if dprime_actual < dprime_min:
+                    criteria_result[i] = False
+
+                    message = "Record {:d} failed d' criteria ({:0.3f} actual vs {:0.3f} minimum)" \
+                        .format(i, dprime_actual, dprime_min)
+                    if verbose:
+                        print message
+                    log.debug(message)
+
+        if criteria_result[i] is not False:  # skip next check if already failed previous criteria
+            if 'propCorrect' in criteria:
+                for category in criteria['propCorrect']:
+                    if 'type' in category:
+                        proportion = row[category['type']]
+                        stim_type = category['type']
+                    elif use_NR:
+                        proportion = row['Total Corr (NR)']
+                        stim_type = 'Total_NR'
+                    else:
+                        proportion = row['Total Corr']
+                        stim_type = 'Total'
+
+                    if proportion < category['minimum']:
+                        criteria_result[i] = False
+
+                        message = "Category {} failed proportion correct criteria ({:0.3f} actual vs {:0.3f} " \
+                                  "minimum)".format(stim_type, proportion, category['minimum'])
+                        if verbose:
+                            print message
+                        log.debug(message)
+
+        i += 1
+
+    if 'days' in criteria:  # criteria not met on at least 'days' days
+        num_days = sum(criteria_result)
+        min_days = criteria['days']
+    else:  # otherwise if ANY days don't meet criteria,
+        num_days = sum(criteria_result)
+        min_days = len(criteria_result)
+        # return false
+    if num_days < min_days:
+        message = "Not enough days meeting criteria ({:d} days, {:d} min)".format(num_days, min_days)
+        if verbose:
+            print message
+        log.debug(message)
+        return False
+
+    # Otherwise, return true
+
+    message = "Meets all criteria!"
+    if verbose:
+        print message
+    log.debug(message)
+    return True
+
+
+# Stimulus naming rules, tried in order until one matches. Each rule has a regex 'pattern' (searched in the stimulus
+# file name) whose named groups 'tempo' and 'family' give those attributes, plus optional 'tempo_divisor' (tempo is the
+# matched number divided by this, default 1) and 'shaping' (stimulus is a shaping stimulus, with no tempo)
+DEFAULT_STIMULUS_NAMING = [
+    # shaping stimuli (which contain 'song' in the name) are categorized separately (they don't have a tempo)
+    {'pattern': r'song\.wav$', 'shaping': True},
+    # e.g. b1i1_1140ir1.wav: tempo is given in tenths of bpm
+    {'pattern': r'^(?P<family>.{4})_(?P<tempo>\d{4})', 'tempo_divisor': 10},
+    # Old stim name format only had tempo as three-digit number
+    {'pattern': r'^(?P<family>.{4})_(?P<tempo>\d{3})'},
+]
+
+
+class StimulusCatalog(object):
+    """Parses stimulus file names into stimulus attributes (tempo, family, shaping). Each distinct name is only parsed
+    once, however many trials use it
+
+    Keyword arguments:
+    naming -- (optional) list of naming rules (see DEFAULT_STIMULUS_NAMING) to try before the default rules. More can
+        be added with add_naming(); experiments record theirs as 'stim_naming' in the settings file
+
+    Methods:
+    add_naming(naming) -- add naming rules, tried before the default rules
+    attributes(stim_name) -- returns dict of 'tempo', 'family' and 'shaping' for one stimulus name
+    table(stim_names) -- returns dataframe of the attributes of each name, indexed by name
+    """
+
+    def __init__(self, naming=None):
+        self.log = logging.getLogger(__name__)
+        self.rules = []
+        self._rule_keys = set()
+        self._attributes = {}
+        for rule in DEFAULT_STIMULUS_NAMING:
+            self._add_rule(rule, len(self.rules))
+        self.add_naming(naming)
+
+    def _add_rule(self, rule, position):
+        ruleKey = json.dumps(rule, sort_keys=True)
+        if ruleKey in self._rule_keys:
+            return
+        self._rule_keys.add(ruleKey)
+        self.rules.insert(position, (re.compile(rule['pattern']), float(rule.get('tempo_divisor', 1)),
+                                     bool(rule.get('shaping', False))))
+        self._attributes = {}  # names may parse differently now
+
+    def add_naming(self, naming):
+        if not naming:
+            return
+        # added rules go after any previously added ones, but before the defaults
+        position = len(self.rules) - len(DEFAULT_STIMULUS_NAMING)
+        for rule in naming:
+            self._add_rule(rule, position)
+            position = len(self.rules) - len(DEFAULT_STIMULUS_NAMING)
+
+    def attributes(self, stim_name):
+        if stim_name not in self._attributes:
+            stimAttributes = {'tempo': None, 'family': None, 'shaping': False}
+            for pattern, tempoDivisor, isShaping in self.rules:
+                match = pattern.search(stim_name)
+                if match is None:
+                    continue
+                groups = match.groupdict()
+                stimAttributes['family'] = groups.get('family')
+                stimAttributes['shaping'] = isShaping
+                if groups.get('tempo') is not None and not isShaping:
+                    stimAttributes['tempo'] = float(groups['tempo']) / tempoDivisor
+                break
+            else:
+                self.log.warning('stimulus name does not match any naming rule: {}'.format(stim_name))
+            self._attributes[stim_name] = stimAttributes
+        return self._attributes[stim_name]
+
+    def table(self, stim_names):
+        return pd.DataFrame([self.attributes(stim_name) for stim_name in stim_names],
+                            index=list(stim_names), columns=['tempo', 'family', 'shaping'])
+
+
 class Analysis:
     """ use this to compute performance metrics """
 
@@ -253,7 +674,7 @@ class FieldList:
         # Item order is resulting sort order
         fieldList = ['Subject', 'File', 'Session', 'File Count', 'Date', 'Time', 'Hour', 'Block', 'Block Number',
                      'Trials', 'S+ Trials', 'S- Trials', 'S+ (NR) Trials', 'S- (NR) Trials', 'Index', 'Stimulus',
-                     'Tempo', 'Trial Type', 'Class', 'Response Type', 'Response', 'RT', 'Reward', 'Punish', 'Timeout']
+                     'Family', 'Tempo', 'Trial Type', 'Class', 'Response Type', 'Response', 'RT', 'Reward', 'Punish', 'Timeout']
 
         fieldList += ["d'", "d' (NR)", u'Beta', u'Beta (NR)', 'S+ Rate', 'S+ (NR) Rate', 'S- Rate', 'S- (NR) Rate',
                       'Total Corr', 'Total Corr (NR)']
@@ -275,7 +696,7 @@ class FieldList:
 
             # Define field filter type
             if columnDict['name'] in ['Subject', 'Block', 'Block Number', 'Response Type', 'Tempo', 'Stimulus',
-                                      'Trial Type', 'Class', 'Response']:
+                                      'Family', 'Trial Type', 'Class', 'Response']:
                 columnDict['filter']['type'] = 'list'
             elif columnDict['name'] in ['Date']:
                 columnDict['filter']['type'] = 'range'
@@ -288,7 +709,7 @@ class FieldList:
                 # sense to group by those fields (e.g., grouping by 'File' for continuous-running birds)
                 columnDict['type'] = 'raw'
             elif columnDict['name'] in ['Subject', 'Block', 'Block Number', 'Date', 'Hour', 'Response Type', 'Stimulus',
-                                        'Tempo', 'Trial Type', 'Class', 'Response']:
+                                        'Family', 'Tempo', 'Trial Type', 'Class', 'Response']:
                 # 'index' columns are those that could be used as an index for grouping
                 columnDict['type'] = 'index'  # groupby enabled
             elif columnDict['name'] in ['RT', 'Timeout']:
@@ -320,8 +741,16 @@ class FieldList:
 class Performance(object):
     # Longer-term performance analysis
 
-    def __init__(self, experiment_folder):
+    def __init__(self, experiment_folder, file_offsets=None, progress=None):
+        # file_offsets -- (optional) dict of trial data file names and byte offsets to start reading each file from,
+        # for reading only trials added since a previous read. After loading, self.file_offsets holds the end offset of
+        # every file that was read
+        # progress -- (optional) function called as progress(files read, total files) while loading trial data. It
+        # can raise AnalysisCancelled to stop loading
         self.log = logging.getLogger(__name__)
+        self.file_offsets = dict(file_offsets) if file_offsets is not None else {}
+        self.progress = progress
+        self.stim_catalog = StimulusCatalog()
 
         # convert experiment_folder to list if single item
         if not isinstance(experiment_folder, list):
@@ -353,7 +782,6 @@ class Performance(object):
                     'Subject': [],
                     'Session': [],
                     'File Count': [],
-                    'Trial Type': [],
                     'Block': [],
                     # 'Block Number': [],
                     'Index': [],
@@ -370,49 +798,7 @@ class Performance(object):
         self.gather_raw_data(dataDict)
 
     def classify_response(self, response=None, trial_class=None):
-        # Preset so the variables don't arrive to the return section with no value
-
-        trial_type = None
-
-        if response == 'ERR':
-            pass
-        elif trial_class == 'probePlus':
-            if response == 'sPlus':
-                trial_type = 'probe_hit'
-            elif response == 'sMinus':
-                trial_type = 'probe_Miss'
-            else:
-                # No response
-                trial_type = 'probe_Miss_NR'
-
-        elif trial_class == 'probeMinus':
-            if response == 'sPlus':
-                trial_type = 'probe_FA'
-            elif response == 'sMinus':
-                trial_type = 'probe_CR'
-            else:
-                # No response
-                trial_type = 'probe_CR_NR'
-
-        elif trial_class == 'sPlus':
-            if response == 'sPlus':
-                trial_type = 'response_hit'
-            elif response == 'sMinus':
-                trial_type = 'response_Miss'
-            else:
-                # No response
-                trial_type = 'response_Miss_NR'
-
-        elif trial_class == 'sMinus':
-            if response == 'sPlus':
-                trial_type = 'response_FA'
-            elif response == 'sMinus':
-                trial_type = 'response_CR'
-            else:
-                # No response
-                trial_type = 'response_CR_NR'
-
-        return trial_type
+        return classify_response(response, trial_class)
 
     def gather_raw_data(self, data_dict):
         # Pull data from across multiple csv files, keeping notation for phase (which comes from the json file)
@@ -440,7 +826,14 @@ class Performance(object):
         data_dict['Probe S- Trials'] = []
         data_dict['Probe S+ (NR) Trials'] = []
         data_dict['Probe S- (NR) Trials'] = []
-        data_dict['Tempo'] = []
+
+        # Trial logs are read straight into dataframes (see read_trial_log), then combined with the csv data
+        logFrames = []
+
+        dirFiles = [os.listdir(curr_dir) for curr_dir in self.data_dir]
+        totalFiles = sum(len(fileList) for fileList in dirFiles)
+        filesRead = 0
+        self.report_progress(filesRead, totalFiles)
 
         # region Read each CSV file
         for dir_index, curr_dir in enumerate(self.data_dir):
@@ -450,22 +843,50 @@ class Performance(object):
             # all subsequent rows was also way too slow
             # - Fastest method was to hardcode column names and indices, which is not ideal (if column order ever
             # changes), but it's WAY faster than the other two approaches
-            csvList = os.listdir(curr_dir)
+            csvList = dirFiles[dir_index]
+            # - Sessions with a typed trial log (triallog.py) are read from the log instead of the csv written
+            # alongside it
+            logStems = set(os.path.splitext(fileName)[0] for fileName in csvList
+                           if os.path.splitext(fileName)[1] == triallog.EXTENSION)
 
             # Add specific response columns to data_dict
             for curr_csv in csvList:
+                self.report_progress(filesRead, totalFiles)
+                filesRead += 1
                 csvPath = os.path.join(curr_dir, curr_csv)
-                with open(csvPath, 'rb') as data_file:
-                    csv_reader = csv.reader(data_file, delimiter=',')
-                    rowCount = len(list(csv_reader)) - 1  # check if csv has data beyond header
-                    if rowCount < 1:
-                        fileEmpty = True
-                    else:
-                        fileEmpty = False
+                fileStem, fileExtension = os.path.splitext(curr_csv)
+                isLog = fileExtension == triallog.EXTENSION
+                if not isLog and fileStem in logStems:
+                    # count the csv as read up to its current size, so callers comparing file_offsets with file sizes
+                    # (e.g. daily_analysis) see it as unchanged
+                    self.file_offsets[curr_csv] = os.path.getsize(csvPath)
+                    continue
 
-                if fileEmpty is False:
-                    # Separated from above to allow data_file to close and be reopened for actual scanning
+                # Files can be read from a byte offset (see file_offsets in __init__), so only trials added since the
+                # last read are imported. Files that haven't grown since then are skipped entirely
+                startOffset = self.file_offsets.get(curr_csv, 0)
+                if startOffset > 0 and os.path.getsize(csvPath) <= startOffset:
+                    self.file_offsets[curr_csv] = startOffset
+                    continue
 
+                if isLog:
+                    trialRecords, endOffset = triallog.read_trial_log(csvPath, startOffset)[1:]
+                    fileEmpty = len(trialRecords) == 0
+                else:
+                    with open(csvPath, 'rb') as data_file:
+                        data_file.seek(startOffset)
+                        csvText = data_file.read()
+                    # only use complete lines, in case a trial is being written right now
+                    csvText = csvText[:csvText.rfind('\n') + 1]
+                    endOffset = startOffset + len(csvText)
+                    csvRows = list(csv.reader(io.BytesIO(csvText), delimiter=','))
+                    if startOffset == 0:
+                        # ignore first line (headers) because we're assuming the order is the same for all files
+                        csvRows = csvRows[1:]
+                    fileEmpty = len(csvRows) < 1  # check if csv has data beyond header
+                self.file_offsets[curr_csv] = endOffset
+
+                if fileEmpty is False:
                     # region Get data from json settings file
                     # get short dict of block names and update old names to match new naming convention
                     jsonFile = os.path.splitext(curr_csv.replace('trialdata', 'settings'))[0] + '.json'
@@ -497,98 +918,88 @@ class Performance(object):
 
                     # Get timeout setting (stored in json file)
                     timeout = jsonData['classes']['sMinus']['punish_value']
+
+                    # Stimulus naming rules for experiments whose stimulus names don't follow the defaults
+                    self.stim_catalog.add_naming(jsonData.get('stim_naming'))
                     # endregion
 
+                    if isLog:
+                        logFrames.append(self.read_trial_log(trialRecords, curr_csv, blocks, timeout))
+                        continue
+
                     # region Actually read csv and pull data
-                    with open(csvPath, 'rb') as data_file:
-                        csv_reader = csv.reader(data_file, delimiter=',')
-                        currentLine = 0  # resets each time so later we can tell how many lines were imported
-                        for row in csv_reader:
-                            if currentLine == 0:
-                                # ignore first line (headers) because we're assuming the order is the same for all files
-                                pass
-                            else:
-                                data_dict['Index'].append(int(row[1]))
-                                data_dict['Class'].append(row[4])
-                                data_dict['Response'].append(row[5])
-
-                                data_dict['RT'].append(float(row[7]) if len(row[7]) > 0 else float('nan'))
-                                data_dict['Reward'].append(1 if row[8] == 'True' else 0)
-                                data_dict['Punish'].append(1 if row[9] == 'True' else 0)
-                                data_dict['Timeout'].append(timeout)
-                                data_dict['Time'].append(row[10])
-                                data_dict['Session'].append(row[0])
-                                data_dict['File'].append(curr_csv)
-
-                                stim_name = re.split('/', row[3])
-                                stim_name = stim_name[-1]
-
-                                data_dict['Stimulus'].append(stim_name)
-                                data_dict['Subject'].append(curr_csv.partition('_')[0])
-                                data_dict['File Count'].append(1)
-
-                                # categorize shaping stimuli (which contain 'song' in the name)separately (they don't
-                                # have a tempo)
-                                if stim_name[-8:] == 'song.wav':
-                                    stim_tempo = 'Shaping'
-                                    trialType = 'Shaping'
-                                else:
-                                    try:
-                                        stim_tempo = float(stim_name[5:9]) / 10
-                                    except ValueError:
-                                        # Old stim name format only had tempo as three-digit number, which is caught
-                                        # by ValueError (since ###_ can't be converted to float)
-                                        stim_tempo = float(stim_name[5:8])
-                                    if row[5] == 'probePlus' or row[5] == 'probeMinus':
-                                        trialType = 'Probe'
-                                    else:
-                                        trialType = 'Training'
-
-                                data_dict['Trial Type'].append(trialType)
-                                data_dict['Tempo'].append(stim_tempo)
-
-                                # block number in data file is indexed from 1
-                                data_dict['Block'].append(blocks[int(row[0]) - 1])
-
-                                response_type = self.classify_response(row[5], row[4])
-                                data_dict['Response Type'].append(response_type)
-
-                                data_dict['Hit'].append(1 if response_type == 'response_hit' else 0)
-                                data_dict['FA'].append(1 if response_type == 'response_FA' else 0)
-                                data_dict['Miss'].append(1 if response_type == 'response_Miss' else 0)
-                                data_dict['CR'].append(1 if response_type == 'response_CR' else 0)
-                                data_dict['Miss (NR)'].append(1 if response_type == 'response_Miss_NR' else 0)
-                                data_dict['CR (NR)'].append(1 if response_type == 'response_CR_NR' else 0)
-                                data_dict['Trials'].append(1 if response_type[0:4] == 'resp' else 0)
-                                data_dict['Probe Hit'].append(1 if response_type == 'probe_hit' else 0)
-                                data_dict['Probe FA'].append(1 if response_type == 'probe_FA' else 0)
-                                data_dict['Probe Miss'].append(1 if response_type == 'probe_Miss' else 0)
-                                data_dict['Probe CR'].append(1 if response_type == 'probe_CR' else 0)
-                                data_dict['Probe Miss (NR)'].append(1 if response_type == 'probe_Miss_NR' else 0)
-                                data_dict['Probe CR (NR)'].append(1 if response_type == 'probe_CR_NR' else 0)
-                                data_dict['Probe Trials'].append(1 if response_type[0:4] == 'prob' else 0)
-
-                                data_dict['S+ Trials'].append(
-                                    1 if response_type in ['response_hit', 'response_Miss'] else 0)
-                                data_dict['S+ (NR) Trials'].append(
-                                    1 if response_type in ['response_hit', 'response_Miss', 'response_Miss_NR'] else 0)
-                                data_dict['S- Trials'].append(
-                                    1 if response_type in ['response_FA', 'response_CR'] else 0)
-                                data_dict['S- (NR) Trials'].append(
-                                    1 if response_type in ['response_FA', 'response_CR', 'response_CR_NR'] else 0)
-                                data_dict['Probe S+ Trials'].append(
-                                    1 if response_type in ['probe_hit', 'probe_Miss'] else 0)
-                                data_dict['Probe S+ (NR) Trials'].append(
-                                    1 if response_type in ['probe_hit', 'probe_Miss', 'probe_Miss_NR'] else 0)
-                                data_dict['Probe S- Trials'].append(
-                                    1 if response_type in ['probe_FA', 'probe_CR'] else 0)
-                                data_dict['Probe S- (NR) Trials'].append(
-                                    1 if response_type in ['probe_FA', 'probe_CR', 'probe_CR_NR'] else 0)
-
-                            currentLine += 1
+                    for row in csvRows:
+                        data_dict['Index'].append(int(row[1]))
+                        data_dict['Class'].append(row[4])
+                        data_dict['Response'].append(row[5])
+
+                        data_dict['RT'].append(float(row[7]) if len(row[7]) > 0 else float('nan'))
+                        data_dict['Reward'].append(1 if row[8] == 'True' else 0)
+                        data_dict['Punish'].append(1 if row[9] == 'True' else 0)
+                        data_dict['Timeout'].append(timeout)
+                        data_dict['Time'].append(row[10])
+                        data_dict['Session'].append(row[0])
+                        data_dict['File'].append(curr_csv)
+
+                        # full stimulus path for now; names and their attributes are added for all trials at once,
+                        # once per distinct stimulus (see add_stimulus_attributes)
+                        data_dict['Stimulus'].append(row[3])
+                        data_dict['Subject'].append(curr_csv.partition('_')[0])
+                        data_dict['File Count'].append(1)
+
+                        # block number in data file is indexed from 1
+                        data_dict['Block'].append(blocks[int(row[0]) - 1])
+
+                        response_type = self.classify_response(row[5], row[4])
+                        data_dict['Response Type'].append(response_type)
+
+                        data_dict['Hit'].append(1 if response_type == 'response_hit' else 0)
+                        data_dict['FA'].append(1 if response_type == 'response_FA' else 0)
+                        data_dict['Miss'].append(1 if response_type == 'response_Miss' else 0)
+                        data_dict['CR'].append(1 if response_type == 'response_CR' else 0)
+                        data_dict['Miss (NR)'].append(1 if response_type == 'response_Miss_NR' else 0)
+                        data_dict['CR (NR)'].append(1 if response_type == 'response_CR_NR' else 0)
+                        data_dict['Trials'].append(1 if response_type[0:4] == 'resp' else 0)
+                        data_dict['Probe Hit'].append(1 if response_type == 'probe_hit' else 0)
+                        data_dict['Probe FA'].append(1 if response_type == 'probe_FA' else 0)
+                        data_dict['Probe Miss'].append(1 if response_type == 'probe_Miss' else 0)
+                        data_dict['Probe CR'].append(1 if response_type == 'probe_CR' else 0)
+                        data_dict['Probe Miss (NR)'].append(1 if response_type == 'probe_Miss_NR' else 0)
+                        data_dict['Probe CR (NR)'].append(1 if response_type == 'probe_CR_NR' else 0)
+                        data_dict['Probe Trials'].append(1 if response_type[0:4] == 'prob' else 0)
+
+                        data_dict['S+ Trials'].append(
+                            1 if response_type in ['response_hit', 'response_Miss'] else 0)
+                        data_dict['S+ (NR) Trials'].append(
+                            1 if response_type in ['response_hit', 'response_Miss', 'response_Miss_NR'] else 0)
+                        data_dict['S- Trials'].append(
+                            1 if response_type in ['response_FA', 'response_CR'] else 0)
+                        data_dict['S- (NR) Trials'].append(
+                            1 if response_type in ['response_FA', 'response_CR', 'response_CR_NR'] else 0)
+                        data_dict['Probe S+ Trials'].append(
+                            1 if response_type in ['probe_hit', 'probe_Miss'] else 0)
+                        data_dict['Probe S+ (NR) Trials'].append(
+                            1 if response_type in ['probe_hit', 'probe_Miss', 'probe_Miss_NR'] else 0)
+                        data_dict['Probe S- Trials'].append(
+                            1 if response_type in ['probe_FA', 'probe_CR'] else 0)
+                        data_dict['Probe S- (NR) Trials'].append(
+                            1 if response_type in ['probe_FA', 'probe_CR', 'probe_CR_NR'] else 0)
+
                     # endregion
+        self.report_progress(filesRead, totalFiles)
         data_dict = pd.DataFrame.from_dict(data_dict)  # Convert to data frame
 
+        # Create actual datetime value from string
+        data_dict['Time'] = pd.to_datetime(data_dict['Time'], format='%Y-%m-%d %H:%M:%S')
+
+        if len(logFrames) > 0:
+            # leave out the csv frame if it's empty: concatenating it would make every count column float. Its columns
+            # still set the order, as when there are csvs
+            frames = logFrames if data_dict.empty else [data_dict] + logFrames
+            data_dict = pd.concat(frames, ignore_index=True, sort=False).reindex(columns=data_dict.columns)
+
+        self.add_stimulus_attributes(data_dict)
+
         # endregion
 
         # Turn constructed dict into self var
@@ -596,9 +1007,6 @@ class Performance(object):
 
         # region Create indexable fields for groupby functions
 
-        # Create actual datetime value from string
-        self.raw_trial_data['Time'] = pd.to_datetime(self.raw_trial_data['Time'], format='%Y-%m-%d %H:%M:%S')
-
         self.raw_trial_data['Hour'] = pd.DatetimeIndex(self.raw_trial_data['Time']).hour
         self.raw_trial_data['Date'] = self.raw_trial_data['Time'].dt.date
 
@@ -625,13 +1033,71 @@ class Performance(object):
         self.raw_trial_data.set_index(['Subject', 'Date'], inplace=True)  # inplace so change is saved to same variable
         self.raw_trial_data.sort_index(inplace=True)  # inplace so change is saved to same variable
 
+    def report_progress(self, files_read, total_files):
+        # Passes loading progress to the progress callback, if any. The callback may raise AnalysisCancelled
+        if self.progress is not None:
+            self.progress(files_read, total_files)
+
+    def read_trial_log(self, records, file_name, blocks, timeout):
+        # Builds the same columns gather_raw_data reads from a csv, from the records of a typed trial log. Values are
+        # already typed, so everything is done on whole columns; per-value work (stimulus names, response types) is
+        # only done once for each distinct value
+        trialData = pd.DataFrame({'Index': records['index'].astype(int),
+                                  'Session': records['session'].astype(str),  # csv sessions are read as strings
+                                  'Class': records['class_'],
+                                  'Response': records['response'],
+                                  'RT': records['rt'].astype(float),
+                                  'Reward': (records['reward'] == 1).astype(int),
+                                  'Punish': (records['punish'] == 1).astype(int),
+                                  'Time': pd.to_datetime(records['time']),
+                                  })
+        trialCount = len(trialData)
+        trialData['Timeout'] = timeout
+        trialData['File'] = file_name
+        trialData['Subject'] = file_name.partition('_')[0]
+        trialData['File Count'] = 1
+
+        # block number in data file is indexed from 1
+        trialData['Block'] = np.array(blocks, dtype=object)[records['session'] - 1]
+
+        # full stimulus path, as for csv data (see add_stimulus_attributes)
+        trialData['Stimulus'] = records['stimulus']
+
+        pairs, pairCodes = np.unique(np.char.add(np.char.add(records['response'], '|'), records['class_']),
+                                     return_inverse=True)
+        pairTypes = np.array([classify_response(*pair.split('|')) for pair in pairs], dtype=object)
+        responseTypes = pairTypes[pairCodes] if trialCount > 0 else np.array([], dtype=object)
+        trialData['Response Type'] = responseTypes
+
+        for column in COUNT_COLUMNS:
+            columnTypes = [responseType for responseType in RESPONSE_COUNT_COLUMNS
+                           if column in RESPONSE_COUNT_COLUMNS[responseType]]
+            trialData[column] = np.in1d(responseTypes, columnTypes).astype(int)
+
+        return trialData
+
+    def add_stimulus_attributes(self, trial_data):
+        # Replaces the stimulus paths in trial_data with stimulus names (as a categorical column), and adds the
+        # Family, Tempo and Trial Type columns from self.stim_catalog. Paths and names are only parsed once each; the
+        # attributes are then joined onto the trials by category code
+        pathCodes, stimPaths = pd.factorize(trial_data['Stimulus'].values)
+        nameCodes, stimNames = pd.factorize(np.array([re.split('/', stimPath)[-1] for stimPath in stimPaths],
+                                                     dtype=object), sort=True)
+        stimCodes = nameCodes[pathCodes] if len(pathCodes) > 0 else pathCodes
+        trial_data['Stimulus'] = pd.Categorical.from_codes(stimCodes, categories=stimNames)
+
+        stimTable = self.stim_catalog.table(stimNames)
+        isShaping = stimTable['shaping'].values.astype(bool)
+        stimTempos = stimTable['tempo'].values.astype(object)
+        stimTempos[isShaping] = 'Shaping'
+        trial_data['Family'] = stimTable['family'].values[stimCodes]
+        trial_data['Tempo'] = stimTempos[stimCodes]
+
+        isProbe = trial_data['Response'].isin(['probePlus', 'probeMinus']).values
+        trial_data['Trial Type'] = np.where(isShaping[stimCodes], 'Shaping', np.where(isProbe, 'Probe', 'Training'))
+
     def divide_by_zero(self, numerator, denominator, roundto=3):
-        # error catching for ZeroDivisionError so I don't have to catch the exception every single time manually
-        try:
-            result = round(float(numerator) / float(denominator), roundto)
-        except ZeroDivisionError:
-            result = None
-        return result
+        return divide_by_zero(numerator, denominator, roundto)
 
     def filter_data(self, **kwargs):
         # Filter the raw data, like restrict to date range or specific block
@@ -717,13 +1183,14 @@ class Performance(object):
 
             input_data = input_data.reset_index()
             if len(rangeGroup) > 0:
-                tempGroupBy = input_data.groupby(groupFieldList, sort=False)  # get groupBy without the row 'collapse'
+                tempGroupBy = input_data.groupby(groupFieldList, sort=False, observed=True)  # get groupBy without the row 'collapse'
                 # add to the groupBy term: series that gives each row a 'group number', based on dividing its
                 # cumcount() (cumulative row count within group) by the break number
                 groupFieldList.append(np.floor(tempGroupBy.cumcount() / rangeGroup[1]).astype(int))
 
             # create groupby object, then specify desired calculations for each column
-            groupData = input_data.groupby(groupFieldList, sort=False)
+            # observed=True so categorical fields (e.g. Stimulus) only give groups that actually have trials
+            groupData = input_data.groupby(groupFieldList, sort=False, observed=True)
 
             groupHeaders = groupData.obj.columns
             groupingDict = {}
@@ -749,151 +1216,7 @@ class Performance(object):
                 indexNames[rangeColumnIndex] = 'Bin'
                 groupData.index.rename(indexNames, inplace=True)
             # groupData = groupData.sort_values(by='Time')
-            groupCount = len(groupData)
-
-            # region Variable init
-            dprimes = []
-            dprimes_NR = []
-            betas = []
-            betas_NR = []
-            sPlus_correct = []
-            sPlus_NR_correct = []
-            sMinus_correct = []
-            sMinus_NR_correct = []
-            total_correct = []
-            total_NR_correct = []
-            probeDprimes = []
-            probeDprimes_NR = []
-            probeBetas = []
-            probeBetas_NR = []
-            probePlus_correct = []
-            probePlus_NR_correct = []
-            probeMinus_correct = []
-            probeMinus_NR_correct = []
-            total_probe_correct = []
-            total_probe_NR_correct = []
-            resetRatio = []
-            # endregion
-
-            # region Calculate stats for each summary group
-            for k in xrange(groupCount):
-                hitCount = float(groupData['Hit'][k])
-                missCount = float(groupData['Miss'][k])
-                missNRCount = float(groupData['Miss (NR)'][k])
-                FACount = float(groupData['FA'][k])
-                CRCount = float(groupData['CR'][k])
-                CRNRCount = float(groupData['CR (NR)'][k])
-                totalTrials = float(groupData['Trials'][k])
-                probeHitCount = float(groupData['Probe Hit'][k])
-                probeMissCount = float(groupData['Probe Miss'][k])
-                probeMissNRCount = float(groupData['Probe Miss (NR)'][k])
-                probeFACount = float(groupData['Probe FA'][k])
-                probeCRCount = float(groupData['Probe CR'][k])
-                probeCRNRCount = float(groupData['Probe CR (NR)'][k])
-                probeTotalTrials = float(groupData['Probe Trials'][k])
-
-                dayDprime = round(Analysis([[hitCount, missCount], [FACount, CRCount]]).dprime(), 3)
-                dprimes.append(dayDprime)
-
-                # region Training trial stats
-                dayDprime_NR = round(Analysis([[hitCount, (missCount + missNRCount)],
-                                               [FACount, (CRCount + CRNRCount)]]).dprime(), 3)
-                dprimes_NR.append(dayDprime_NR)
-
-                if totalTrials < 10:
-                    dayBeta = 'n/a'
-                else:
-                    dayBeta = round(Analysis([[hitCount, missCount], [FACount, CRCount]]).bias(), 3)
-                betas.append(dayBeta)
-
-                if totalTrials < 10:
-                    dayBeta_NR = 'n/a'
-                else:
-                    dayBeta_NR = round(Analysis([[hitCount, (missCount + missNRCount)],
-                                                 [FACount, (CRCount + CRNRCount)]]).bias(), 3)
-                betas_NR.append(dayBeta_NR)
-
-                resetRatio.append(self.divide_by_zero(CRCount, (CRCount + CRNRCount), 5))
-
-                # endregion
-
-                # region Probe trial stats
-                dayProbeDprime = round(Analysis([[probeHitCount, probeMissCount],
-                                                 [probeFACount, probeCRCount]]).dprime(), 3)
-                probeDprimes.append(dayProbeDprime)
-
-                dayProbeDprime_NR = round(Analysis([[probeHitCount, (probeMissCount + probeMissNRCount)],
-                                                    [probeFACount, (probeCRCount + probeCRNRCount)]]).dprime(), 3)
-                probeDprimes_NR.append(dayProbeDprime_NR)
-
-                if probeTotalTrials < 10:
-                    dayProbeBeta = 'n/a'
-                else:
-                    dayProbeBeta = round(
-                        Analysis([[probeHitCount, probeMissCount], [probeFACount, probeCRCount]]).bias(),
-                        3)
-                probeBetas.append(dayProbeBeta)
-
-                if probeTotalTrials < 10:
-                    dayProbeBeta_NR = 'n/a'
-                else:
-                    dayProbeBeta_NR = round(Analysis([[probeHitCount, (probeMissCount + probeMissNRCount)],
-                                                      [probeFACount, (probeCRCount + probeCRNRCount)]]).bias(), 3)
-                probeBetas_NR.append(dayProbeBeta_NR)
-                # endregion
-
-                if missCount == float(0):
-                    missCount = 0.001
-                if missNRCount == float(0):
-                    missNRCount = 0.001
-                if FACount == float(0):
-                    FACount = 0.001
-
-                sPlus_correct.append(self.divide_by_zero(hitCount, (hitCount + missCount), 5))
-                sPlus_NR_correct.append(self.divide_by_zero(hitCount, (hitCount + missCount + missNRCount), 5))
-                sMinus_correct.append(self.divide_by_zero(CRCount, (CRCount + FACount), 5))
-                sMinus_NR_correct.append(self.divide_by_zero((CRCount + CRNRCount), (FACount + CRCount + CRNRCount), 5))
-                total_correct.append(self.divide_by_zero((hitCount + CRCount),
-                                                         (hitCount + CRCount + missCount + FACount), 5))
-                total_NR_correct.append(self.divide_by_zero((hitCount + CRCount + CRNRCount), totalTrials, 5))
-
-                probePlus_correct.append(self.divide_by_zero(probeHitCount, (probeHitCount + probeMissCount), 5))
-                probePlus_NR_correct.append(self.divide_by_zero(probeHitCount,
-                                                                (probeHitCount + probeMissCount + probeMissNRCount), 5))
-                probeMinus_correct.append(self.divide_by_zero(probeCRCount, (probeCRCount + probeFACount), 5))
-                probeMinus_NR_correct.append(self.divide_by_zero((probeCRCount + probeCRNRCount),
-                                                                 (probeFACount + probeCRCount + probeCRNRCount), 5))
-                total_probe_correct.append(
-                    self.divide_by_zero((probeHitCount + probeCRCount),
-                                        (probeHitCount + probeCRCount + probeMissCount + probeFACount), 5))
-                total_probe_NR_correct.append(self.divide_by_zero((probeHitCount + probeCRCount + probeCRNRCount),
-                                                                  probeTotalTrials, 5))
-            # endregion
-
-            # region Add calculated stats to summarized dataframe
-            groupData["d'"] = dprimes
-            groupData["d' (NR)"] = dprimes_NR
-            groupData['Beta'] = betas
-            groupData['Beta (NR)'] = betas_NR
-            groupData['S+ Rate'] = sPlus_correct
-            groupData['S+ (NR) Rate'] = sPlus_NR_correct
-            groupData['S- Rate'] = sMinus_correct
-            groupData['S- (NR) Rate'] = sMinus_NR_correct
-            groupData['Total Corr'] = total_correct
-            groupData['Total Corr (NR)'] = total_NR_correct
-            groupData["Probe d'"] = probeDprimes
-            groupData["Probe d' (NR)"] = probeDprimes_NR
-            groupData['Probe Beta'] = probeBetas
-            groupData['Probe Beta (NR)'] = probeBetas_NR
-            groupData['Probe S+ Rate'] = probePlus_correct
-            groupData['Probe S+ (NR) Rate'] = probePlus_NR_correct
-            groupData['Probe S- Rate'] = probeMinus_correct
-            groupData['Probe S- (NR) Rate'] = probeMinus_NR_correct
-            groupData['Probe Tot Corr'] = total_probe_correct
-            groupData['Probe Tot Corr (NR)'] = total_probe_NR_correct
-            groupData['Prop CR Resets'] = resetRatio
-
-            # endregion
+            groupData = group_stats(groupData)
 
             # if len(rangeGroup) > 0:
             #     groupData.index[''].drop()
@@ -903,11 +1226,19 @@ class Performance(object):
             # groupData = groupData.drop(['Date'], axis=1)
             groupData.reset_index()
 
+        return self.select_columns(groupData, kwargs.get('dropCols'))
+
+    def select_columns(self, group_data, drop_cols=None):
+        # Returns group_data with dropped columns removed and remaining columns put in FieldList order
+        # Kept separate from analyze() so changing column visibility doesn't require regrouping the data
+
+        groupData = group_data
+
         # Get list of columns to remove
         dropColumns = []
 
-        if 'dropCols' in kwargs and len(kwargs['dropCols']) > 0:
-            dropColumns += kwargs['dropCols']
+        if drop_cols is not None and len(drop_cols) > 0:
+            dropColumns += drop_cols
 
         # Set column order
 
@@ -934,109 +1265,162 @@ class Performance(object):
         pass
 
     def check_criteria(self, trialdata, criteria=None, verbose=False):
-        # parse criteria for: number of days prior to check, which block, dprime threshold, etc
-        # returns True if criteria met on all days, otherwise False
-        # trialdata = dataframe of summarized, filtered, analyzed data to check
-        # criteria = dict of criteria settings
-        # Start with assumption that each day is True, then reject if any criteria are not met
-        if not isinstance(trialdata, pd.DataFrame):
-            return 'Error: not dataframe'
-        if criteria is None:
-            return False
+        return check_criteria(trialdata, criteria, verbose, self.log)
+
+
+def _freeze(value):
+    # Convert nested filter/grouping parameters (dicts and lists) to hashable tuples so they can be used as cache keys
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    else:
+        return value
 
-        rowcount = len(trialdata.index)
-        criteria_result = [True] * rowcount  # List of whether each row meets criteria
-        i = 0
 
-        if 'NR' in criteria:
-            use_NR = criteria['NR']
+class AnalysisSession(object):
+    """
+    Holds trial data for one or more birds in memory so repeated analyses don't reread every csv file
+
+    Results of filter_data/summarize/analyze are memoized by (filters, grouping fields, bin size). Column selection is
+    applied to the cached result, so toggling column visibility or returning to a previous view doesn't recalculate
+    anything. Frames returned by analyze() are shared with the cache and shouldn't be modified in place.
+
+    Keyword arguments:
+    experiment_folder -- folder or list of folders, as passed to Performance
+    cache_size -- number of analysis results to keep (least recently used results are discarded first)
+    progress -- (optional) progress callback while loading trial data, as for Performance
+    """
+
+    def __init__(self, experiment_folder, cache_size=32, progress=None):
+        self.log = logging.getLogger(__name__)
+        self.experiment_folder = experiment_folder
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+        self.performance = Performance(experiment_folder, progress=progress)
+        self.raw_trial_data = self.performance.raw_trial_data
+
+    def analyze(self, filters=None, groupBy=None, dropCols=None):
+        if filters is None:
+            filters = {}
+        if groupBy is None:
+            groupBy = []
+
+        # Bin size is part of groupBy (as [field, size]), so it's included in the key
+        key = (_freeze(filters), _freeze(groupBy))
+        if key in self._cache:
+            groupData = self._cache.pop(key)  # popped and reinserted below to mark as most recently used
         else:
-            use_NR = True
-
-        for index, row in trialdata.iterrows():
-            if criteria_result[i] is not False:  # skip next check if already failed previous criteria
-                if 'trialcount' in criteria:  # minimum trial count of specific trial type or overall
-                    if 'mintrials' in criteria['trialcount']:
-                        trialThreshold = criteria['trialcount']['mintrials']
-                        if 'type' in criteria['trialcount']:
-                            ntrials = row[criteria['trialcount']['type']]
-                        elif use_NR:
-                            ntrials = row['Trials']  # if type not specified, just compare to total trialcount
-                        else:
-                            ntrials = row['Trials']  # if type not specified, just compare to total trialcount
-
-                        if ntrials < trialThreshold:
-                            criteria_result[i] = False
-
-                            message = 'Record {:d} does not meet trial count criteria ({:d} trials vs {:d} minimum)' \
-                                .format(i, ntrials, trialThreshold)
-                            if verbose:
-                                print message
-                            self.log.debug(message)
-
-            if criteria_result[i] is not False:  # skip next check if already failed previous criteria
-                if 'dprime' in criteria:
-                    if use_NR:
-                        dprime_actual = row["d' (NR)"]
-                        dprime_min = criteria["d' (NR)"]
-                    else:
-                        dprime_actual = row["d'"]
-                        dprime_min = criteria["d'"]
+            self.performance.filter_data(filters=filters)
+            self.performance.summarize('filt')
+            # analyze() pops range groups out of the groupBy list, so give it a copy
+            groupData = self.performance.analyze(self.performance.summaryData, groupBy=copy.deepcopy(groupBy))
+        self._cache[key] = groupData
 
-                    if dprime_actual < dprime_min:
-                        criteria_result[i] = False
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
 
-                        message = "Record {:d} failed d' criteria ({:d} actual vs {:d} minimum)" \
-                            .format(i, dprime_actual, dprime_min)
-                        if verbose:
-                            print message
-                        self.log.debug(message)
-
-            if criteria_result[i] is not False:  # skip next check if already failed previous criteria
-                if 'propCorrect' in criteria:
-                    for category in criteria['propCorrect']:
-                        if 'type' in category:
-                            proportion = row[category['type']]
-                            stim_type = category['type']
-                        elif use_NR:
-                            proportion = row['Total Corr (NR)']
-                            stim_type = 'Total_NR'
-                        else:
-                            proportion = row['Total Corr']
-                            stim_type = 'Total'
-
-                        if proportion < category['minimum']:
-                            criteria_result[i] = False
-
-                            message = "Category {} failed proportion correct criteria ({:0.3f} actual vs {:0.3f} " \
-                                      "minimum)".format(stim_type, proportion, category['minimum'])
-                            if verbose:
-                                print message
-                            self.log.debug(message)
-
-            i += 1
-
-        if 'days' in criteria:  # criteria not met on at least 'days' days
-            num_days = sum(criteria_result)
-            min_days = criteria['days']
-        else:  # otherwise if ANY days don't meet criteria,
-            num_days = sum(criteria_result)
-            min_days = len(criteria_result)
-            # return false
-        if num_days < min_days:
-            message = "Not enough days meeting criteria ({:d} days, {:d} min)".format(num_days, min_days)
-            if verbose:
-                print message
-            self.log.debug(message)
-            return False
+        return self.performance.select_columns(groupData, dropCols)
 
-        # Otherwise, return true
+    def clear(self):
+        self._cache.clear()
 
-        message = "Meets all criteria!"
-        if verbose:
-            print message
-        self.log.debug(message)
-        return True
+
+class CriteriaTracker(object):
+    """
+    Keeps running per-day, per-block response counts for a subject so block criteria can be checked without rereading
+    the subject's whole trial history
+
+    Counts are updated as each trial is saved and written to <experiment_path>/<subject>_criteria.json (not in
+    trialdata, because Performance reads every file in that folder as trial data). If the file doesn't exist yet,
+    counts are rebuilt once from the existing trial data.
+
+    Keyword arguments:
+    experiment_path -- subject's experiment folder (the one containing trialdata and settings_files)
+    subject -- subject name
+    max_days -- days of counts to keep, older days are discarded when the file is saved
+
+    Methods:
+    update(trial) -- add a saved trial to the counts
+    check_criteria(block_name, criteria) -- check criteria for the block against each day in the window
+    """
+
+    def __init__(self, experiment_path, subject, max_days=90):
+        self.log = logging.getLogger(__name__)
+        self.experiment_path = experiment_path
+        self.subject = subject
+        self.max_days = max_days
+        self.filename = os.path.join(experiment_path, subject + '_criteria.json')
+
+        # {date string: {block name: {count column: count}}}
+        self.days = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                self.days = json.load(f)['days']
+        else:
+            self.rebuild()
+
+    def rebuild(self):
+        # Build counts from existing trial data, only needed the first time a subject is tracked
+        self.days = {}
+        if os.path.exists(os.path.join(self.experiment_path, 'trialdata')):
+            try:
+                trialdata = Performance(self.experiment_path).raw_trial_data.reset_index()
+            except Exception:
+                self.log.error('could not rebuild criteria counts for %s: %s' % (self.subject, traceback.format_exc()))
+                trialdata = None
+            if trialdata is not None and len(trialdata) > 0:
+                counts = trialdata.groupby(['Date', 'Block'])[COUNT_COLUMNS].sum()
+                for (date, block), row in counts.iterrows():
+                    dayCounts = self.days.setdefault(str(pd.Timestamp(date).date()), {})
+                    dayCounts[block] = dict((column, int(row[column])) for column in COUNT_COLUMNS)
+        self.save()
+
+    def update(self, trial):
+        response_type = classify_response(trial.response, trial.class_)
+        if response_type is None:
+            return  # error trials aren't counted, same as Performance
+
+        date = str(trial.time.date())
+        blockCounts = self.days.setdefault(date, {}).setdefault(trial.block, {})
+        for column in RESPONSE_COUNT_COLUMNS[response_type]:
+            blockCounts[column] = blockCounts.get(column, 0) + 1
+        self.save()
+
+    def save(self):
+        if len(self.days) > self.max_days:
+            for date in sorted(self.days)[:-self.max_days]:
+                del self.days[date]
+
+        # write to temp file then rename, so a crash mid-write can't leave a truncated file
+        tempFile = self.filename + '.tmp'
+        with open(tempFile, 'wb') as f:
+            json.dump({'subject': self.subject, 'days': self.days}, f, sort_keys=True)
+        os.rename(tempFile, self.filename)
+
+    def day_counts(self, block_name, days=5, now=None):
+        # Returns dataframe of counts with one row per day (within the last 'days' days) that has trials in block_name
+        if now is None:
+            now = dt.datetime.now()
+        firstDate = str((now - dt.timedelta(days=days)).date())
+
+        rows = []
+        for date in sorted(self.days):
+            if date >= firstDate and block_name in self.days[date]:
+                row = dict((column, 0) for column in COUNT_COLUMNS)
+                row.update(self.days[date][block_name])
+                row['Date'] = date
+                rows.append(row)
+        return pd.DataFrame(rows, columns=['Date'] + COUNT_COLUMNS)
+
+    def check_criteria(self, block_name, criteria, days=5, now=None, verbose=False):
+        # Same rules as check_criteria(), with each day in the window (for the given block only) as a record
+        dayData = self.day_counts(block_name, days, now)
+        if len(dayData) == 0:
+            self.log.debug('No trials for {} in the last {} days'.format(block_name, days))
+            return False
+        return check_criteria(group_stats(dayData), criteria, verbose, self.log)
 
 # datapath = '/home/rouse/bird/data/y18r8'
 # perform = Performance(datapath).gather_raw_data()
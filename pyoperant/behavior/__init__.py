@@ -1,3 +1,7 @@
-# from two_alt_choice import *
-from .go_nogo_interrupt import *
-# from lights import *
+# Protocols that can be run with scripts/behave, and the module each is defined in. Protocol modules are only imported
+# when their protocol is run, so listing protocols (or importing pyoperant.behavior.base) doesn't import them all.
+PROTOCOLS = {
+    'GoNoGoInterruptExp': 'pyoperant.behavior.go_nogo_interrupt',
+    # 'TwoAltChoiceExp': 'pyoperant.behavior.two_alt_choice',
+    # 'Lights': 'pyoperant.behavior.lights',
+}
@@ -2,7 +2,7 @@ import logging, traceback
 import os, sys, socket
 import datetime as dt
 import atexit
-from pyoperant import utils, components, local, hwio
+from pyoperant import utils, components, local, hwio, status
 from pyoperant import ComponentError, InterfaceError
 from pyoperant.behavior import shape
 
@@ -71,6 +71,16 @@ class BaseExp(object):
             self.parameters['stim_path'] = stim_path
         self.parameters['subject'] = subject
 
+        # live status for the GUI and any other listeners (see status.py). Set up before logging so errors are sent
+        self.status = status.StatusPublisher(subject, self.parameters.get('panel_name', ''))
+        if self.parameters.get('state_history'):
+            # time spent in each state of every state machine, sent with the heartbeat
+            self.state_stats = utils.StateStats(history=self.parameters['state_history'])
+            self.state_stats.install()
+        else:
+            self.state_stats = None
+        self.heartbeat = status.Heartbeat(self.status, state_stats=self.state_stats)  # started by run()
+
         # configure logging
         self.parameters['log_handlers'] = log_handlers
         self.log_config()
@@ -121,6 +131,10 @@ class BaseExp(object):
 
         self.log.addHandler(errorHandler)
 
+        statusHandler = status.StatusHandler(self.status)
+        statusHandler.setFormatter(logging.Formatter('"%(asctime)s",\n%(message)s'))
+        self.log.addHandler(statusHandler)
+
         if 'email' in self.parameters['log_handlers']:
             from pyoperant.local import SMTP_CONFIG
             from logging import handlers
@@ -167,12 +181,16 @@ class BaseExp(object):
         self.save()
         self.init_summary()
 
+        self.status.publish_ready()  # startup handshake for the GUI
+        self.heartbeat.start()
+
         self.log.info('%s: running %s with parameters in %s' % (self.name,
                                                                 self.__class__.__name__,
                                                                 self.snapshot_f,
                                                                 )
                       )
         if self.parameters['shape']:
+            self.heartbeat.poll('shaping', within=None)
             self.shaper.run_shape()
 
         while True:  # is this while necessary?
@@ -191,6 +209,7 @@ class BaseExp(object):
         else:
             self.panel_reset()
             self.log.debug('idling...')
+            self.heartbeat.poll('idle', within=self.parameters['idle_poll_interval'])
             utils.wait(self.parameters['idle_poll_interval'])
             return 'idle'
 
@@ -203,6 +222,7 @@ class BaseExp(object):
         """ reset expal parameters for the next day """
         self.log.debug('sleeping...')
         self.panel.house_light.off()
+        self.heartbeat.poll('sleep', within=self.parameters['idle_poll_interval'])
         utils.wait(self.parameters['idle_poll_interval'])
         if not self.check_light_schedule():
             return 'main'
@@ -245,12 +265,16 @@ class BaseExp(object):
         return None
 
     def _run_session(self):
+        self.heartbeat.session(True)
+        # protocols that poll during a session set their own deadlines; until then, don't leave the idle one standing
+        self.heartbeat.poll('session', within=None)
         utils.run_state_machine(start_in='pre',
                                 error_state='post',
                                 error_callback=self.log_error_callback,
                                 pre=self.session_pre,
                                 main=self.session_main,
                                 post=self.session_post)
+        self.heartbeat.session(False)
         return 'idle'
 
     def init_summary(self):
@@ -271,16 +295,18 @@ class BaseExp(object):
     def write_summary(self):
         """ takes in a summary dictionary and options and writes to the bird's summaryDAT"""
         summary_file = os.path.join(self.parameters['experiment_path'], self.parameters['subject'] + '.summaryDAT')
+        summary = "Trials this session: %s\n" % self.summary['trials']
+        summary += "Rf'd responses: %i\n" % self.summary['feeds']
+        summary += "\n"
+        summary += "\tS+\tS-\n"
+        summary += "RespSw\t%i\t%i\n" % (self.summary['correct_responses'], self.summary['false_alarms'])
+        summary += "TrlSw\t%i\t%i\n" % (self.summary['misses'], self.summary['correct_rejections'])
+        summary += "d': %1.2f\n" % self.summary['dprime']
+        # summary += "Feeder ops today: %i\n" % self.summary['feeds']
+        summary += "\nLast trial @: %s" % self.summary['last_trial_time']
         with open(summary_file, 'wb') as f:
-            f.write("Trials this session: %s\n" % self.summary['trials'])
-            f.write("Rf'd responses: %i\n" % self.summary['feeds'])
-            f.write("\n")
-            f.write("\tS+\tS-\n")
-            f.write("RespSw\t%i\t%i\n" % (self.summary['correct_responses'], self.summary['false_alarms']))
-            f.write("TrlSw\t%i\t%i\n" % (self.summary['misses'], self.summary['correct_rejections']))
-            f.write("d': %1.2f\n" % self.summary['dprime'])
-            # f.write("Feeder ops today: %i\n" % self.summary['feeds'])
-            f.write("\nLast trial @: %s" % self.summary['last_trial_time'])
+            f.write(summary)
+        self.status.publish({'message': summary})
 
     def write_summary_shaping(self):
         """ takes in a summary dictionary and options and writes to the bird's summaryDAT"""
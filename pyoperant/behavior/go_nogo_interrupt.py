@@ -2,11 +2,12 @@
 # -*- coding: utf-8 -*-
 import os
 import csv
+import logging
 import copy
 import datetime as dt
 from pyoperant.behavior import base, shape, adlib
 from pyoperant.errors import EndSession, EndBlock, InterfaceError, ArduinoException
-from pyoperant import utils, reinf, queues, analysis
+from pyoperant import utils, reinf, queues, analysis, triallog
 
 # from collections import OrderedDict  # If we want to export json in some sort of ordered way
 
@@ -65,6 +66,9 @@ class GoNoGoInterruptExp(base.BaseExp):
                 with open(stim_file, 'rb') as stim_list:
                     stimuli = json.load(stim_list)
                     self.parameters['stims'] = stimuli['stims']
+                    # naming rules for analysis (see analysis.StimulusCatalog), saved with the settings file
+                    if 'naming' in stimuli:
+                        self.parameters['stim_naming'] = stimuli['naming']
 
         # # assign stim files full names
         for name, filename in self.parameters['stims'].items():
@@ -109,6 +113,23 @@ class GoNoGoInterruptExp(base.BaseExp):
         self.data_csv = os.path.join(data_dir, self.parameters['subject'] + '_trialdata_' + self.timestamp + '.csv')
         self.make_data_csv()
 
+        # number of upcoming trials to prepare in the background (see queues.PrefetchQueue)
+        if 'prefetch_trials' not in self.parameters:
+            self.parameters['prefetch_trials'] = 2
+
+        # optional typed binary log written alongside the csv (see triallog.py), which analysis reads instead
+        if 'binary_trial_log' not in self.parameters:
+            self.parameters['binary_trial_log'] = False
+        if self.parameters['binary_trial_log']:
+            self.trial_log = triallog.TrialLog(os.path.splitext(self.data_csv)[0] + triallog.EXTENSION,
+                                               self.fields_to_save)
+        else:
+            self.trial_log = None
+
+        # running per-day counts for checking block criteria (see check_performance)
+        self.criteria_tracker = analysis.CriteriaTracker(self.parameters['experiment_path'],
+                                                         self.parameters['subject'])
+
         if 'block_design' not in self.parameters:
             self.parameters['block_design'] = {
                 'blocks': {
@@ -152,6 +173,7 @@ class GoNoGoInterruptExp(base.BaseExp):
         device_name = self.panel.interfaces['arduino'].device_name
         # device = self.panel.interfaces['arduino'].device
         self.log.info('Serial device %s not responding, reconnecting' % device_name)
+        self.heartbeat.set_interface('reconnecting')
         self.panel.interfaces['arduino'].device.close()
         try:
             self.panel.interfaces['arduino'].device.open()
@@ -161,7 +183,9 @@ class GoNoGoInterruptExp(base.BaseExp):
                 utils.wait(0.5)
                 self.panel.interfaces['arduino'].device.open()
             except (InterfaceError, ArduinoException):
+                self.heartbeat.set_interface('error')
                 raise InterfaceError('Could not open serial device %s' % device_name)
+        self.heartbeat.set_interface('ok')
 
         # self.log.debug("Waiting for device to open")
         # device.readline()
@@ -236,6 +260,8 @@ class GoNoGoInterruptExp(base.BaseExp):
         self.save()
         if self.session_q is None:  # Skip summary overwriting if resuming session
             self.init_summary()
+        self.status.publish_ready()  # startup handshake for the GUI
+        self.heartbeat.start()
 
         self.log.info('%s: running %s with parameters in %s' % (self.name,
                                                                 self.__class__.__name__,
@@ -243,6 +269,7 @@ class GoNoGoInterruptExp(base.BaseExp):
                                                                 )
                       )
         if self.parameters['shape']:
+            self.heartbeat.poll('shaping', within=None)
             self.shaper.run_shape()
 
         while True:  # is this while necessary?
@@ -268,10 +295,12 @@ class GoNoGoInterruptExp(base.BaseExp):
         else:
             self.panel_reset()
             self.log.debug('idling...')
+            self.heartbeat.poll('idle', within=self.parameters['idle_poll_interval'])
             utils.wait(self.parameters['idle_poll_interval'])
             return 'idle'
 
     def _run_dayoff(self):
+        self.heartbeat.poll('dayoff', within=None)
         self.shaperAdLib.run_adlib()
         return 'idle'
 
@@ -309,12 +338,14 @@ class GoNoGoInterruptExp(base.BaseExp):
         summary_file = os.path.join(self.parameters['experiment_path'], self.parameters['subject'] + '.summaryDAT')
         with open(summary_file, 'wb') as f:
             f.write("Welcome to pyoperant v%s." % self.version)
+        self.status.publish({'message': "Welcome to pyoperant v%s." % self.version})
 
     def write_summary(self):
         """ takes in a summary dictionary and options and writes to the bird's summaryDAT"""
         summary_file = os.path.join(self.parameters['experiment_path'], self.parameters['subject'] + '.summaryDAT')
         with open(summary_file, 'w') as f:
             json.dump(self.summary, f, ensure_ascii=False)
+        self.status.publish(self.summary)
 
     ## session flow
     def session_pre(self):
@@ -427,16 +458,7 @@ class GoNoGoInterruptExp(base.BaseExp):
                     reinforcement = blk.pop('reinforcement')
 
                     # Get reinforcement schedule
-                    if reinforcement['schedule'] == 'variable_ratio':
-                        self.reinf_sched = reinf.VariableRatioSchedule(ratio=reinforcement['ratio'])
-                    elif reinforcement['schedule'] == 'fixed_ratio':
-                        self.reinf_sched = reinf.FixedRatioSchedule(ratio=reinforcement['ratio'])
-                    elif reinforcement['schedule'] == 'percent_reinf':
-                        self.reinf_sched = reinf.PercentReinforcement(prob=reinforcement['prob'])
-                    elif reinforcement['schedule'] == 'go_interrupt':
-                        self.reinf_sched = reinf.GoInterruptPercentSchedule(prob=reinforcement['prob'])
-                    else:
-                        self.reinf_sched = reinf.ContinuousReinforcement()
+                    self.reinf_sched = reinf.schedule_from_config(reinforcement)
 
                     # Other reinforcement parameters
                     if 'secondary' not in reinforcement:
@@ -455,18 +477,36 @@ class GoNoGoInterruptExp(base.BaseExp):
                         self.passiveReward = reinforcement.pop('passive')
 
                 if q_type == 'random':
+                    if 'seed' in blk:
+                        blk['seed'] = (blk['seed'], self.session_id)  # reproducible, but different each session
                     self.trial_q = queues.random_queue(**blk)
+                elif q_type == 'randomNoReplacement':
+                    # resumes the epoch it was in if the session is restarted
+                    self.trial_q = queues.random_queue_no_replacement(
+                        state_file=os.path.join(self.parameters['experiment_path'], 'noReplacementQ.json'), **blk)
                 elif q_type == 'block':
                     self.trial_q = queues.block_queue(**blk)
                 elif q_type == 'mixedDblStaircase':
                     dbl_staircases = [queues.DoubleStaircaseReinforced(stims) for stims in blk['stim_lists']]
                     self.trial_q = queues.MixedAdaptiveQueue.load(
-                        os.path.join(self.parameters['experiment_path'], 'persistentQ.pkl'), dbl_staircases)
+                        os.path.join(self.parameters['experiment_path'], 'persistentQ.pkl'), dbl_staircases,
+                        probabilities=blk.get('probabilities'), max_consecutive=blk.get('max_consecutive'))
 
+                if q_type in ('random', 'block') and self.parameters['prefetch_trials']:
+                    # pick the next trials and load their stimuli during the current trial
+                    self.trial_q = queues.PrefetchQueue(self.trial_q, self.parameters['prefetch_trials'],
+                                                        self.prefetch_stimuli)
+
+                trial_q = self.trial_q
                 try:
                     run_trial_queue()
                 except EndSession:
                     return 'post'
+                finally:
+                    # a session that ends partway through the queue leaves it in self.trial_q for the next session
+                    # to continue, so keep prefetching for that
+                    if isinstance(trial_q, queues.PrefetchQueue) and self.trial_q is not trial_q:
+                        trial_q.close()
 
             self.session_q = None
             if self.parameters['subject_type'] == 'human':
@@ -586,6 +626,10 @@ class GoNoGoInterruptExp(base.BaseExp):
         epochs = []
         return stim, epochs
 
+    def prefetch_stimuli(self, conditions):
+        # Runs on the prefetch thread (see queues.PrefetchQueue): loads the stimulus get_stimuli() will use
+        utils.warm_wav(self.parameters['stims'][conditions['stim_name']])
+
     def analyze_trial(self):
         # Calculate both including and excluding NR trials
         # excluding NR trials
@@ -634,6 +678,11 @@ class GoNoGoInterruptExp(base.BaseExp):
             trialWriter = csv.DictWriter(data_fh, fieldnames=self.fields_to_save, extrasaction='ignore')
             trialWriter.writerow(trial_dict)
 
+        if self.trial_log is not None:
+            self.trial_log.append(trial_dict)
+
+        self.criteria_tracker.update(trial)
+
     def run_trial(self):
         self.trial_pre()
 
@@ -655,7 +704,9 @@ class GoNoGoInterruptExp(base.BaseExp):
         # this is where we initialize a trial
         # make sure lights are on at the beginning of each trial, prep for trial
         self.log.debug('running trial')
-        self.log.debug("number of open file descriptors: %d" % (utils.get_num_open_fds()))
+        if self.log.isEnabledFor(logging.DEBUG):
+            # counting them runs lsof, which takes longer than the rest of the trial setup
+            self.log.debug("number of open file descriptors: %d" % (utils.get_num_open_fds()))
 
         self.this_trial = self.trials[-1]
         min_wait = self.parameters['response_delay']  # delay before response allowed defined in json file
@@ -672,6 +723,8 @@ class GoNoGoInterruptExp(base.BaseExp):
         self.analyze_trial()
         self.save_trial(self.this_trial)
         self.write_summary()
+        self.heartbeat.trial()
+        self.heartbeat.poll('intertrial')
 
         utils.wait(self.parameters['intertrial_min'])
 
@@ -693,13 +746,10 @@ class GoNoGoInterruptExp(base.BaseExp):
             raise EndSession
 
     def check_performance(self, block_name):
+        # checks each of the last five days of the block against its criteria, using running counts rather than
+        # reloading the full trial history
         criteria = self.parameters['block_design']['blocks'][block_name]['criteria']
-        perform = analysis.Performance(self.parameters['experiment_path'])
-        five_days_ago = dt.datetime.now() - dt.timedelta(days=5)
-        perform.filter_data(startdate=five_days_ago, block=block_name)
-        perform.summarize('filtered')
-        analyzed_data = perform.analyze(perform.summaryData)
-        perform_result = perform.check_criteria(analyzed_data, criteria)
+        perform_result = self.criteria_tracker.check_criteria(block_name, criteria, days=5)
         # print perform_result
         return perform_result
 
@@ -729,6 +779,7 @@ class GoNoGoInterruptExp(base.BaseExp):
                 self.update_adaptive_queue(presented=False)
                 raise EndSession
             else:
+                self.heartbeat.poll('waiting', within=15.0)
                 trial_time = self.try_panel_function(self.panel.trialSens.poll, timeout=15.0)
 
         self.this_trial.time = trial_time
@@ -771,6 +822,7 @@ class GoNoGoInterruptExp(base.BaseExp):
     def response_main(self):
         response_start = dt.datetime.now()
         while True:
+            self.heartbeat.poll('response', within=1.0)
             elapsed_time = (dt.datetime.now() - self.this_trial.time).total_seconds()
             response_time = elapsed_time - self.this_trial.stimulus_event.time
             if response_time > self.this_trial.annotations['max_wait']:
@@ -812,6 +864,7 @@ class GoNoGoInterruptExp(base.BaseExp):
             utils.wait(.010)
 
     def response_post(self):
+        self.heartbeat.poll('consequence')
         for class_, port in self.class_assoc.items():
             self.try_panel_function(port.off)
             # port.off()
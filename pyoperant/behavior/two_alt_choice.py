@@ -1,5 +1,6 @@
 import os
 import csv
+import logging
 import copy
 import datetime as dt
 from pyoperant.behavior import base, shape
@@ -196,7 +197,14 @@ class TwoAltChoiceExp(base.BaseExp):
                 elif q_type == 'mixedDblStaircase':
                     dbl_staircases = [queues.DoubleStaircaseReinforced(stims) for stims in blk['stim_lists']]
                     self.trial_q = queues.MixedAdaptiveQueue.load(
-                        os.path.join(self.parameters['experiment_path'], 'persistentQ.pkl'), dbl_staircases)
+                        os.path.join(self.parameters['experiment_path'], 'persistentQ.pkl'), dbl_staircases,
+                        probabilities=blk.get('probabilities'), max_consecutive=blk.get('max_consecutive'))
+                elif q_type == 'mixedPsi':
+                    psi_queues = [queues.PsiQueue(stims, max_trials=blk.get('max_trials'), stop_sd=blk.get('stop_sd'))
+                                  for stims in blk['stim_lists']]
+                    self.trial_q = queues.MixedAdaptiveQueue.load(
+                        os.path.join(self.parameters['experiment_path'], 'persistentPsiQ.pkl'), psi_queues,
+                        probabilities=blk.get('probabilities'), max_consecutive=blk.get('max_consecutive'))
                 try:
                     run_trial_queue()
                 except EndSession:
@@ -331,7 +339,9 @@ class TwoAltChoiceExp(base.BaseExp):
         """ this is where we initialize a trial"""
         # make sure lights are on at the beginning of each trial, prep for trial
         self.log.debug('running trial')
-        self.log.debug("number of open file descriptors: %d" % (utils.get_num_open_fds()))
+        if self.log.isEnabledFor(logging.DEBUG):
+            # counting them runs lsof, which takes longer than the rest of the trial setup
+            self.log.debug("number of open file descriptors: %d" % (utils.get_num_open_fds()))
 
         self.this_trial = self.trials[-1]
         min_wait = self.this_trial.stimulus_event.duration
@@ -347,6 +357,7 @@ class TwoAltChoiceExp(base.BaseExp):
         self.analyze_trial()
         self.save_trial(self.this_trial)
         self.write_summary()
+        self.heartbeat.trial()
         utils.wait(self.parameters['intertrial_min'])
 
         # determine if next trial should be a correction trial
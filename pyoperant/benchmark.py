@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import copy
+import time
+import shutil
+import datetime
+import argparse
+import tempfile
+import importlib
+import subprocess
+import collections
+import logging
+import numpy as np
+from pyoperant import simulation, SimulationEnd
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    from pyoperant.local import BENCHMARK_BASELINE_PATH
+except ImportError:
+    BENCHMARK_BASELINE_PATH = os.path.join(os.path.expanduser('~'), '.pyoperant', 'benchmark_baseline.json')
+
+# Benchmarks for the things that make boxes slow to come back after a crash or wake up, and for the trial loop.
+#
+#   startup -- time and memory (max RSS) for a fresh python process to import what a box process imports. Each run is
+#              a new process, since imports are only slow the first time. Also lists the heavy modules (pandas, scipy)
+#              that were imported, which should be none for the default modules.
+#   trials -- wall time of each phase of run_trial (trial_pre ... trial_post, plus new_trial), of the trial data and
+#             summary writes and trial analysis in trial_post, and of logging, for each protocol, running on a
+#             simulated box and subject (see simulation.py). Waiting (ITIs, response windows) is instant on the
+#             simulated clock, so these are the time the code itself takes, though polling loops like response_main
+#             still take time for every poll. Reports p50 and p99, and compares them with a baseline saved with
+#             --save-baseline, exiting with status 1 if any got slower. Baselines are only comparable on the machine
+#             they were saved on.
+#
+# usage: python -m pyoperant.benchmark startup [--repeat 5] [module ...]
+#        python -m pyoperant.benchmark trials [--trials 1000] [--save-baseline] [protocol ...]
+
+STARTUP_MODULES = ['pyoperant.behavior.go_nogo_interrupt']  # what scripts/behave imports to run the usual protocol
+HEAVY_MODULES = ['pandas', 'scipy', 'scipy.stats', 'scipy.special', 'matplotlib']
+
+_wall_time = time.time  # the real time.time, which a simulation's clock replaces while it runs
+
+# run in the child process: argv is the module list
+_STARTUP_CODE = """
+import sys, time, resource, json
+start = time.time()
+for module in sys.argv[1:]:
+    __import__(module)
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed,
+                  'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'modules': len(sys.modules),
+                  'heavy': [name for name in %r if sys.modules.get(name) is not None]}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_startup(modules=STARTUP_MODULES, python=sys.executable):
+    """ Imports modules in a new python process. Returns dict of seconds (import time), max_rss (kB), modules (number
+    loaded) and heavy (which of HEAVY_MODULES were loaded) """
+    env = dict(os.environ)
+    # import this copy of pyoperant, even if another is installed
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                      env.get('PYTHONPATH')]))
+    process = subprocess.Popen([python, '-c', _STARTUP_CODE] + list(modules), stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('importing %s failed:\n%s' % (', '.join(modules), stderr))
+    return json.loads(stdout.strip().splitlines()[-1])
+
+
+def startup_benchmark(modules=STARTUP_MODULES, repeat=5):
+    """ Runs measure_startup repeat times. Returns dict of median and min seconds, median max_rss, modules and heavy
+    (from the last run) """
+    runs = [measure_startup(modules) for _ in range(repeat)]
+    seconds = sorted(run['seconds'] for run in runs)
+    rss = sorted(run['max_rss'] for run in runs)
+    return {'seconds': seconds[len(seconds) // 2],
+            'min_seconds': seconds[0],
+            'max_rss': rss[len(rss) // 2],
+            'modules': runs[-1]['modules'],
+            'heavy': runs[-1]['heavy']}
+
+
+# region Trial loop
+TRIAL_PHASES = ['new_trial', 'trial_pre', 'stimulus_pre', 'stimulus_main', 'stimulus_post', 'response_pre',
+                'response_main', 'response_post', 'consequence_pre', 'consequence_main', 'consequence_post',
+                'trial_post']
+TRIAL_POST_PARTS = ['analyze_trial', 'save_trial', 'write_summary']  # timed separately as well as in trial_post
+PROTOCOL_MODULES = collections.OrderedDict([('GoNoGoInterruptExp', 'pyoperant.behavior.go_nogo_interrupt'),
+                                            ('TwoAltChoiceExp', 'pyoperant.behavior.two_alt_choice')])
+
+# a block of two stimuli and their classes for each protocol, with a fixed queue seed so the trials are the same
+# every run
+_STIMS = {'a': 'a.wav', 'b': 'b.wav'}
+_SCHEDULE = [['08:30', '20:30']]
+BENCHMARK_PARAMETERS = {
+    'GoNoGoInterruptExp': {
+        'classes': {'sPlus': {'component': 'respSens', 'reward_value': 0.075, 'punish_value': 0.0},
+                    'sMinus': {'component': 'trialSens', 'reward_value': 0.0, 'punish_value': 2.0}},
+        'block_design': {'blocks': {'benchmark': {'description': 'benchmark', 'queue': 'random', 'seed': 0,
+                                                  'conditions': [{'class': 'sPlus', 'stim_name': 'a'},
+                                                                 {'class': 'sMinus', 'stim_name': 'b'}]}},
+                         'order': ['benchmark']},
+        'stims': _STIMS, 'light_schedule': _SCHEDULE, 'session_schedule': _SCHEDULE, 'session_days': 'daily',
+        'intertrial_min': 0.5, 'response_delay': 0.5, 'response_win': 5, 'correction_trials': False,
+        'shape': False, 'debug': False, 'log_handlers': ['text']},
+    'TwoAltChoiceExp': {
+        'classes': {'L': {'component': 'left', 'reward_value': 2.0, 'punish_value': 2.0},
+                    'R': {'component': 'right', 'reward_value': 2.0, 'punish_value': 2.0}},
+        'block_design': {'blocks': {'benchmark': {'queue': 'random', 'seed': 0,
+                                                  'conditions': [{'class': 'L', 'stim_name': 'a'},
+                                                                 {'class': 'R', 'stim_name': 'b'}]}},
+                         'order': ['benchmark']},
+        'reinforcement': {'schedule': 'continuous', 'secondary': False},
+        'stims': _STIMS, 'light_schedule': _SCHEDULE, 'session_schedule': _SCHEDULE,
+        'intertrial_min': 0.5, 'response_win': 5, 'correction_trials': False,
+        'shape': False, 'debug': False, 'log_handlers': ['text']},
+}
+
+
+class TrialTimer(object):
+    """Times an experiment's trial phases, on the real clock. Samples are only kept once warmup trials have finished,
+    and the simulation is ended (with errors.SimulationEnd) after trials more
+
+    Keyword arguments:
+    trials -- number of trials to time
+    warmup -- number of trials to run first, untimed (the first trials open files, load stimuli, etc.)
+
+    Methods:
+    instrument(experiment) -- wrap the experiment's phase methods and log handlers with timers
+    results() -- dict of phase: dict of p50, p99, mean and max (in seconds) and count. 'trial' is the whole of
+        run_trial, and 'logging' the time per trial spent in log handlers
+
+    Attributes:
+    samples -- dict of phase: list of times (s)
+    """
+
+    def __init__(self, trials=1000, warmup=10):
+        self.trials = trials
+        self.warmup = warmup
+        self.samples = collections.OrderedDict((name, []) for name in TRIAL_PHASES + TRIAL_POST_PARTS +
+                                               ['trial', 'logging'])
+        self.finished = 0  # trials finished, including warmup
+        self._trial_start = None
+        self._logging = 0.0  # time in log handlers since the last trial finished
+
+    def instrument(self, experiment):
+        for name in TRIAL_PHASES + TRIAL_POST_PARTS:
+            setattr(experiment, name, self._timed(name, getattr(experiment, name)))
+        for handler in logging.getLogger().handlers:
+            handler.handle = self._timed_logging(handler.handle)
+
+    def _timed(self, name, function):
+        def timed(*args, **kwargs):
+            start = _wall_time()
+            if name == 'trial_pre':
+                self._trial_start = start
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = _wall_time()
+                if self.finished >= self.warmup:
+                    self.samples[name].append(end - start)
+                if name == 'trial_post':
+                    self._end_trial(end)
+        return timed
+
+    def _timed_logging(self, handle):
+        def timed(record):
+            start = _wall_time()
+            try:
+                return handle(record)
+            finally:
+                self._logging += _wall_time() - start
+        return timed
+
+    def _end_trial(self, end):
+        if self.finished >= self.warmup:
+            self.samples['trial'].append(end - self._trial_start)
+            self.samples['logging'].append(self._logging)
+        self._logging = 0.0
+        self.finished += 1
+        if self.finished >= self.warmup + self.trials:
+            raise SimulationEnd('benchmark finished')
+
+    def results(self):
+        results = collections.OrderedDict()
+        for name, samples in self.samples.items():
+            if samples:
+                p50, p99 = np.percentile(samples, [50, 99])
+                results[name] = {'p50': p50, 'p99': p99, 'mean': np.mean(samples), 'max': max(samples),
+                                 'count': len(samples)}
+        return results
+
+
+def trial_benchmark(protocol_name, trials=1000, warmup=10, seed=0):
+    """ Runs trials (after warmup) of a protocol (a name in PROTOCOL_MODULES) with BENCHMARK_PARAMETERS on a
+    simulated box, in a temporary folder. Returns dict of trials, seconds (wall time of the whole run) and phases
+    (TrialTimer.results()) """
+    protocol = getattr(importlib.import_module(PROTOCOL_MODULES[protocol_name]), protocol_name)
+    if protocol_name in simulation.TWO_ALT_CHOICE_PROTOCOLS:
+        agent = simulation.TwoAltChoiceAgent(seed=seed)
+    else:
+        agent = simulation.GoNoGoAgent(seed=seed)
+    parameters = copy.deepcopy(BENCHMARK_PARAMETERS[protocol_name])
+    timer = TrialTimer(trials, warmup)
+    experimentPath = tempfile.mkdtemp(prefix='pyoperant_benchmark_')
+
+    # the experiment configures the root logger with basicConfig, which does nothing if it already has handlers, and
+    # adds its own: run it with none, and put things back after
+    root = logging.getLogger()
+    rootHandlers, rootLevel, excepthook = list(root.handlers), root.level, sys.excepthook
+    for handler in rootHandlers:
+        root.removeHandler(handler)
+    try:
+        simulation.placeholder_stimuli(parameters, os.path.join(experimentPath, 'stims'))
+        start = _wall_time()
+        # starts at 08:00, just before the session, and runs for up to a year of simulated days (the timer ends it)
+        simulation.simulate(protocol, parameters, experimentPath, days=365, agent=agent,
+                            start=datetime.datetime(2020, 1, 6, 8), seed=seed, before_run=timer.instrument)
+        seconds = _wall_time() - start
+    finally:
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+        for handler in rootHandlers:
+            root.addHandler(handler)
+        root.setLevel(rootLevel)
+        sys.excepthook = excepthook
+        shutil.rmtree(experimentPath, ignore_errors=True)
+    return {'trials': timer.finished - warmup, 'seconds': seconds, 'phases': timer.results()}
+
+
+def compare_trials(results, baseline, tolerance=0.3, min_difference=0.2e-3):
+    """ Compares trial_benchmark results with a baseline (both dicts of protocol: results). Returns list of
+    (protocol, phase, statistic, baseline seconds, seconds) for each p50 or p99 that's more than tolerance (a
+    fraction) and min_difference (s) slower than the baseline. Protocols whose baseline ran a different number of
+    trials aren't compared, since the trials (and the history analyzed after each) differ """
+    regressions = []
+    for protocol, result in results.items():
+        if baseline.get(protocol, {}).get('trials') != result['trials']:
+            continue
+        basePhases = baseline[protocol].get('phases', {})
+        for phase, stats in result['phases'].items():
+            for statistic in ['p50', 'p99']:
+                if statistic not in basePhases.get(phase, {}):
+                    continue
+                before, after = basePhases[phase][statistic], stats[statistic]
+                if after > before * (1 + tolerance) and after - before > min_difference:
+                    regressions.append((protocol, phase, statistic, before, after))
+    return regressions
+
+
+def load_baseline(path=BENCHMARK_BASELINE_PATH):
+    try:
+        with open(path, 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_baseline(results, path=BENCHMARK_BASELINE_PATH):
+    """ Saves trial_benchmark results (dict of protocol: results), replacing those protocols' baselines """
+    baseline = load_baseline(path) or {}
+    baseline.update(results)
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    # write to temporary file then rename, so a failed write doesn't lose the old baseline
+    tempPath = '%s.%i.tmp' % (path, os.getpid())
+    with open(tempPath, 'wb') as f:
+        json.dump(baseline, f, indent=4, sort_keys=True)
+    os.rename(tempPath, path)
+# endregion
+
+
+def main(arg_str=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark pyoperant')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    startup = subparsers.add_parser('startup', help='box process import time and memory')
+    startup.add_argument('modules', nargs='*', default=STARTUP_MODULES,
+                         help='modules to import (default: %s)' % ' '.join(STARTUP_MODULES))
+    startup.add_argument('--repeat', type=int, default=5, help='number of processes to time (default: %(default)s)')
+    trials = subparsers.add_parser('trials', help='trial loop phase times, compared with a baseline')
+    trials.add_argument('protocols', nargs='*', default=list(PROTOCOL_MODULES), metavar='protocol',
+                        help='protocols to run (default: %s)' % ' '.join(PROTOCOL_MODULES))
+    trials.add_argument('--trials', type=int, default=1000, help='trials to time (default: %(default)s)')
+    trials.add_argument('--baseline', default=BENCHMARK_BASELINE_PATH, help='baseline file (default: %(default)s)')
+    trials.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    trials.add_argument('--tolerance', type=float, default=0.3,
+                        help='fraction slower than the baseline that counts as a regression (default: %(default)s)')
+    args = parser.parse_args(arg_str)
+
+    if args.benchmark == 'startup':
+        result = startup_benchmark(args.modules, args.repeat)
+        print('%s\n  import time: %.3f s (median of %i, min %.3f s)\n  max RSS: %.1f MB\n  modules loaded: %i\n'
+              '  heavy modules loaded: %s' % (', '.join(args.modules), result['seconds'], args.repeat,
+                                              result['min_seconds'], result['max_rss'] / 1024.0, result['modules'],
+                                              ', '.join(result['heavy']) or 'none'))
+
+    elif args.benchmark == 'trials':
+        for protocol in args.protocols:
+            if protocol not in PROTOCOL_MODULES:
+                parser.error('unknown protocol %s (choose from %s)' % (protocol, ', '.join(PROTOCOL_MODULES)))
+        results = collections.OrderedDict()
+        for protocol in args.protocols:
+            results[protocol] = result = trial_benchmark(protocol, args.trials)
+            print('%s: %i trials in %.1f s\n  %-18s %10s %10s %10s' % (protocol, result['trials'], result['seconds'],
+                                                                      'phase', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+            for phase, stats in result['phases'].items():
+                print('  %-18s %10.3f %10.3f %10.3f' % (phase, stats['p50'] * 1000, stats['p99'] * 1000,
+                                                       stats['max'] * 1000))
+        if args.save_baseline:
+            save_baseline(results, args.baseline)
+            print('baseline saved to %s' % args.baseline)
+            return
+        baseline = load_baseline(args.baseline)
+        if baseline is None:
+            print('no baseline in %s (save one with --save-baseline)' % args.baseline)
+            return
+        for protocol, result in results.items():
+            if baseline.get(protocol, {}).get('trials') != result['trials']:
+                print('not compared: %s has no baseline of %i trials' % (protocol, result['trials']))
+        regressions = compare_trials(results, baseline, args.tolerance)
+        for protocol, phase, statistic, before, after in regressions:
+            print('slower: %s %s %s %.3f ms -> %.3f ms' % (protocol, phase, statistic, before * 1000, after * 1000))
+        if regressions:
+            sys.exit(1)
+        print('no regressions against %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
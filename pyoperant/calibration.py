@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import time
+import wave
+import numpy as np
+from pyoperant import InterfaceError
+from pyoperant import devices
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None  # only needed to record; analysis and history work without it
+
+try:
+    from pyoperant.local import CALIBRATION_PATH
+except ImportError:
+    CALIBRATION_PATH = os.path.join(os.path.expanduser('~'), '.pyoperant', 'calibration')
+
+# Sound check: play a test tone through a box's speaker, record it with the box's microphone, and measure the level
+#
+# Levels are in dBFS relative to a full-scale sine wave (AES17), so a full-scale sine has an rms level of 0 dBFS, and
+# peak levels are relative to the largest sample value. Band levels split the rms level by frequency (octave bands by
+# default); the band powers add up to the total.
+
+FULL_SCALE = 32768.0  # int16 samples
+DEFAULT_BANDS = [(125, 250), (250, 500), (500, 1000), (1000, 2000), (2000, 4000), (4000, 8000), (8000, 16000)]
+
+
+def _dbfs(mean_square):
+    # rms level (from mean square) in dBFS, None for silence
+    return None if mean_square <= 0 else 10 * np.log10(mean_square * 2)
+
+
+def analyze(samples, sample_rate, bands=DEFAULT_BANDS, full_scale=FULL_SCALE, work=None):
+    """ Returns level and spectrum of a recording as a dict of:
+    rms, peak -- as a fraction of full scale (DC offset removed)
+    rms_dbfs, peak_dbfs -- the same in dBFS (None for silence)
+    dc_offset -- mean sample value, as a fraction of full scale
+    dominant_frequency -- frequency (Hz) with the most power
+    bands -- list of [low, high, level in dBFS] for each frequency band
+
+    samples -- numpy array of samples
+    work -- optional float64 array at least as long as samples, used instead of allocating one (e.g. when analyzing
+        repeatedly)
+    """
+    count = len(samples)
+    if count == 0:
+        return {'rms': 0.0,
+                'peak': 0.0,
+                'rms_dbfs': None,
+                'peak_dbfs': None,
+                'dc_offset': 0.0,
+                'dominant_frequency': None,
+                'bands': [[low, high, None] for low, high in bands],
+                }
+    if work is None or len(work) < count:
+        work = np.empty(count)
+    x = work[:count]
+    np.multiply(samples, 1.0 / full_scale, out=x)
+    dcOffset = x.mean()
+    x -= dcOffset
+
+    meanSquare = np.dot(x, x) / count
+    peak = np.abs(x).max()
+
+    # Power spectrum, with a Hann window, scaled so the bins add up to the mean square
+    window = np.hanning(count)
+    x *= window
+    power = np.abs(np.fft.rfft(x)) ** 2
+    power *= 2.0 / (count * np.dot(window, window))
+    power[0] /= 2
+    if count % 2 == 0:
+        power[-1] /= 2
+    frequencies = np.fft.rfftfreq(count, 1.0 / sample_rate)
+    cumulative = np.concatenate(([0.0], np.cumsum(power)))
+
+    bandLevels = []
+    for low, high in bands:
+        start, stop = np.searchsorted(frequencies, [low, high])
+        bandLevels.append([low, high, _dbfs(cumulative[stop] - cumulative[start])])
+
+    return {'rms': float(np.sqrt(meanSquare)),
+            'peak': float(peak),
+            'rms_dbfs': _dbfs(meanSquare),
+            'peak_dbfs': None if peak <= 0 else float(20 * np.log10(peak)),
+            'dc_offset': float(dcOffset),
+            'dominant_frequency': float(frequencies[np.argmax(power[1:]) + 1]) if len(power) > 1 else None,
+            'bands': bandLevels,
+            }
+
+
+def record(stream, frame_count, chunk=4096, buffer=None):
+    """ Reads frame_count int16 samples from an open pyaudio input stream into buffer (a preallocated int16 numpy
+    array, allocated if not given). Returns the buffer """
+    if buffer is None:
+        buffer = np.empty(frame_count, dtype=np.int16)
+    position = 0
+    while position < frame_count:
+        samples = np.frombuffer(stream.read(min(chunk, frame_count - position)), dtype=np.int16)
+        buffer[position:position + len(samples)] = samples
+        position += len(samples)
+    return buffer
+
+
+def sound_check(box_number, test_file, seconds=2.0, rate=44100, chunk=4096, bands=DEFAULT_BANDS):
+    """ Plays test_file through a box's speaker while recording from its microphone, and returns the analysis of the
+    recording (see analyze) with 'box', 'time' and 'test_file' added. Safe to run for several boxes at once, on
+    separate threads """
+    if pyaudio is None:
+        raise InterfaceError('pyaudio is required for sound checks')
+
+    # One PortAudio instance is shared by all sound checks, and devices are looked up in the registry, so neither
+    # enumerates all the devices again. Devices are matched as in the box processes: the speaker by name, and the
+    # microphone by ALSA card, which udev rules name by USB port ('soundNN')
+    registry = devices.registry
+    audio = registry.acquire_audio()
+    try:
+        outputIndex = registry.output_index('Board{:02d}: USB Audio'.format(box_number), audio)
+        inputIndex = registry.card_index('sound%02i' % box_number, audio)
+
+        # everything opened is closed, whichever step fails
+        waveFile = streamOut = streamIn = None
+        try:
+            waveFile = wave.open(test_file)
+
+            def callback(in_data, frame_count, time_info, status):
+                # necessary for pyaudio to play in non-blocking mode
+                return waveFile.readframes(frame_count), pyaudio.paContinue
+
+            with registry.lock:
+                streamOut = audio.open(format=audio.get_format_from_width(waveFile.getsampwidth()),
+                                       channels=1,  # fixed to 1 for single-channel (mono) stimuli
+                                       rate=waveFile.getframerate(),
+                                       output=True,
+                                       output_device_index=outputIndex,
+                                       start=False,
+                                       stream_callback=callback)
+                streamIn = audio.open(format=pyaudio.paInt16,
+                                      channels=1,
+                                      rate=rate,
+                                      input=True,
+                                      input_device_index=inputIndex,
+                                      frames_per_buffer=chunk)
+
+            # play sound, then record
+            streamOut.start_stream()
+            recording = record(streamIn, int(rate * seconds), chunk)
+        finally:
+            for opened in (streamIn, streamOut, waveFile):
+                if opened is not None:
+                    opened.close()
+    finally:
+        registry.release_audio(audio)
+
+    result = analyze(recording, rate, bands)
+    result.update(box=box_number, time=time.time(), test_file=test_file)
+    return result
+
+
+class CalibrationHistory(object):
+    """Sound check results for each box, kept in one file per box (one json object per line) so they can be compared
+    over time
+
+    Keyword arguments:
+    path -- folder for history files (default CALIBRATION_PATH)
+
+    Methods:
+    add(result) -- save a sound_check result
+    history(box_number, limit=None) -- list of a box's results, oldest first (only the last 'limit', if given)
+    last(box_number) -- a box's most recent result, or None
+    """
+
+    def __init__(self, path=CALIBRATION_PATH):
+        self.path = path
+
+    def _file(self, box_number):
+        return os.path.join(self.path, 'box%02i.json' % box_number)
+
+    def add(self, result):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(self._file(result['box']), 'ab') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    def history(self, box_number, limit=None):
+        try:
+            with open(self._file(box_number), 'rb') as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+        if limit is not None:
+            lines = lines[-limit:]
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def last(self, box_number):
+        results = self.history(box_number, limit=1)
+        return results[0] if results else None
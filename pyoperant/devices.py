@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import re
+import hashlib
+import threading
+import logging
+from pyoperant import InterfaceError
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None  # card lookups work without it
+
+try:
+    from pyoperant.local import DEVICE_CACHE_PATH
+except ImportError:
+    DEVICE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pyoperant', 'devices.json')
+
+# Audio device registry: looks up pyaudio device indices by name or ALSA card without enumerating every device each
+# time. Enumerating PortAudio devices means probing every ALSA device, which takes seconds with a rig full of USB sound
+# cards, and every box process and sound check used to do it.
+#
+# Lookups are cached (in memory and in DEVICE_CACHE_PATH, so box processes share them) against a generation: a hash of
+# /proc/asound/cards, which changes whenever a sound card is added or removed. A changed generation, or invalidate()
+# (called by the GUI when udev reports a sound device change), makes the next lookup enumerate again. A cached index is
+# checked against the device's name before it's returned, since PortAudio leaves out devices it can't open (e.g. one
+# in use by another process), which shifts the indices after it.
+
+CARDS_FILE = '/proc/asound/cards'
+NAME_LENGTH = 18  # device names are compared on their first NAME_LENGTH characters; the rest varies with the ALSA name
+
+
+def _matches(name, device_name):
+    return name[:NAME_LENGTH] == device_name[:NAME_LENGTH]
+
+
+class DeviceRegistry(object):
+    """Cached pyaudio device and ALSA card lookup
+
+    Keyword arguments:
+    path -- cache file shared between processes (default DEVICE_CACHE_PATH), or None for memory only
+    cards_file -- ALSA card list (default /proc/asound/cards)
+
+    Methods:
+    generation() -- current device generation (changes when sound cards are added or removed)
+    invalidate() -- forget cached lookups, e.g. after a udev event
+    cards() -- dict of ALSA card name: card number
+    devices(audio=None) -- list of pyaudio device info dicts (index, name, maxInputChannels, maxOutputChannels, card)
+    output_index(device_name, audio=None) -- pyaudio index of an output device by name
+    input_index(device_name, audio=None) -- pyaudio index of an input device by name
+    card_index(card_name, audio=None) -- pyaudio index of the (first) device of a named ALSA card
+    acquire_audio() -- shared pyaudio.PyAudio instance, current for this generation; release_audio() when done
+    release_audio(audio) -- release an instance from acquire_audio
+    close() -- terminate the shared PyAudio instance
+
+    audio -- an open pyaudio.PyAudio to enumerate with, if devices need enumerating (one is created if not given)
+    lock -- held while PortAudio is initialized or terminated, which isn't thread safe. Hold it when opening streams
+    """
+
+    def __init__(self, path=DEVICE_CACHE_PATH, cards_file=CARDS_FILE):
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.cards_file = cards_file
+        self.lock = threading.RLock()
+        self._generation = None  # generation of the cached values below
+        self._cards = None
+        self._devices = None
+        self._audio = None
+        self._audio_generation = None
+        self._audio_users = {}  # PyAudio instance: number of users
+
+    def generation(self):
+        try:
+            with open(self.cards_file, 'rb') as f:
+                return hashlib.md5(f.read()).hexdigest()
+        except IOError:
+            return None
+
+    def invalidate(self):
+        with self.lock:
+            self._generation = None
+            self._cards = None
+            self._devices = None
+            if self.path is not None:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+    def _check_generation(self):
+        # drop cached values if the devices have changed. Called with lock held
+        generation = self.generation()
+        if generation != self._generation:
+            self._generation = generation
+            self._cards = None
+            self._devices = None
+        return generation
+
+    # region ALSA cards
+    def cards(self):
+        with self.lock:
+            self._check_generation()
+            if self._cards is None:
+                self._cards = {}
+                try:
+                    with open(self.cards_file, 'r') as f:
+                        # card lines are formatted " number [name           ]: driver - description"
+                        for line in f:
+                            match = re.search(r'^\s*(\d+)\s\[(.+?)\s*\]', line)
+                            if match is not None:
+                                self._cards[match.group(2)] = int(match.group(1))
+                except IOError:
+                    pass
+            return self._cards
+    # endregion
+
+    # region pyaudio devices
+    def devices(self, audio=None):
+        with self.lock:
+            generation = self._check_generation()
+            if self._devices is None:
+                self._devices = self._load(generation)
+            if self._devices is None:
+                self._devices = self._enumerate(audio)
+                self._save(generation, self._devices)
+            return self._devices
+
+    def _enumerate(self, audio=None):
+        # Called with lock held
+        if audio is None:
+            audio = self.acquire_audio()
+            try:
+                return self._enumerate(audio)
+            finally:
+                self.release_audio(audio)
+        deviceList = []
+        for index in range(audio.get_device_count()):
+            deviceList.append(self._device_info(audio, index))
+        self.log.debug('Enumerated %i audio devices' % len(deviceList))
+        return deviceList
+
+    @staticmethod
+    def _device_info(audio, index):
+        deviceInfo = audio.get_device_info_by_index(index)
+        match = re.search(r'hw:(\d+),', deviceInfo['name'])
+        return {'index': index,
+                'name': deviceInfo['name'],
+                'maxInputChannels': deviceInfo.get('maxInputChannels', 0),
+                'maxOutputChannels': deviceInfo.get('maxOutputChannels', 0),
+                'card': int(match.group(1)) if match is not None else None}
+
+    def _load(self, generation):
+        if self.path is None or generation is None:
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cache.get('generation') != generation:
+            return None
+        return cache['devices']
+
+    def _save(self, generation, device_list):
+        if self.path is None or generation is None:
+            return
+        try:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            # write to temporary file then rename, so other processes never read a partly written cache
+            tempPath = '%s.%i.tmp' % (self.path, os.getpid())
+            with open(tempPath, 'wb') as f:
+                json.dump({'generation': generation, 'devices': device_list}, f)
+            os.rename(tempPath, self.path)
+        except (IOError, OSError) as e:
+            self.log.warning('Could not save audio device cache: %s' % e)
+
+    def _find(self, test, description, audio=None):
+        # index of the first device passing test. The cached index is checked against the device itself when audio is
+        # given, and devices are enumerated again if it doesn't match
+        with self.lock:
+            cached = [device['index'] for device in self.devices(audio) if test(device)]
+            if cached and audio is None:
+                return cached[0]
+            if cached:
+                try:
+                    if test(self._device_info(audio, cached[0])):
+                        return cached[0]
+                except (IOError, ValueError):
+                    pass  # index out of range
+            if audio is not None:
+                # not found, or devices have moved: look through the caller's PyAudio (its indices are the ones that
+                # matter), without replacing the shared cache
+                self.log.debug('Cached audio devices out of date looking for %s' % description)
+                for index in range(audio.get_device_count()):
+                    if test(self._device_info(audio, index)):
+                        return index
+            raise InterfaceError('could not find pyaudio device %s' % description)
+
+    def output_index(self, device_name, audio=None):
+        return self._find(lambda device: device['maxOutputChannels'] > 0 and _matches(device['name'], device_name),
+                          device_name, audio)
+
+    def input_index(self, device_name, audio=None):
+        return self._find(lambda device: device['maxInputChannels'] > 0 and _matches(device['name'], device_name),
+                          device_name, audio)
+
+    def card_index(self, card_name, audio=None):
+        cardNumber = self.cards().get(card_name)
+        if cardNumber is None:
+            raise InterfaceError('could not find ALSA card %s' % card_name)
+        return self._find(lambda device: device['card'] == cardNumber, '%s (card %i)' % (card_name, cardNumber), audio)
+    # endregion
+
+    # region Shared PyAudio instance
+    def acquire_audio(self):
+        if pyaudio is None:
+            raise InterfaceError('pyaudio is required for audio devices')
+        with self.lock:
+            generation = self.generation()
+            if self._audio is None or generation != self._audio_generation:
+                # PortAudio only sees devices present when it was initialized, so start a new instance when they
+                # change. The old one is terminated once nothing is using it
+                oldAudio = self._audio
+                self._audio = pyaudio.PyAudio()
+                self._audio_generation = generation
+                self._audio_users[self._audio] = 0
+                if oldAudio is not None and self._audio_users[oldAudio] == 0:
+                    self._terminate(oldAudio)
+            self._audio_users[self._audio] += 1
+            return self._audio
+
+    def release_audio(self, audio):
+        with self.lock:
+            self._audio_users[audio] -= 1
+            if audio is not self._audio and self._audio_users[audio] == 0:
+                self._terminate(audio)
+
+    def _terminate(self, audio):
+        # Called with lock held
+        del self._audio_users[audio]
+        audio.terminate()
+
+    def close(self):
+        with self.lock:
+            if self._audio is not None and self._audio_users[self._audio] == 0:
+                self._terminate(self._audio)
+            self._audio = None
+    # endregion
+
+
+registry = DeviceRegistry()  # shared by everything in a process
@@ -44,3 +44,13 @@ class ComponentError(Exception):
 
 class ArduinoException(Exception):
     pass
+
+
+class AnalysisCancelled(Exception):
+    """ raised (e.g. by an analysis progress callback) to stop an analysis whose result is no longer needed """
+    pass
+
+
+class SimulationEnd(Exception):
+    """ raised by a simulation's virtual clock when the simulated time is up (see simulation.py) """
+    pass
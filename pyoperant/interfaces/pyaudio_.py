@@ -2,6 +2,7 @@ import pyaudio
 import wave
 from pyoperant.interfaces import base_
 from pyoperant import InterfaceError
+from pyoperant import devices
 
 
 class PyAudioInterface(base_.BaseInterface):
@@ -28,32 +29,16 @@ class PyAudioInterface(base_.BaseInterface):
         self.open()
 
     def open(self):
-        self.pa = pyaudio.PyAudio()
-        # Get device index based on device name, which is customized in Linux implementations (e.g., 'board01')
+        with devices.registry.lock:
+            self.pa = pyaudio.PyAudio()
+        # Get device index based on device name, which is customized in Linux implementations (e.g., 'board01').
+        # Looked up in the device registry, so the devices aren't all enumerated again
         if self.io_type == 'output':
-            for index in range(self.pa.get_device_count()):
-                deviceInfo = self.pa.get_device_info_by_index(index)
-                truncName = deviceInfo['name']
-                # if self.device_name == self.pa.get_device_info_by_index(index)['name']:
-                if deviceInfo.get('maxOutputChannels') > 0 and self.device_name[:18] == truncName[:18]:  # only check
-                    # the first 7 characters
-                    self.device_index = index
-                    break
-                else:
-                    self.device_index = None
+            self.device_index = devices.registry.output_index(self.device_name, self.pa)
         elif self.io_type == 'input':
-            for index in range(self.pa.get_device_count()):
-                deviceInfo = self.pa.get_device_info_by_index(index)
-                truncName = deviceInfo['name']
-                # if self.device_name == self.pa.get_device_info_by_index(index)['name']:
-                if deviceInfo.get('maxInputChannels') > 0 and self.device_name[:18] == truncName[:18]:  # only check
-                    # the first 7 characters
-                    self.device_index = index
-                    break
-                else:
-                    self.device_index = None
-        if self.device_index is None:
-            raise InterfaceError('could not find pyaudio device %s' % self.device_name)
+            self.device_index = devices.registry.input_index(self.device_name, self.pa)
+        else:
+            raise InterfaceError('unknown io_type %s' % self.io_type)
 
         self.device_info = self.pa.get_device_info_by_index(self.device_index)
 
@@ -66,7 +51,8 @@ class PyAudioInterface(base_.BaseInterface):
             self.wf.close()
         except AttributeError:
             self.wf = None
-        self.pa.terminate()
+        with devices.registry.lock:
+            self.pa.terminate()
 
     def validate(self):
         if self.wf is not None:
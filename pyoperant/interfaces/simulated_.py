@@ -0,0 +1,96 @@
+import logging
+from pyoperant.interfaces import base_
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedInterface(base_.BaseInterface):
+    """Stands in for a box's hardware in a simulation (see simulation.py): inputs are pecks from a simulated subject,
+    outputs are just remembered, and waiting happens on a virtual clock
+
+    Channels are named rather than numbered (e.g. {'channel': 'trial'}); any name can be used as an input or an output.
+    A peck is an event: once read (or returned by a poll) it's gone.
+
+    Keyword arguments:
+    clock -- simulation.VirtualClock that polls wait on
+    agent -- simulated subject (see simulation.BaseAgent), asked when it pecks and told when outputs change
+    response_channel -- input that the agent's responses to stimuli are pecks on, unless it names another (default
+        'response')
+
+    Attributes:
+    counts -- dict of output channel: number of times it was turned on
+    durations -- dict of output channel: total time (s) it was on
+    stimuli -- number of stimuli played
+    """
+
+    def __init__(self, clock, agent, response_channel='response', *args, **kwargs):
+        super(SimulatedInterface, self).__init__(*args, **kwargs)
+        self.clock = clock
+        self.agent = agent
+        self.response_channel = response_channel
+        self._outputs = {}  # output channel: value
+        self._on_since = {}  # output channel: time it was turned on
+        self._pecks = {}  # input channel: time of the next peck
+        self._wav = None
+        self._response = None  # input channel of the pending response to the stimulus
+        self.counts = {}
+        self.durations = {}
+        self.stimuli = 0
+
+    def _read_bool(self, channel, **kwargs):
+        if channel in self._outputs:
+            return self._outputs[channel]
+        peck = self._pecks.get(channel)
+        if peck is not None and peck <= self.clock.time():
+            del self._pecks[channel]
+            return True
+        return False
+
+    def _write_bool(self, channel, value, **kwargs):
+        value = bool(value)
+        now = self.clock.time()
+        if value and not self._outputs.get(channel):
+            self.counts[channel] = self.counts.get(channel, 0) + 1
+            self._on_since[channel] = now
+        elif not value and self._outputs.get(channel):
+            self.durations[channel] = self.durations.get(channel, 0.0) + now - self._on_since.pop(channel)
+        if value != self._outputs.get(channel):
+            self.agent.output(channel, value, now)
+        self._outputs[channel] = value
+        return value
+
+    def _poll(self, channel, timeout=None, **kwargs):
+        """ waits on the clock for the agent's next peck on channel. Returns its time, or None if polling times out """
+        now = self.clock.time()
+        if channel not in self._pecks:
+            delay = self.agent.peck_delay(channel, now)
+            if delay is not None:
+                self._pecks[channel] = now + max(delay, 0.0)
+        peck = self._pecks.get(channel)
+        if peck is None or (timeout is not None and peck > now + timeout):
+            # no peck before timing out (or ever, with no timeout: the clock ends the simulation)
+            self.clock.sleep(timeout if timeout is not None else float('inf'))
+            return None
+        self.clock.sleep(peck - now)
+        del self._pecks[channel]
+        return self.clock.now()
+
+    def _queue_wav(self, wav_file, **kwargs):
+        self._wav = wav_file
+
+    def _play_wav(self):
+        self.stimuli += 1
+        now = self.clock.time()
+        response = self.agent.respond(self._wav, now)
+        delay, channel = response if isinstance(response, tuple) else (response, self.response_channel)
+        if delay is not None:
+            self._pecks[channel] = now + max(delay, 0.0)
+            self._response = channel
+        logger.debug('played %s, response in %s s' % (self._wav, delay))
+
+    def _stop_wav(self):
+        # a response that hasn't happened by the time the stimulus is stopped (at the response, or the end of the
+        # response window) isn't made
+        if self._response is not None:
+            self._pecks.pop(self._response, None)
+            self._response = None
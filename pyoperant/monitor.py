@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import cgi
+import time
+import argparse
+import threading
+import collections
+import logging
+import BaseHTTPServer
+import SocketServer
+from pyoperant import status
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Headless rig monitor: collects the status every box pushes (summary, errors, heartbeats; see status.py) and serves it
+# over HTTP, so box status can be checked from a browser or script without the GUI, and without any load on the boxes
+# however many viewers there are.
+#
+#   GET /             -- html dashboard (refreshes itself)
+#   GET /status.json  -- all boxes
+#   GET /box/<panel>.json -- one box
+#
+# Responses are rendered once after a status change (or every CACHE_TIME, so boxes that have gone quiet show up as
+# not responding) and then served from memory.
+#
+# usage: python -m pyoperant.monitor [--host 127.0.0.1] [--port 8080]
+
+RATE_WINDOW = 3600.0  # trial rate is trials per hour over this window (s)
+MAX_ERRORS = 10  # latest errors kept per box
+HEARTBEAT_STALE = 15.0  # time (s) without any message before a box is shown as not responding
+CACHE_TIME = 5.0  # longest time (s) a rendered response is served for
+
+
+class StatusMonitor(object):
+    """Keeps the latest status of every box, from a status.StatusListener, on a background thread
+
+    Keyword arguments:
+    listener -- status.StatusListener to receive from
+
+    Methods:
+    start() -- start receiving
+    stop() -- stop receiving and close the listener
+    update(box_status) -- apply one status update (normally called by the receiving thread)
+    render(name) -- (content type, body) of a cached response: 'json', 'html', or 'box/<panel>', or None if unknown
+    """
+
+    def __init__(self, listener):
+        self.log = logging.getLogger(__name__)
+        self.listener = listener
+        self.boxes = {}  # panel: dict of box info served in the json
+        self._trial_history = {}  # panel: deque of (time, trial count)
+        self._cache = {}  # response name: (render time, content type, body)
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='status monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self.listener.close()
+
+    def _run(self):
+        while self._running:
+            for key, boxStatus, changed in self.listener.receive(timeout=1.0):
+                self.update(boxStatus)
+
+    def update(self, box_status):
+        panel = box_status['panel']
+        state = box_status['state']
+        heartbeat = box_status.get('heartbeat') or {}
+        now = time.time()
+
+        with self._lock:
+            box = self.boxes.setdefault(panel, {'panel': panel})
+            box.update(subject=box_status['subject'],
+                       pid=box_status.get('pid'),
+                       ready=box_status.get('ready', False),
+                       last_seen=box_status.get('time', now),
+                       errors=box_status['errors'][-MAX_ERRORS:],
+                       error_count=len(box_status['errors']),
+                       heartbeat=heartbeat or None,
+                       state=heartbeat.get('state'),
+                       interface=heartbeat.get('interface'))
+            if 'message' in state:
+                # the summary's fields are from before the message (e.g. the last session, before sleeping)
+                box.update(message=state['message'], summary=None, phase=None, trials=None, dprime=None,
+                           dprime_nr=None, last_trial_time=None, trial_rate=None)
+            else:
+                box.update(message=None, summary=state,
+                           phase=state.get('phase'),
+                           trials=state.get('trials'),
+                           dprime=state.get('dprime'),
+                           dprime_nr=state.get('dprime_NR'),
+                           last_trial_time=state.get('last_trial_time'))
+                box['trial_rate'] = self._trial_rate(panel, state.get('trials'), now)
+            self._cache.clear()
+
+    def _trial_rate(self, panel, trials, now):
+        # trials per hour over the last RATE_WINDOW. Called with lock held
+        if trials is None:
+            return None
+        history = self._trial_history.setdefault(panel, collections.deque())
+        if history and trials < history[-1][1]:
+            history.clear()  # summary was reset (new day or new run)
+        if not history or trials != history[-1][1]:
+            history.append((now, trials))
+        while len(history) > 1 and history[1][0] < now - RATE_WINDOW:
+            history.popleft()
+        startTime, startTrials = history[0]
+        if startTime < now - RATE_WINDOW or len(history) < 2:
+            # history covers the whole window (or there's only one point): rate over the window
+            elapsed = RATE_WINDOW
+        else:
+            elapsed = max(now - startTime, 60.0)  # don't report huge rates from the first couple of trials
+        return (trials - startTrials) * 3600.0 / elapsed
+
+    def render(self, name):
+        with self._lock:
+            now = time.time()
+            if name not in self._cache or now - self._cache[name][0] > CACHE_TIME:
+                response = self._render(name, now)
+                if response is None:
+                    return None
+                self._cache[name] = (now,) + response
+            return self._cache[name][1:]
+
+    def _render(self, name, generated):
+        # called with lock held
+        if name == 'json':
+            return 'application/json', json.dumps({'generated': generated,
+                                                   'boxes': [self.boxes[panel] for panel in sorted(self.boxes)]})
+        elif name.startswith('box/'):
+            panel = name[len('box/'):]
+            if panel not in self.boxes:
+                return None
+            return 'application/json', json.dumps(dict(self.boxes[panel], generated=generated))
+        elif name == 'html':
+            return 'text/html; charset=utf-8', self._render_html(generated)
+        return None
+
+    def _render_html(self, generated):
+        rows = []
+        for panel in sorted(self.boxes):
+            box = self.boxes[panel]
+            responding = generated - box['last_seen'] < HEARTBEAT_STALE
+            rows.append('<tr class="%s"><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td>'
+                        '<td>%s</td><td>%s</td><td><pre>%s</pre></td></tr>' % (
+                            'ok' if responding else 'stale',
+                            _html(panel),
+                            _html(box.get('subject')),
+                            _html(box.get('state')),
+                            _html(box.get('phase') or box.get('message')),
+                            _html(box.get('trials')),
+                            _number(box.get('trial_rate'), '%.1f'),
+                            _number(box.get('dprime'), '%.2f'),
+                            _html(box.get('last_trial_time')),
+                            _html('\n'.join(box.get('errors') or []))))
+        return ('<!DOCTYPE html><html><head><meta charset="utf-8"><meta http-equiv="refresh" content="10">'
+                '<title>pyoperant</title><style>'
+                'body{font-family:sans-serif}td,th{padding:2px 8px;text-align:left;vertical-align:top}'
+                'tr.stale{color:#999}pre{margin:0;color:#b00;white-space:pre-wrap}'
+                '</style></head><body><h1>pyoperant boxes</h1><table>'
+                '<tr><th>Box</th><th>Subject</th><th>State</th><th>Phase</th><th>Trials</th><th>Trials/h</th>'
+                "<th>d'</th><th>Last trial</th><th>Errors</th></tr>"
+                '%s</table><p>Updated %s</p></body></html>' % (''.join(rows), time.ctime(generated)))
+
+
+def _html(value):
+    return '' if value is None else cgi.escape(unicode(value)).encode('utf-8')
+
+
+def _number(value, fmt):
+    try:
+        return '' if value is None else fmt % value
+    except TypeError:
+        return _html(value)  # not a number, e.g. a summary from another kind of experiment
+
+
+class MonitorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # self.server.monitor is the StatusMonitor to serve
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path in ('/', '/index.html'):
+            name = 'html'
+        elif path == '/status.json':
+            name = 'json'
+        elif path.startswith('/box/') and path.endswith('.json'):
+            name = 'box/' + path[len('/box/'):-len('.json')]
+        else:
+            name = None
+
+        response = self.server.monitor.render(name) if name is not None else None
+        if response is None:
+            self.send_error(404)
+            return
+        contentType, body = response
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug('%s - %s' % (self.address_string(), format % args))
+
+
+class MonitorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server for a StatusMonitor. Each request is handled on its own thread """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, monitor):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MonitorRequestHandler)
+        self.monitor = monitor
+
+
+def serve(host='127.0.0.1', port=8080, status_path=status.STATUS_PATH):
+    """ Runs the monitor until interrupted """
+    monitor = StatusMonitor(status.StatusListener('monitor-%i' % os.getpid(), status_path))
+    monitor.start()
+    server = MonitorServer((host, port), monitor)
+    logging.getLogger(__name__).info('serving box status on http://%s:%i/' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        monitor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve pyoperant box status over HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: localhost only)')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--status-path', default=status.STATUS_PATH, help='status socket folder')
+    args = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO, format='"%(asctime)s","%(levelname)s","%(message)s"')
+    serve(args.host, args.port, args.status_path)
@@ -1,23 +1,117 @@
+import os
 import sys
 import random
+import hashlib
+import logging
+import threading
+import traceback
+import Queue
+from fractions import Fraction, gcd
 from pyoperant.utils import rand_from_log_shape_dist
 import numpy as np
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 if sys.version_info[0] < 3:
     import pickle
 else:
     import _pickle as pickle
 
 
-def random_queue(conditions, tr_max=5000, weights=None, **kwargs):
+class AliasSampler(object):
+    """ Weighted random sampling with Walker's alias method: O(n) to set up, then O(1) (a single random number) per
+    sample, for any non-negative weights, including fractional ones
+
+    Keyword arguments:
+    items -- list of items to sample from
+    weights -- list of weights, same length as items (need not sum to 1)
+    rng -- random.Random to draw from (default: a new one, seeded from the system)
+
+    Methods:
+    sample() -- one item, chosen with probability weight / sum(weights)
+    probability(index) -- probability of sampling items[index]
+    """
+
+    def __init__(self, items, weights, rng=None):
+        self.items = list(items)
+        weights = [float(w) for w in weights]
+        if len(weights) != len(self.items):
+            raise ValueError('got %i weights for %i items' % (len(weights), len(self.items)))
+        if any(not 0 <= w < float('inf') for w in weights):
+            raise ValueError('weights must be non-negative and finite: %s' % weights)
+        total = sum(weights)
+        if total <= 0:
+            raise ValueError('weights must not all be zero')
+        self.rng = rng if rng is not None else random.Random()
+
+        # Vose's construction: scale weights so they average 1, then pair each under-full column with an over-full
+        # one, which tops it up to 1 (its alias)
+        n = len(weights)
+        self._weights = weights
+        self._total = total
+        self._prob = [w * n / total for w in weights]
+        self._alias = list(range(n))
+        small = [i for i, p in enumerate(self._prob) if p < 1]
+        large = [i for i, p in enumerate(self._prob) if p >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self._alias[less] = more
+            self._prob[more] -= 1 - self._prob[less]
+            if self._prob[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        for i in small + large:
+            self._prob[i] = 1.0  # only rounding error left
+
+    def sample(self):
+        x = self.rng.random() * len(self._prob)
+        column = int(x)
+        return self.items[column if x - column < self._prob[column] else self._alias[column]]
+
+    def probability(self, index):
+        return self._weights[index] / self._total
+
+
+def condition_weights(conditions, weights=None):
+    """ Returns list of the relative weight of each condition (not normalized), from class weights and (optional)
+    condition weights
+
+    Each class is chosen with probability proportional to its weight, then a condition within the class with
+    probability proportional to the condition's 'weight' (default 1). Classes not in weights are never chosen. Without
+    class weights, conditions are weighted by their own weights alone.
+
+    weights -- list of {'class': class, 'weight': weight} dicts, or dict of class: weight
+    """
+    conditionWeights = [float(cond.get('weight', 1)) for cond in conditions]
+    if not weights:
+        return conditionWeights
+
+    if isinstance(weights, dict):
+        classWeights = dict((condClass, float(w)) for condClass, w in weights.items())
+    else:
+        classWeights = dict((w['class'], float(w['weight'])) for w in weights)
+    classTotals = {}
+    for cond, w in zip(conditions, conditionWeights):
+        classTotals[cond['class']] = classTotals.get(cond['class'], 0) + w
+    for condClass, w in classWeights.items():
+        if w > 0 and not classTotals.get(condClass):
+            raise ValueError('class %s has weight %s but no conditions to choose from' % (condClass, w))
+
+    return [classWeights.get(cond['class'], 0) * w / classTotals[cond['class']] if w else 0.0
+            for cond, w in zip(conditions, conditionWeights)]
+
+
+def random_queue(conditions, tr_max=5000, weights=None, seed=None, **kwargs):
     """ generator which randomly samples conditions
 
-    If weights are provided, builds two variables:
-        - list of classes, where a class can appear multiple times in the list so that the overall proportion of
-        entries for a class within the list is equal to the probability for that class - it's a weird way of doing
-        weighted class selection since Python 2.7 doesn't have a built-in function for weighted random selection
-        - dict where each class is a single key, and the values for each key are the stimuli that are in that class
-    If weights not provided, just samples randomly from conditions
+    Conditions are sampled with replacement, in proportion to their class weight (if weights are provided) and their
+    own 'weight' key (if present), using AliasSampler. Weights can be any non-negative number, including fractions.
+    If no weights are given, each condition is equally likely.
 
     Args:
 
@@ -25,69 +119,21 @@ def random_queue(conditions, tr_max=5000, weights=None, **kwargs):
 
     Kwargs:
 
-       :param weights: (dict) All classes and their weights
+       :param weights: (list or dict) All classes and their weights, as [{'class': class, 'weight': weight}, ...] or
+                       {class: weight, ...}. Classes not listed are never chosen
        :param tr_max: (int) Maximum number of trial conditions to generate. (default: 5000)
+       :param seed: (hashable) Seed for the random stream; the same seed gives the same sequence. (default: None,
+                    seeded from the system)
 
     Returns:
         whatever the elements of 'conditions' are
 
     """
-    random.seed()
-    if weights:  # Handling weights this way because python 2.7 doesn't have a built-in weighted random function
-
-        classes_weighted = []
-        for w in weights:
-            currWeight = int(w['weight'])
-            for ww in range(currWeight):
-                classes_weighted.append(w['class'])
-        # classes_weighted is a weighted list of classes, so that randomly picking a condition will yield that
-        # condition at the expected probability
-
-        conditionsList = {}
-        for cond in conditions:
-            condClass = cond['class']
-            if condClass not in conditionsList:
-                conditionsList[condClass] = []
-            conditionsList[condClass].append(cond)
-        # conditionsList is a dict with stimuli sorted into classes
-
-        tr_num = 0
-        while tr_num < tr_max:
-            yield random.choice(conditionsList[random.choice(
-                classes_weighted)])  # pick random condition (stim) from weighted random class
-            tr_num += 1
-
-    else:
-        # just randomly pick a condition
-        tr_num = 0
-        while tr_num < tr_max:
-            yield random.choice(conditions)
-
-            tr_num += 1
-
-    # if weights:  # Handling weights this way because python 2.7 doesn't have a built-in weighted random function
-    #
-    #     conditions_weighted = []
-    #
-    #     for cond in conditions:
-    #         for w in weights:   # Compare weight values to condition class
-    #             if cond['class'] == w['class']:
-    #                 currWeight = int(w['weight'])
-    #                 for ww in range(currWeight):
-    #                     conditions_weighted.append(cond)
-    #     conditions = conditions_weighted
-    # tr_num = 0
-    # #     conditions_weighted = []
-    # #     for cond, w in zip(conditions, weights):
-    # #         for ww in range(w):
-    # #             conditions_weighted.append(cond)
-    # #     conditions = conditions_weighted
-    # # tr_num = 0
-    #
-    # while tr_num < tr_max:
-    #     yield random.choice(conditions)
-    #
-    #     tr_num += 1
+    sampler = AliasSampler(conditions, condition_weights(conditions, weights), random.Random(seed))
+    tr_num = 0
+    while tr_num < tr_max:
+        yield sampler.sample()
+        tr_num += 1
 
 
 def block_queue(conditions, reps=1, shuffle=False):
@@ -118,9 +164,266 @@ def block_queue(conditions, reps=1, shuffle=False):
         yield cond
 
 
-def random_queue_no_replacement(conditions, tr_max=5000, weights=None, **kwargs):
-    # TODO: This section
-    pass
+MAX_EPOCH = 1000  # largest epoch random_queue_no_replacement uses to match weights exactly
+
+
+def _epoch_counts(probabilities, epoch_size=None):
+    # Number of times each condition appears in an epoch. Without an epoch size, uses the smallest epoch (up to
+    # MAX_EPOCH) that gives every condition a whole number of presentations; otherwise rounds by largest remainder.
+    # probabilities are relative weights (condition_weights' don't necessarily sum to 1)
+    total = float(sum(probabilities))
+    probabilities = [p / total for p in probabilities]
+    if epoch_size is None:
+        fractions = [Fraction(p).limit_denominator(MAX_EPOCH) for p in probabilities]
+        epoch_size = reduce(lambda a, b: a * b // gcd(a, b), [f.denominator for f in fractions if f], 1)
+        if epoch_size > MAX_EPOCH:
+            epoch_size = MAX_EPOCH
+    exact = [p * epoch_size for p in probabilities]
+    counts = [int(x) for x in exact]
+    for index in sorted(range(len(exact)), key=lambda i: counts[i] - exact[i])[:epoch_size - sum(counts)]:
+        counts[index] += 1
+    assert sum(counts) == epoch_size
+    return counts
+
+
+def _runs_feasible(remaining, max_run, last_class, run):
+    # Whether the remaining conditions (dict of class: count) can be ordered without a run longer than max_run: each
+    # class needs the others to break it into runs, the first of which continues the current run
+    total = sum(remaining.values())
+    for condClass, count in remaining.items():
+        capacity = max_run * (total - count + 1) - (run if condClass == last_class else 0)
+        if count > capacity:
+            return False
+    return True
+
+
+def _limit_runs(row, classes, max_run, carry, rng):
+    # Reorders a shuffled epoch (in place) so no class runs longer than max_run, here or at the start of the next
+    # epoch. The class of each position is drawn in proportion to how many of each class are left, from the classes
+    # that keep the rest of the epoch feasible, followed by another epoch (so an epoch doesn't end in a run the next
+    # one can't break up). Where no class does, runs are kept as short as they can be. Conditions keep their shuffled
+    # order within each class. carry is (class, run length) at the start of the epoch; returns the same at the end
+    lastClass, run = carry
+    byClass = {}
+    for condIndex in row:
+        byClass.setdefault(classes[condIndex], []).append(condIndex)
+    remaining = dict((condClass, len(members)) for condClass, members in byClass.items())
+    epochCounts = dict(remaining)
+    taken = dict((condClass, 0) for condClass in byClass)
+
+    for i in range(len(row)):
+        allowed = []
+        candidates = []
+        for condClass, count in remaining.items():
+            if count == 0 or (condClass == lastClass and run >= max_run):
+                continue
+            allowed.append(condClass)
+            nextRun = run + 1 if condClass == lastClass else 1
+            remaining[condClass] -= 1
+            withNext = dict((c, remaining[c] + epochCounts[c]) for c in remaining)
+            if (_runs_feasible(remaining, max_run, condClass, nextRun)
+                    and _runs_feasible(withNext, max_run, condClass, nextRun)):
+                candidates.append(condClass)
+            remaining[condClass] += 1
+        if not candidates:
+            # max_run can't be kept from here: break the current run if anything else is left
+            candidates = allowed or [condClass for condClass, count in remaining.items() if count]
+        weights = np.array([remaining[condClass] for condClass in candidates], dtype=float)
+        condClass = candidates[np.searchsorted(np.cumsum(weights), rng.random_sample() * weights.sum(), 'right')]
+
+        row[i] = byClass[condClass][taken[condClass]]
+        taken[condClass] += 1
+        remaining[condClass] -= 1
+        run = run + 1 if condClass == lastClass else 1
+        lastClass = condClass
+    return lastClass, run
+
+
+def _shuffled_chunk(base, classes, epochs, max_run, rng, carry):
+    # epochs shuffled copies of base (condition indices), shuffled together in one numpy call. Returns the flattened
+    # chunk and (class, run length) at its end
+    chunk = base[rng.random_sample((epochs, len(base))).argsort(axis=1)]
+    chunkClasses = classes[chunk.ravel()]
+    # run lengths, the first continuing the run carried over from the last chunk
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(chunkClasses)) + 1])
+    runs = np.diff(np.concatenate([starts, [len(chunkClasses)]]))
+    if chunkClasses[0] == carry[0]:
+        runs[0] += carry[1]
+    if max_run and (runs.max() > max_run or
+                    not _runs_feasible(_class_counts(base, classes), max_run, chunkClasses[-1], runs[-1])):
+        for row in chunk:
+            carry = _limit_runs(row, classes, max_run, carry, rng)
+        return chunk.ravel(), carry
+    return chunk.ravel(), (chunkClasses[-1], runs[-1])
+
+
+def _class_counts(base, classes):
+    # dict of class: number of conditions of that class in an epoch
+    values, counts = np.unique(classes[base], return_counts=True)
+    return dict(zip(values, counts))
+
+
+def random_queue_no_replacement(conditions, tr_max=5000, weights=None, max_run=None, epoch_size=None, seed=None,
+                                state_file=None, chunk_trials=1000, **kwargs):
+    """ generator which presents conditions in shuffled epochs
+
+    Each epoch contains every condition in proportion to its weight (class weights and condition 'weight' keys, as in
+    random_queue), shuffled, so conditions are sampled without replacement until the epoch runs out. Epochs are
+    shuffled ahead of time in chunks of about chunk_trials trials.
+
+    Args:
+
+       :param conditions: (list)  The conditions to sample from.
+
+    Kwargs:
+
+       :param weights: (list or dict) All classes and their weights, as for random_queue
+       :param tr_max: (int) Maximum number of trial conditions to generate. (default: 5000)
+       :param max_run: (int) Most conditions of the same class in a row, within and across epochs (default: None, no
+                       limit). Runs are broken up within each epoch, so weights are still kept exactly. A class can't
+                       be more than max_run / (max_run + 1) of the trials; if one is, runs are kept as short as the
+                       weights allow
+       :param epoch_size: (int) Trials per epoch (default: None, the smallest epoch, up to MAX_EPOCH, in which weights
+                          are matched exactly)
+       :param seed: (hashable) Seed for the shuffles (default: None, seeded from the system)
+       :param state_file: (str) json file to keep the queue's place in, so a resumed session carries on with the same
+                          epoch, starting with the condition that was interrupted (default: None, not saved). Ignored if
+                          it was saved with different conditions or settings
+       :param chunk_trials: (int) Number of trials to shuffle at a time (default: 1000)
+
+    Returns:
+        whatever the elements of 'conditions' are
+
+    """
+    counts = _epoch_counts(condition_weights(conditions, weights), epoch_size)
+    base = np.repeat(np.arange(len(conditions)), counts)
+    classNames = sorted(set(cond['class'] for cond in conditions))
+    classes = np.array([classNames.index(cond['class']) for cond in conditions])
+    # epochs follow each other, so each class needs the others to break it up every max_run trials: a class can be at
+    # most max_run / (max_run + 1) of an epoch
+    if max_run and any(count > max_run * (len(base) - count) for count in _class_counts(base, classes).values()):
+        logging.getLogger(__name__).warning("max_run of %i can't be kept with these weights; runs will be kept as "
+                                            "short as they can be" % max_run)
+    epochs = max(1, chunk_trials // len(base))
+
+    # The state only needs the seed and position: a chunk can be shuffled again from the seed and its number
+    key = hashlib.md5(json.dumps([conditions, counts, max_run], sort_keys=True)).hexdigest()
+    state = None
+    if state_file is not None:
+        try:
+            with open(state_file, 'rb') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            pass
+    if state is None or state.get('key') != key:
+        state = {'key': key,
+                 'seed': random.SystemRandom().getrandbits(32) if seed is None else hash(seed) & 0xffffffff,
+                 'chunk': 0,
+                 'position': 0,
+                 'carry': [None, 0]}
+
+    tr_num = 0
+    while True:
+        chunk, carry = _shuffled_chunk(base, classes, epochs, max_run,
+                                       np.random.RandomState([state['seed'], state['chunk']]), tuple(state['carry']))
+        for position in range(state['position'], len(chunk)):
+            if tr_num >= tr_max:
+                return
+            if state_file is not None:
+                state['position'] = position
+                _save_json(state_file, state)
+            yield conditions[chunk[position]]
+            tr_num += 1
+        state.update(chunk=state['chunk'] + 1, position=0, carry=[int(carry[0]), int(carry[1])])
+
+
+def _save_json(filename, obj):
+    # write to temp file then rename, so a crash mid-write can't leave a truncated file
+    tempFile = filename + '.tmp'
+    with open(tempFile, 'wb') as f:
+        json.dump(obj, f)
+    os.rename(tempFile, filename)
+
+
+class PrefetchQueue(object):
+    """ Pulls conditions from a queue ahead of time on a background thread, and prepares each one (e.g. loads its
+    stimulus) while the current trial runs, so the next trial can start straight away
+
+    Only for queues whose conditions don't depend on responses (not AdaptiveBase queues), and which don't save their
+    place (random_queue_no_replacement with a state file would save a place up to lookahead trials ahead).
+
+    Keyword arguments:
+    queue -- iterable of conditions
+    lookahead -- number of conditions to keep ready (default 2)
+    prepare -- function called with each condition on the background thread (default None). If it fails, the
+        condition is still used, and the trial loads whatever it needs itself
+
+    Methods:
+    next() -- the next condition
+    close() -- stop prefetching
+    """
+
+    _DONE = object()
+
+    def __init__(self, queue, lookahead=2, prepare=None):
+        if isinstance(queue, AdaptiveBase):
+            raise ValueError("adaptive queues depend on responses and can't be prefetched")
+        self.log = logging.getLogger(__name__)
+        self.prepare = prepare
+        self._source = iter(queue)
+        self._ready = Queue.Queue(maxsize=lookahead)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def _put(self, item):
+        # waits for space, unless closed. Returns whether item was added
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for condition in self._source:
+                if self.prepare is not None:
+                    try:
+                        self.prepare(condition)
+                    except Exception:
+                        self.log.warning('could not prepare %s: %s' % (condition, traceback.format_exc()))
+                if not self._put(condition):
+                    return
+        except Exception as e:
+            self.log.error('queue failed: %s' % traceback.format_exc())
+            self._put((self._DONE, e))
+            return
+        self._put((self._DONE, None))
+
+    def next(self):
+        # wait with a timeout, as a plain get() can't be interrupted by signals
+        while True:
+            try:
+                item = self._ready.get(timeout=1.0)
+                break
+            except Queue.Empty:
+                pass
+        if isinstance(item, tuple) and len(item) == 2 and item[0] is self._DONE:
+            self._ready.put(item)  # stay finished
+            if item[1] is not None:
+                raise item[1]
+            raise StopIteration
+        return item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(1.0)
 
 
 class AdaptiveBase(object):
@@ -161,6 +464,15 @@ class AdaptiveBase(object):
     def update_error_msg(self):
         return self.update_error_str
 
+    def get_state(self):
+        """ dict of everything update() changes, small enough to save after every trial (see MixedAdaptiveQueue)
+        """
+        return {}
+
+    def set_state(self, state):
+        """ restores a state from get_state() """
+        pass
+
 
 class PersistentBase(object):
     """
@@ -191,8 +503,13 @@ class PersistentBase(object):
             pass
 
     def save(self):
-        with open(self.filename, 'wb') as handle:
-            pickle.dump(self, handle)
+        # write to temp file then rename, so a crash mid-write can't leave a truncated file
+        tempFile = self.filename + '.tmp'
+        with open(tempFile, 'wb') as handle:
+            pickle.dump(self, handle, pickle.HIGHEST_PROTOCOL)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(tempFile, self.filename)
 
 
 class KaernbachStaircase(AdaptiveBase):
@@ -257,6 +574,14 @@ class KaernbachStaircase(AdaptiveBase):
         self.counter += 1 if self.crit_method == 'trials' else 0
         return self.val
 
+    def get_state(self):
+        return {'val': self.val, 'counter': self.counter, 'going_up': self.going_up}
+
+    def set_state(self, state):
+        self.val = state['val']
+        self.counter = state['counter']
+        self.going_up = state['going_up']
+
 
 class DoubleStaircase(AdaptiveBase):
     """
@@ -310,6 +635,13 @@ class DoubleStaircase(AdaptiveBase):
         super(DoubleStaircase, self).no_response()
         self.trial = {}
 
+    def get_state(self):
+        return {'low_idx': self.low_idx, 'high_idx': self.high_idx}
+
+    def set_state(self, state):
+        self.low_idx = state['low_idx']
+        self.high_idx = state['high_idx']
+
     def update_error_msg(self):
         sup = super(DoubleStaircase, self).update_error_msg()
         state = "self.trial.low=%s    self.trial.value=%d    self.low_idx=%d    self.high_idx=%d" % (
@@ -381,6 +713,13 @@ class DoubleStaircaseReinforced(AdaptiveBase):
         super(DoubleStaircaseReinforced, self).on_load()
         self.dblstaircase.on_load()
 
+    def get_state(self):
+        return {'probe_rate': self.probe_rate, 'dblstaircase': self.dblstaircase.get_state()}
+
+    def set_state(self, state):
+        self.probe_rate = state['probe_rate']
+        self.dblstaircase.set_state(state['dblstaircase'])
+
     def update_error_msg(self):
         sup = super(DoubleStaircaseReinforced, self).update_error_msg()
         state = "self.last_probe=%s" % self.last_probe
@@ -389,6 +728,131 @@ class DoubleStaircaseReinforced(AdaptiveBase):
         return "\n".join([sup, state, sub_state])
 
 
+class PsiQueue(AdaptiveBase):
+    """
+    Generates conditions from a list of stims that monotonically vary from most easily left to most easily right
+    (as DoubleStaircase), choosing each stimulus by the Psi method (Kontsevich & Tyler 1999; see also QUEST+), which
+    estimates the whole psychometric function rather than stepping towards the 50% point.
+
+    The probability of a right response to stimulus x is modelled as
+        p(R | x) = lapse / 2 + (1 - lapse) / (1 + exp(-slope * (x - threshold)))
+    with x the stimulus's index in stims. The posterior over a grid of threshold, slope and lapse values is kept as a
+    numpy array. Each trial presents the stimulus that minimizes the expected entropy of the posterior after the
+    response (maximizes expected information gain), computed for every stimulus at once from precomputed likelihood
+    tables, so choosing and updating take a few matrix-vector products per trial.
+
+    stims: an array of stimuli names ordered from most easily left to most easily right
+    boundary: index of the first stimulus rewarded as right (default: the middle of stims). Stims below it are
+        presented as class 'L', the rest as 'R'
+    thresholds, slopes, lapses: parameter grids (default: 41 thresholds across stims, 20 slopes log-spaced from a
+        function spanning all the stims to one spanning about one stim, and lapse rates 0 to 0.1)
+    max_trials: number of trials after which the queue finishes (default: None, no limit)
+    stop_sd: finish when the posterior standard deviation of the threshold (in stims) is below this (default: None)
+    """
+
+    def __init__(self, stims, boundary=None, thresholds=None, slopes=None, lapses=None, max_trials=None,
+                 stop_sd=None, **kwargs):
+        super(PsiQueue, self).__init__(**kwargs)
+        self.stims = stims
+        self.boundary = len(stims) // 2 if boundary is None else boundary
+        self.thresholds = np.linspace(0, len(stims) - 1, 41) if thresholds is None else np.asarray(thresholds, float)
+        self.slopes = (np.logspace(np.log10(4.4 / len(stims)), np.log10(4.4), 20) if slopes is None
+                       else np.asarray(slopes, float))
+        self.lapses = np.linspace(0, .1, 6) if lapses is None else np.asarray(lapses, float)
+        self.max_trials = max_trials
+        self.stop_sd = stop_sd
+        self.posterior = np.ones(len(self.thresholds) * len(self.slopes) * len(self.lapses))
+        self.posterior /= self.posterior.sum()
+        self.n_trials = 0  # responses applied to the posterior
+        self.last_trial = None  # [stim index, responded right] of the latest response
+        self.trial = None  # stim index presented, until updated
+        self.update_error_str = "psi queue %s hasn't been updated since last trial" % (self.stims[0])
+        self._build_tables()
+
+    def _build_tables(self):
+        # Likelihood of a right response for every stimulus (rows) and parameter combination (columns, in posterior
+        # order), with the x*log(x) terms the expected entropy needs
+        threshold, slope, lapse = [a.ravel() for a in np.meshgrid(self.thresholds, self.slopes, self.lapses,
+                                                                    indexing='ij')]
+        x = np.arange(len(self.stims), dtype=float)[:, None]
+        pRight = lapse / 2 + (1 - lapse) / (1 + np.exp(-slope * (x - threshold)))
+        self._p_right = np.clip(pRight, 1e-12, 1 - 1e-12)
+        self._p_left = 1 - self._p_right
+        self._p_right_log = self._p_right * np.log(self._p_right)
+        self._p_left_log = self._p_left * np.log(self._p_left)
+        self._grid = (threshold, slope, lapse)
+
+    def __getstate__(self):
+        # the tables are rebuilt from the grids when loaded
+        state = self.__dict__.copy()
+        for key in ('_p_right', '_p_left', '_p_right_log', '_p_left_log', '_grid'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_tables()
+
+    def expected_entropy(self):
+        """ expected entropy of the posterior after presenting each stimulus (array, one per stim) """
+        post = self.posterior
+        postLog = post * np.log(np.maximum(post, 1e-300))
+        pRight = self._p_right.dot(post)
+        pLeft = 1 - pRight
+        # sum of p*log(p) over the updated (unnormalized) posterior for each response, then normalized
+        sumRight = self._p_right_log.dot(post) + self._p_right.dot(postLog)
+        sumLeft = self._p_left_log.dot(post) + self._p_left.dot(postLog)
+        return pRight * np.log(pRight) + pLeft * np.log(pLeft) - sumRight - sumLeft
+
+    def estimate(self):
+        """ posterior mean and standard deviation of each parameter, as a dict of (mean, sd) """
+        result = {}
+        for name, values in zip(('threshold', 'slope', 'lapse'), self._grid):
+            mean = values.dot(self.posterior)
+            result[name] = (float(mean), float(np.sqrt(((values - mean) ** 2).dot(self.posterior))))
+        return result
+
+    def update(self, correct, no_resp):
+        super(PsiQueue, self).update(correct, no_resp)
+        if self.trial is not None and not no_resp:
+            stimClass = 'L' if self.trial < self.boundary else 'R'
+            self._observe(self.trial, (stimClass == 'R') == bool(correct))
+        self.trial = None
+
+    def _observe(self, stim_index, right):
+        self.posterior *= self._p_right[stim_index] if right else self._p_left[stim_index]
+        self.posterior /= self.posterior.sum()
+        self.n_trials += 1
+        self.last_trial = [int(stim_index), bool(right)]
+
+    def next(self):
+        super(PsiQueue, self).next()
+        if self.max_trials is not None and self.n_trials >= self.max_trials:
+            raise StopIteration
+        if self.stop_sd is not None and self.estimate()['threshold'][1] < self.stop_sd:
+            raise StopIteration
+        self.trial = int(np.argmin(self.expected_entropy()))
+        return {'class': 'L' if self.trial < self.boundary else 'R', 'stim_name': self.stims[self.trial]}
+
+    def no_response(self):
+        super(PsiQueue, self).no_response()
+        self.trial = None
+
+    def get_state(self):
+        # only the latest response: set_state applies it if it's the next one, so states replay in order, and
+        # replaying one already applied does nothing
+        return {'n_trials': self.n_trials, 'last_trial': self.last_trial}
+
+    def set_state(self, state):
+        if state['n_trials'] == self.n_trials + 1:
+            self._observe(*state['last_trial'])
+
+    def update_error_msg(self):
+        sup = super(PsiQueue, self).update_error_msg()
+        state = "self.trial=%s    self.n_trials=%d    estimate=%s" % (self.trial, self.n_trials, self.estimate())
+        return "\n".join([sup, state])
+
+
 class MixedAdaptiveQueue(PersistentBase, AdaptiveBase):
     """
     Generates conditions from multiple adaptive sub queues.
@@ -397,40 +861,149 @@ class MixedAdaptiveQueue(PersistentBase, AdaptiveBase):
     to load a previously saved MixedAdaptiveQueue or generate a new one 
     if the pkl file doesn't exist.
 
+    After each trial, only the updated sub queue's state (see AdaptiveBase.get_state) is appended to a journal
+    (filename + '.journal'), a few bytes rather than pickling the whole queue. Every compact_every updates, and when
+    loaded, the journal is compacted: the whole queue is pickled to filename (atomically) and the journal is cleared.
+    Journal entries are sub queue states rather than trial results, so replaying any of them twice is harmless, and a
+    partly written last entry (from a crash) is ignored.
+
+    Sub queues that finish (raise StopIteration, e.g. a converged staircase) are dropped from the active set, and
+    the rest carry on; the MixedAdaptiveQueue only finishes when all of them have.
+
     sub_queues: a list of adaptive queues
     probabilities: a list of weights with which to sample from sub_queues
-                        should be same length as sub_queues
-                        NotImplemented
+                        should be same length as sub_queues (default: None, all equally likely). Sub queues with
+                        weight 0 are never used
+    max_consecutive: most trials in a row from the same sub queue, while others are active (default: None, no limit)
     filename: filename of pickle to save itself
+    compact_every: number of journal entries between snapshots (default: 100)
     """
 
-    def __init__(self, sub_queues, probabilities=None, **kwargs):
+    compact_every = 100  # class default, for queues pickled before journaling
+
+    def __init__(self, sub_queues, probabilities=None, max_consecutive=None, compact_every=100, **kwargs):
         super(MixedAdaptiveQueue, self).__init__(**kwargs)
+        self.compact_every = compact_every
         self.sub_queues = sub_queues
         self.probabilities = probabilities
+        if probabilities is not None and len(probabilities) != len(sub_queues):
+            raise ValueError('got %i probabilities for %i sub queues' % (len(probabilities), len(sub_queues)))
+        self.max_consecutive = max_consecutive
         self.sub_queue_idx = -1
+        self.consecutive = 0  # trials in a row from sub_queue_idx
+        self.active = [idx for idx in range(len(sub_queues)) if self._weight(idx) > 0]
         self.update_error_str = "MixedAdaptiveQueue hasn't been updated since last trial"
         self.save()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_journal', None)  # open file
+        state.pop('_journal_count', None)
+        state.pop('_positions', None)  # rebuilt from active
+        state.pop('_sampler', None)
+        return state
+
+    def _weight(self, sub_queue_idx):
+        return 1.0 if self.probabilities is None else float(self.probabilities[sub_queue_idx])
+
+    def _choose(self):
+        # Picks an active sub queue by weight. The sampler over the active set is only rebuilt after a sub queue is
+        # dropped
+        if self.probabilities is None:
+            idx = random.choice(self.active)
+        else:
+            if getattr(self, '_sampler', None) is None:
+                self._sampler = AliasSampler(self.active, [self._weight(i) for i in self.active])
+            idx = self._sampler.sample()
+        if (self.max_consecutive and idx == self.sub_queue_idx and self.consecutive >= self.max_consecutive and
+                len(self.active) > 1):
+            others = [i for i in self.active if i != idx]
+            idx = AliasSampler(others, [self._weight(i) for i in others]).sample()
+        return idx
+
+    def drop(self, sub_queue_idx):
+        """ removes a finished sub queue from the active set """
+        if getattr(self, '_positions', None) is None:
+            self._positions = dict((idx, position) for position, idx in enumerate(self.active))
+        # O(1): move the last active queue into the dropped one's place
+        position = self._positions.pop(sub_queue_idx)
+        last = self.active.pop()
+        if last != sub_queue_idx:
+            self.active[position] = last
+            self._positions[last] = position
+        self._sampler = None
+
+    @property
+    def journal_filename(self):
+        return self.filename + '.journal'
+
     def update(self, correct, no_resp):
         super(MixedAdaptiveQueue, self).update(correct, no_resp)
         self.sub_queues[self.sub_queue_idx].update(correct, no_resp)
-        self.save()
+        self.journal(self.sub_queue_idx)
+
+    def journal(self, sub_queue_idx):
+        """ appends the state of a sub queue to the journal, compacting it if it's long enough """
+        if getattr(self, '_journal', None) is None:
+            self._journal = open(self.journal_filename, 'ab')
+        self._journal.write(json.dumps([sub_queue_idx, self.sub_queues[sub_queue_idx].get_state()]) + '\n')
+        self._journal.flush()
+        self._journal_count = getattr(self, '_journal_count', 0) + 1
+        if self._journal_count >= self.compact_every:
+            self.save()
+
+    def replay_journal(self):
+        """ applies the journal's sub queue states, returns the number applied """
+        count = 0
+        try:
+            with open(self.journal_filename, 'rb') as f:
+                for line in f:
+                    try:
+                        sub_queue_idx, state = json.loads(line)
+                    except ValueError:
+                        break  # partly written when the program stopped, always the last line
+                    self.sub_queues[sub_queue_idx].set_state(state)
+                    count += 1
+        except IOError:
+            pass
+        return count
+
+    def save(self):
+        # snapshot, then clear the journal. A crash in between leaves entries the snapshot already includes, which
+        # replay to the same state
+        super(MixedAdaptiveQueue, self).save()
+        if getattr(self, '_journal', None) is not None:
+            self._journal.close()
+            self._journal = None
+        try:
+            os.remove(self.journal_filename)
+        except OSError:
+            pass
+        self._journal_count = 0
 
     def next(self):
         super(MixedAdaptiveQueue, self).next()
-        if self.probabilities is None:
+        while self.active:
+            idx = self._choose()
             try:
-                self.sub_queue_idx = random.randrange(len(self.sub_queues))
-                return self.sub_queues[self.sub_queue_idx].next()
+                condition = self.sub_queues[idx].next()
             except StopIteration:
-                # TODO: deal with subqueue finished, and possibility of all subqueues finishing
-                raise NotImplementedError
-        else:
-            # TODO: support variable probabilities for each sub_queue
-            raise NotImplementedError
+                self.drop(idx)
+                continue
+            self.consecutive = self.consecutive + 1 if idx == self.sub_queue_idx else 1
+            self.sub_queue_idx = idx
+            return condition
+        self.updated = True  # no trial to update
+        raise StopIteration
 
     def on_load(self):
+        if not hasattr(self, 'active'):
+            # pickled before sub queues could finish
+            self.max_consecutive = None
+            self.consecutive = 0
+            self.active = [idx for idx in range(len(self.sub_queues)) if self._weight(idx) > 0]
+        if self.replay_journal():
+            self.save()
         super(MixedAdaptiveQueue, self).on_load()
         for sub_queue in self.sub_queues:
             try:
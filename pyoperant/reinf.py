@@ -1,5 +1,25 @@
+import sys
+import csv
+import argparse
+import numpy as np
 from numpy import random
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class _ReplayTrial(object):
+    # the parts of a trial schedules look at, for replaying responses through consequate()
+    def __init__(self, correct, response):
+        self.correct = bool(correct)
+        self.response = response
+        if response == 'sPlus':
+            self.responseType = 'correct_response' if correct else 'false_alarm'
+        else:
+            self.responseType = 'correct_reject' if correct else 'miss'
+
 
 class BaseSchedule(object):
     """Maintains logic for deciding whether to consequate trials.
@@ -10,6 +30,9 @@ class BaseSchedule(object):
     Methods:
     consequate(trial) -- returns a boolean value based on whether the trial
         should be consequated. Always returns True.
+    consequate_many(correct, response=None, rng=None) -- the same for a sequence of trials at once, continuing the
+        schedule's state: returns a boolean array. correct is an array of whether each trial was correct, response
+        an array of each trial's response ('sPlus', 'sMinus', ...), rng a numpy RandomState (default: numpy.random)
 
     """
 
@@ -23,6 +46,12 @@ class BaseSchedule(object):
         else:
             return True
 
+    def consequate_many(self, correct, response=None, rng=None):
+        # one trial at a time; schedules override this with a vectorized version
+        if response is None:
+            response = [None] * len(correct)
+        return np.array([self.consequate(_ReplayTrial(c, r)) for c, r in zip(correct, response)], dtype=bool)
+
 
 class ContinuousReinforcement(BaseSchedule):
     """Maintains logic for deciding whether to consequate trials.
@@ -46,6 +75,9 @@ class ContinuousReinforcement(BaseSchedule):
         else:
             return True
 
+    def consequate_many(self, correct, response=None, rng=None):
+        return np.ones(len(correct), dtype=bool)
+
 
 class FixedRatioSchedule(BaseSchedule):
     """Maintains logic for deciding whether to consequate trials.
@@ -85,6 +117,19 @@ class FixedRatioSchedule(BaseSchedule):
         else:
             return False
 
+    def consequate_many(self, correct, response=None, rng=None):
+        correct = np.asarray(correct, dtype=bool)
+        if len(correct) == 0:
+            return correct.copy()
+        # number of correct trials in a row up to each trial, continuing the current count
+        index = np.arange(len(correct))
+        lastIncorrect = np.maximum.accumulate(np.where(correct, -1, index))
+        count = index - lastIncorrect
+        count[lastIncorrect < 0] += self.cumulative_correct
+        result = ~correct | (count % self.ratio == 0)
+        self.cumulative_correct = int(count[-1] % self.ratio) if correct[-1] else 0
+        return result
+
     def __unicode__(self):
         return "FR%i" % self.ratio
 
@@ -127,6 +172,9 @@ class GoInterruptSchedule(BaseSchedule):
         else:
             return False
 
+    def consequate_many(self, correct, response=None, rng=None):
+        return np.asarray(response) == 'sPlus'  # hits and false alarms
+
 
 class GoInterruptPercentSchedule(BaseSchedule):
     """Maintains logic for deciding whether to consequate trials.
@@ -160,6 +208,12 @@ class GoInterruptPercentSchedule(BaseSchedule):
         else:
             return False
 
+    def consequate_many(self, correct, response=None, rng=None):
+        rng = random if rng is None else rng
+        correct = np.asarray(correct, dtype=bool)
+        goResponse = np.asarray(response) == 'sPlus'
+        return goResponse & (~correct | (rng.random_sample(len(correct)) < self.prob))
+
 
 class VariableRatioSchedule(FixedRatioSchedule):
     """Maintains logic for deciding whether to consequate trials.
@@ -189,6 +243,51 @@ class VariableRatioSchedule(FixedRatioSchedule):
         self.cumulative_correct = 0
         self.threshold = random.randint(1, 2 * self.ratio)
 
+    def consequate_many(self, correct, response=None, rng=None):
+        # Runs of correct trials are found with numpy; the schedule then only has to step from reward to reward, and
+        # over runs too short for the current threshold
+        rng = random if rng is None else rng
+        correct = np.asarray(correct, dtype=bool)
+        count = len(correct)
+        result = ~correct
+        if count == 0:
+            return result
+        index = np.arange(count)
+        lastIncorrect = np.maximum.accumulate(np.where(correct, -1, index))
+        streak = index - lastIncorrect  # correct trials in a row, ending at each trial
+        # for each trial, the next incorrect trial (where its run ends) and the next correct trial (where a run starts)
+        runEnd = np.minimum.accumulate(np.where(correct, count, index)[::-1])[::-1].tolist() + [count]
+        runStart = np.minimum.accumulate(np.where(correct, index, count)[::-1])[::-1].tolist() + [count]
+
+        thresholds = rng.randint(1, 2 * self.ratio, size=count).tolist()
+        threshold = self.threshold
+        drawn = 0
+        rewards = []
+        # the first reward can come before the first incorrect trial, continuing the current count
+        position = -self.cumulative_correct if correct[0] else 0
+        while position < count:
+            end = runEnd[max(position, 0)]
+            if position + threshold <= end:
+                rewards.append(position + threshold - 1)
+                position += threshold
+                threshold = thresholds[drawn]
+                drawn += 1
+            else:
+                position = runStart[end]
+        self.threshold = threshold
+        result[rewards] = True
+
+        # count at the end
+        if not correct[-1]:
+            self.cumulative_correct = 0
+        elif rewards:
+            self.cumulative_correct = min(count - 1 - rewards[-1], int(streak[-1]))
+        elif lastIncorrect[-1] < 0:
+            self.cumulative_correct += count
+        else:
+            self.cumulative_correct = int(streak[-1])
+        return result
+
     def __unicode__(self):
         return "VR%i" % self.ratio
 
@@ -218,5 +317,229 @@ class PercentReinforcement(BaseSchedule):
         else:
             return True
 
+    def consequate_many(self, correct, response=None, rng=None):
+        rng = random if rng is None else rng
+        correct = np.asarray(correct, dtype=bool)
+        return ~correct | (rng.random_sample(len(correct)) < self.prob)
+
     def __unicode__(self):
         return "PR%i" % self.prob
+
+
+def schedule_from_config(reinforcement=None):
+    """ Returns the schedule for a block's 'reinforcement' parameters (see behavior/config_guide): 'schedule' is
+    variable_ratio or fixed_ratio (with 'ratio'), percent_reinf or go_interrupt (with 'prob'), or anything else for
+    continuous reinforcement """
+    if reinforcement is None:
+        return ContinuousReinforcement()
+    schedule = reinforcement.get('schedule')
+    if schedule == 'variable_ratio':
+        return VariableRatioSchedule(ratio=reinforcement['ratio'])
+    elif schedule == 'fixed_ratio':
+        return FixedRatioSchedule(ratio=reinforcement['ratio'])
+    elif schedule == 'percent_reinf':
+        return PercentReinforcement(prob=reinforcement['prob'])
+    elif schedule == 'go_interrupt':
+        return GoInterruptPercentSchedule(prob=reinforcement['prob'])
+    else:
+        return ContinuousReinforcement()
+
+
+# region Simulation
+# Replays go/nogo trials (recorded or synthetic) through schedules to estimate how much water each gives, without
+# running birds.
+#
+# usage: python -m pyoperant.reinf config.json [trialdata.csv ...] [--synthetic 5000 --hit-rate .8 ...]
+#   config.json is a list of 'reinforcement' dicts, or a block design (each block's reinforcement is simulated). The
+#   water each reward gives is its class's reward_value in the config's 'classes', if it has them
+
+DEFAULT_REWARD_VALUES = {'sPlus': 1.0}  # only hits give water, when there are no reward values
+
+def water_deliveries(schedule, classes, responses, passive=False, rng=None, reward_values=None):
+    """ Returns a boolean array of which trials give water when replayed through schedule, following go_nogo_interrupt:
+    only trials with a response are consequated (in order, so the schedule's state carries from one to the next), and
+    are rewarded if correct and consequated; sPlus trials without a response are rewarded only with passive reward.
+    Probe and error trials give nothing, and nor do rewards of classes whose reward_value is 0 (e.g. correct rejects).
+
+    classes, responses -- arrays of each trial's class ('sPlus', 'sMinus', ...) and response ('sPlus', 'sMinus', 'none')
+    reward_values -- dict of class: reward_value, as in the config's 'classes' (default: sPlus 1, others 0)
+    """
+    consequated, correct, responses, passiveTrials = _replay_trials(classes, responses)
+    water = np.zeros(len(classes), dtype=bool)
+    water[consequated] = schedule.consequate_many(correct, responses, rng) & correct
+    if passive:
+        water[passiveTrials] = True
+    return water & (_trial_values(classes, reward_values) > 0)
+
+
+def _trial_values(classes, reward_values):
+    # each trial's reward_value (a reward of 0, e.g. for a correct reject, gives no water)
+    if reward_values is None:
+        reward_values = DEFAULT_REWARD_VALUES
+    return np.array([float(reward_values.get(c, 0.0)) for c in classes])
+
+
+def _replay_trials(classes, responses):
+    # (indices of the trials that are consequated, whether each was correct, their responses, indices of the trials
+    # that get passive reward)
+    classes = np.asarray(classes)
+    responses = np.asarray(responses)
+    scored = ((classes == 'sPlus') | (classes == 'sMinus')) & (responses != 'ERR')
+    responded = (responses == 'sPlus') | (responses == 'sMinus')
+    consequated = np.flatnonzero(scored & responded)
+    correct = (classes[consequated] == 'sPlus') == (responses[consequated] == 'sPlus')
+    return consequated, correct, responses[consequated], np.flatnonzero(scored & ~responded & (classes == 'sPlus'))
+
+
+def synthetic_trials(count, splus=0.5, hit_rate=0.8, fa_rate=0.2, no_response=0.1, rng=None):
+    """ Returns (classes, responses) arrays of count go/nogo trials: sPlus trials with probability splus, answered
+    'sPlus' with probability hit_rate (sPlus trials) or fa_rate (sMinus trials), and otherwise 'none' with probability
+    no_response, else 'sMinus' """
+    rng = random if rng is None else rng
+    isPlus = rng.random_sample(count) < splus
+    go = rng.random_sample(count) < np.where(isPlus, hit_rate, fa_rate)
+    silent = rng.random_sample(count) < no_response
+    classes = np.where(isPlus, 'sPlus', 'sMinus')
+    responses = np.where(go, 'sPlus', np.where(silent, 'none', 'sMinus'))
+    return classes, responses
+
+
+def trials_from_csv(filenames):
+    """ Returns (classes, responses, days) arrays from trial data csv files, in order. days is each trial's date """
+    classes, responses, days = [], [], []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for row in csv.DictReader(f):
+                classes.append(row['class_'])
+                responses.append(row['response'])
+                days.append(row.get('time', '')[:10])
+    return np.array(classes), np.array(responses), np.array(days)
+
+
+def simulate_water(configs, classes, responses, days=None, trials_per_day=None, repeats=20, reward_values=None,
+                   seed=None):
+    """ Simulates each reinforcement config (a block's 'reinforcement' dict) over the same trials. Returns a list of
+    dicts with the config, and the mean and standard deviation over repeats of: rewards (number of water deliveries)
+    and water (sum of their reward_values), in total and per day
+
+    days -- each trial's date, to count days; otherwise trials_per_day (default: all trials are one day)
+    reward_values -- dict of class: reward_value, as in the config's 'classes' (default: sPlus 1, others 0). Rewards
+        of classes with a value of 0 (e.g. correct rejects) aren't water deliveries
+    """
+    rng = np.random.RandomState(seed)
+    classes = np.asarray(classes)
+    if days is not None:
+        dayCount = len(set(days))
+    elif trials_per_day:
+        dayCount = len(classes) / float(trials_per_day)
+    else:
+        dayCount = 1.0
+    values = _trial_values(classes, reward_values)
+    # as water_deliveries, but the trials are only sorted out once
+    consequated, correct, consequatedResponses, passiveTrials = _replay_trials(classes, responses)
+    consequatedValues = values[consequated] * correct
+
+    rewards = np.empty((len(configs), repeats))
+    water = np.empty((len(configs), repeats))
+    schedules = [schedule_from_config(config) for config in configs]
+    # variable ratio schedules are stepped through reward by reward, so they're all simulated together
+    variable = [i for i, schedule in enumerate(schedules) if isinstance(schedule, VariableRatioSchedule)]
+    if variable:
+        ratios = np.repeat([schedules[i].ratio for i in variable], repeats)
+        chainRewards, chainWater = _variable_ratio_chains(ratios, correct, consequatedValues, rng)
+        rewards[variable] = chainRewards.reshape(len(variable), repeats)
+        water[variable] = chainWater.reshape(len(variable), repeats)
+    for i in sorted(set(range(len(configs))) - set(variable)):
+        for repeat in range(repeats):
+            delivered = schedule_from_config(configs[i]).consequate_many(correct, consequatedResponses, rng) & correct
+            rewards[i, repeat] = np.count_nonzero(delivered & (consequatedValues > 0))
+            water[i, repeat] = np.dot(delivered, consequatedValues)
+
+    results = []
+    for config, configRewards, configWater in zip(configs, rewards, water):
+        if config and config.get('passive', False):
+            configRewards += np.count_nonzero(values[passiveTrials])
+            configWater += values[passiveTrials].sum()
+        results.append({'config': config,
+                        'rewards': configRewards.mean(),
+                        'rewards_sd': configRewards.std(),
+                        'rewards_per_day': configRewards.mean() / dayCount,
+                        'water': configWater.mean(),
+                        'water_sd': configWater.std(),
+                        'water_per_day': configWater.mean() / dayCount})
+    return results
+
+
+def _variable_ratio_chains(ratios, correct, values, rng):
+    # Runs a new VariableRatioSchedule for each ratio through the same trials, all at once: every step, each schedule
+    # either gets its next reward in the current run of correct trials, or moves on to the next run. Returns arrays of
+    # the number of rewards (of trials with a value), and the sum of values of the rewarded trials, for each schedule
+    count = len(correct)
+    index = np.arange(count)
+    runEnd = np.append(np.minimum.accumulate(np.where(correct, count, index)[::-1])[::-1], count)
+    runStart = np.append(np.minimum.accumulate(np.where(correct, index, count)[::-1])[::-1], count)
+    values = np.append(values, 0.0)
+
+    ratios = np.asarray(ratios)
+    chains = np.arange(len(ratios))
+    # thresholds are drawn from [1, 2 * ratio) as VariableRatioSchedule._update does (randint takes one high only)
+    threshold = 1 + (rng.random_sample(len(ratios)) * (2 * ratios - 1)).astype(int)
+    position = np.zeros(len(ratios), dtype=int)
+    rewards = np.zeros(len(ratios))
+    water = np.zeros(len(ratios))
+    while len(chains):
+        end = runEnd[position]
+        hit = position + threshold <= end
+        reward = position[hit] + threshold[hit] - 1
+        rewards[chains[hit]] += values[reward] > 0
+        water[chains[hit]] += values[reward]
+        position = np.where(hit, position + threshold, runStart[end])
+        threshold[hit] = 1 + (rng.random_sample(len(reward)) * (2 * ratios[hit] - 1)).astype(int)
+        # drop the schedules that have reached the end
+        active = position < count
+        if not active.all():
+            chains, position, threshold, ratios = chains[active], position[active], threshold[active], ratios[active]
+    return rewards, water
+# endregion
+
+
+def main(arg_str=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Estimate water delivered by reinforcement schedules')
+    parser.add_argument('config', help="json list of 'reinforcement' dicts, or a block design")
+    parser.add_argument('trialdata', nargs='*', help='trial data csv files to replay')
+    parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic trials, if no trial data')
+    parser.add_argument('--hit-rate', type=float, default=0.8)
+    parser.add_argument('--fa-rate', type=float, default=0.2)
+    parser.add_argument('--no-response', type=float, default=0.1)
+    parser.add_argument('--trials-per-day', type=float, default=None, help='for synthetic trials')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(arg_str)
+
+    with open(args.config, 'rb') as f:
+        config = json.load(f)
+    rewardValues = None
+    if isinstance(config, dict):
+        blocks = config.get('block_design', config).get('blocks', config)
+        configs = [block.get('reinforcement') for block in blocks.values()]
+        if 'classes' in config:
+            rewardValues = dict((name, cls.get('reward_value', 0.0)) for name, cls in config['classes'].items())
+    else:
+        configs = config
+
+    if args.trialdata:
+        classes, responses, days = trials_from_csv(args.trialdata)
+    else:
+        classes, responses = synthetic_trials(args.synthetic or 5000, hit_rate=args.hit_rate, fa_rate=args.fa_rate,
+                                              no_response=args.no_response, rng=np.random.RandomState(args.seed))
+        days = None
+
+    for result in simulate_water(configs, classes, responses, days, args.trials_per_day, args.repeats,
+                                 reward_values=rewardValues, seed=args.seed):
+        print('%s\n  rewards: %.1f (sd %.1f), %.1f per day\n  water: %.1f (sd %.1f), %.1f per day' % (
+            json.dumps(result['config'], sort_keys=True), result['rewards'], result['rewards_sd'],
+            result['rewards_per_day'], result['water'], result['water_sd'], result['water_per_day']))
+
+
+if __name__ == '__main__':
+    main()
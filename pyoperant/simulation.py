@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import wave
+import datetime
+import argparse
+import tempfile
+import thread
+import importlib
+import collections
+import logging
+import numpy as np
+from pyoperant import hwio, components, panels, queues, SimulationEnd
+from pyoperant.interfaces import simulated_
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Offline simulation: runs an experiment (GoNoGoInterruptExp, the shapers, ...) on a SimulatedPanel, with an agent
+# standing in for the bird, against a virtual clock, so days of sessions run in seconds without a box. Useful for
+# benchmarking the trial loop, trying out block designs and auto_advance criteria, and catching regressions.
+#
+# While the clock is installed it replaces time.time, time.sleep and datetime.datetime (now() and today()), so
+# utils.wait, polls, ITIs, light and session schedules all run on simulated time, and waiting advances the clock
+# instantly. Only sleeps on the thread that installed the clock advance it; other threads (e.g. the heartbeat) sleep
+# for real. The simulation ends when the clock reaches its end time, by raising errors.SimulationEnd from whatever
+# was waiting.
+#
+# usage: python -m pyoperant.simulation config.json [--days 7] [--protocol GoNoGoInterruptExp] [--hit-rate 0.8] ...
+#   Trial data, logs and settings are written to --experiment-path (default: a new temporary folder). Silent
+#   placeholder stimuli are written for any stimulus files that don't exist.
+
+_real_time = time.time
+_real_sleep = time.sleep
+_real_datetime = datetime.datetime
+TWO_ALT_CHOICE_PROTOCOLS = ['TwoAltChoiceExp']  # run with a TwoAltChoiceAgent; other protocols get a GoNoGoAgent
+# compiled modules that check datetime.datetime's size when they're imported (and crash on the virtual one), so they're
+# imported before the clock is installed. pandas is otherwise imported lazily, e.g. by analysis in the middle of a run
+_DATETIME_MODULES = ['pandas']
+
+
+class _VirtualDatetimeType(type):
+    # real datetimes are instances of the virtual datetime class too, so isinstance checks still work while it's
+    # installed
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, _real_datetime)
+
+    def __subclasscheck__(cls, subclass):
+        return issubclass(subclass, _real_datetime)
+
+
+class VirtualClock(object):
+    """Simulated time, for running experiments faster than real time
+
+    Keyword arguments:
+    start -- datetime the clock starts at (default: now)
+    end -- datetime, or seconds after start, at which waiting raises errors.SimulationEnd (default: never)
+
+    Methods:
+    time() -- seconds since the epoch, like time.time()
+    now() -- current datetime
+    sleep(seconds) -- advances the clock (on the installing thread; sleeps for real on others)
+    advance(seconds) -- advances the clock
+    install() -- replace time.time, time.sleep and datetime.datetime with the clock's
+    uninstall() -- put back the real ones
+
+    Can be used as a context manager, which installs the clock.
+    """
+
+    def __init__(self, start=None, end=None):
+        self.log = logging.getLogger(__name__)
+        start = start if start is not None else _real_datetime.now()
+        self._time = _timestamp(start)
+        if isinstance(end, (int, float)):
+            self.end = self._time + end
+        else:
+            self.end = _timestamp(end) if end is not None else None
+        self._thread = None  # ident of the installing thread
+        self._installed = None
+
+    def time(self):
+        return self._time
+
+    def now(self):
+        return _real_datetime.fromtimestamp(self._time)
+
+    def advance(self, seconds):
+        self._time += max(seconds, 0.0)
+        if self.end is not None and self._time >= self.end:
+            self._time = self.end
+            raise SimulationEnd('simulated time is up')
+        if self._time == float('inf'):
+            raise SimulationEnd('waiting forever')
+
+    def sleep(self, seconds):
+        if self._thread is not None and thread.get_ident() != self._thread:
+            _real_sleep(seconds)
+        else:
+            self.advance(seconds)
+
+    def install(self):
+        if self._installed is not None:
+            return
+        for name in _DATETIME_MODULES:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+        clock = self
+
+        class VirtualDatetime(_real_datetime):
+            __metaclass__ = _VirtualDatetimeType
+
+            @classmethod
+            def now(cls, tz=None):
+                if tz is not None:
+                    return tz.fromutc(_real_datetime.utcfromtimestamp(clock.time()).replace(tzinfo=tz))
+                return clock.now()
+
+            @classmethod
+            def today(cls):
+                return clock.now()
+
+        self._thread = thread.get_ident()
+        self._installed = (time.time, time.sleep, datetime.datetime)
+        time.time = self.time
+        time.sleep = self.sleep
+        datetime.datetime = VirtualDatetime
+
+    def uninstall(self):
+        if self._installed is None:
+            return
+        time.time, time.sleep, datetime.datetime = self._installed
+        self._installed = None
+        self._thread = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.uninstall()
+
+
+def _timestamp(value):
+    # seconds since the epoch (local time) from a datetime
+    return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+
+# region Agents
+class BaseAgent(object):
+    """A simulated subject: decides when to peck. This one starts a trial every trial_interval seconds on average
+    (and pecks any port being polled, e.g. in shaping, as often), and never responds to stimuli
+
+    Keyword arguments:
+    trial_interval -- mean time (s) between pecks on a polled port (exponentially distributed)
+    seed -- random seed
+
+    Methods:
+    peck_delay(channel, now) -- seconds until the next peck on an input channel that's being polled, or None for none
+    respond(stimulus, now) -- seconds from the start of a stimulus (wav file name) until a response peck, or None for
+        no response. Can also return (seconds, channel) to peck an input other than the panel's response port
+    output(channel, value, now) -- called when a panel output changes (e.g. 'water' turning on), for agents that learn
+    """
+
+    def __init__(self, trial_interval=20.0, seed=None):
+        self.trial_interval = trial_interval
+        self.rng = np.random.RandomState(seed)
+
+    def peck_delay(self, channel, now):
+        return self.rng.exponential(self.trial_interval)
+
+    def respond(self, stimulus, now):
+        return None
+
+    def output(self, channel, value, now):
+        pass
+
+
+class GoNoGoAgent(BaseAgent):
+    """A subject with a fixed performance on a go/nogo task: responds to S+ stimuli with probability hit_rate, S-
+    stimuli with probability fa_rate and anything else (probes) with probability probe_rate, after a normally
+    distributed reaction time
+
+    Keyword arguments:
+    stimulus_classes -- dict of stimulus file: class (see stimulus_classes()). If None, simulate() fills it in from the
+        experiment
+    hit_rate, fa_rate, probe_rate -- response probabilities
+    rt_mean, rt_sd -- reaction time (s from the start of the stimulus)
+    trial_interval, seed -- as BaseAgent
+
+    Attributes:
+    water -- number of times the water valve was opened
+    """
+
+    def __init__(self, stimulus_classes=None, hit_rate=0.8, fa_rate=0.2, probe_rate=0.5, rt_mean=1.0, rt_sd=0.3,
+                 *args, **kwargs):
+        super(GoNoGoAgent, self).__init__(*args, **kwargs)
+        self.stimulus_classes = stimulus_classes
+        self.rates = {'sPlus': hit_rate, 'sMinus': fa_rate}
+        self.probe_rate = probe_rate
+        self.rt_mean = rt_mean
+        self.rt_sd = rt_sd
+        self.water = 0
+
+    def respond(self, stimulus, now):
+        rate = self.rates.get((self.stimulus_classes or {}).get(stimulus), self.probe_rate)
+        if self.rng.random_sample() < rate:
+            return max(self.rng.normal(self.rt_mean, self.rt_sd), 0.05)
+        return None
+
+    def output(self, channel, value, now):
+        if channel == 'water' and value:
+            self.water += 1
+
+
+class TwoAltChoiceAgent(BaseAgent):
+    """A subject with a fixed performance on a two-alternative choice task: responds to a stimulus with probability
+    response_rate, on its class's port with probability accuracy and on another class's port otherwise, after a
+    normally distributed reaction time
+
+    Keyword arguments:
+    stimulus_classes -- dict of stimulus file: class (see stimulus_classes()). If None, simulate() fills it in
+    ports -- dict of class: input channel its responses are pecks on (see class_ports()). If None, simulate() fills it
+        in from the experiment's classes
+    accuracy, response_rate -- response probabilities
+    rt_mean, rt_sd -- reaction time (s from the start of the stimulus)
+    trial_interval, seed -- as BaseAgent
+    """
+
+    def __init__(self, stimulus_classes=None, ports=None, accuracy=0.8, response_rate=0.9, rt_mean=1.0, rt_sd=0.3,
+                 *args, **kwargs):
+        super(TwoAltChoiceAgent, self).__init__(*args, **kwargs)
+        self.stimulus_classes = stimulus_classes
+        self.ports = ports
+        self.accuracy = accuracy
+        self.response_rate = response_rate
+        self.rt_mean = rt_mean
+        self.rt_sd = rt_sd
+
+    def respond(self, stimulus, now):
+        ports = self.ports or {}
+        class_ = (self.stimulus_classes or {}).get(stimulus)
+        if not ports or self.rng.random_sample() >= self.response_rate:
+            return None
+        others = sorted(channel for other, channel in ports.items() if other != class_)
+        if class_ in ports and (not others or self.rng.random_sample() < self.accuracy):
+            channel = ports[class_]
+        else:
+            channel = others[self.rng.randint(len(others))]
+        return max(self.rng.normal(self.rt_mean, self.rt_sd), 0.05), channel
+
+
+def stimulus_classes(parameters):
+    """ dict of stimulus file: class, from an experiment's block design and stims (after the experiment has made the
+    stimulus file names full paths) """
+    classes = {}
+    stims = parameters.get('stims', {})
+    for block in parameters.get('block_design', {}).get('blocks', {}).values():
+        conditions = list(block.get('conditions', []))
+        for stimList in block.get('stim_lists', []):  # adaptive queues' conditions
+            conditions.extend(stimList if isinstance(stimList, list) else [])
+        for condition in conditions:
+            if isinstance(condition, dict) and 'stim_name' in condition and condition['stim_name'] in stims:
+                classes[stims[condition['stim_name']]] = condition.get('class')
+    return classes
+
+
+def class_ports(parameters, panel):
+    """ dict of class: input channel of the class's component (its peck port) on a SimulatedPanel """
+    ports = {}
+    for class_, classParameters in parameters.get('classes', {}).items():
+        component = getattr(panel, classParameters.get('component', ''), None)
+        if isinstance(component, components.PeckPort):
+            ports[class_] = component.IR.params['channel']
+    return ports
+# endregion
+
+
+class SimulatedPanel(panels.BasePanel):
+    """A box with go/nogo peck ports (trialSens, respSens), two-alternative choice peck ports (center, left, right)
+    and cue light, house light, water valve and speaker, on a simulated_.SimulatedInterface
+
+    Keyword arguments:
+    agent -- simulated subject (see BaseAgent)
+    clock -- VirtualClock to run on
+    """
+
+    def __init__(self, agent, clock, *args, **kwargs):
+        super(SimulatedPanel, self).__init__(*args, **kwargs)
+        self.agent = agent
+        self.clock = clock
+        self.interfaces['simulated'] = simulated_.SimulatedInterface(clock, agent)
+
+        for in_chan in ['trial', 'response', 'center', 'left', 'right']:
+            self.inputs.append(hwio.BooleanInput(interface=self.interfaces['simulated'],
+                                                 params={'channel': in_chan}))
+        for out_chan in ['trial_led', 'response_led', 'house_light', 'water', 'center_led', 'left_led', 'right_led',
+                         'cue_red', 'cue_green', 'cue_blue']:
+            self.outputs.append(hwio.BooleanOutput(interface=self.interfaces['simulated'],
+                                                   params={'channel': out_chan}))
+
+        self.speaker = hwio.AudioOutput(interface=self.interfaces['simulated'])
+        self.trialSens = components.PeckPort(ir=self.inputs[0], led=self.outputs[0])
+        self.respSens = components.PeckPort(ir=self.inputs[1], led=self.outputs[1])
+        self.house_light = components.HouseLight(light=self.outputs[2])
+        self.water = components.WaterValve(solenoid=self.outputs[3])
+        self.center = components.PeckPort(ir=self.inputs[2], led=self.outputs[4])
+        self.left = components.PeckPort(ir=self.inputs[3], led=self.outputs[5])
+        self.right = components.PeckPort(ir=self.inputs[4], led=self.outputs[6])
+        self.cue = components.RGBLight(red=self.outputs[7], green=self.outputs[8], blue=self.outputs[9])
+
+        self.reward = self.water.reward
+        self.punish = self.house_light.punish
+
+    def reset(self):
+        for output in self.outputs:
+            output.write(False)
+        self.house_light.on()
+        self.water.off()
+
+
+def placeholder_stimuli(parameters, stim_path, duration=1.0, rate=44100):
+    """ Writes a silent wav file for each of an experiment's stims that doesn't exist in stim_path. Returns the list
+    of files written """
+    written = []
+    for filename in parameters.get('stims', {}).values():
+        path = os.path.join(stim_path, filename)
+        if os.path.exists(path):
+            continue
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        wavFile = wave.open(path, 'wb')
+        wavFile.setparams((1, 2, rate, 0, 'NONE', 'not compressed'))
+        wavFile.writeframes('\x00\x00' * int(rate * duration))
+        wavFile.close()
+        written.append(path)
+    return written
+
+
+def simulate(protocol, parameters, experiment_path, days=7.0, start=None, agent=None, stim_path=None,
+             subject='simulated', seed=None, before_run=None):
+    """ Runs an experiment on a SimulatedPanel for days of simulated time. Returns the experiment, with its trials,
+    summary, data files and panel (see SimulatedPanel; panel.interfaces['simulated'] has the output counts)
+
+    protocol -- experiment class (e.g. GoNoGoInterruptExp)
+    parameters -- the experiment's parameters, as in a config file
+    experiment_path -- folder for the experiment's data and logs
+    start -- datetime the simulation starts at (default: midnight today)
+    agent -- simulated subject (default: a GoNoGoAgent)
+    stim_path -- stimulus folder (default <experiment_path>/stims)
+    before_run -- function called with the experiment just before it runs, e.g. to instrument it
+    """
+    if start is None:
+        start = _real_datetime.combine(datetime.date.today(), datetime.time())
+    if stim_path is None:
+        stim_path = os.path.join(experiment_path, 'stims')
+    clock = VirtualClock(start, days * 24 * 3600.0)
+    if agent is None:
+        agent = GoNoGoAgent(seed=seed)
+    with clock:
+        panel = SimulatedPanel(agent, clock)
+        experiment = protocol(panel=panel, subject=subject, panel_name='simulated', experiment_path=experiment_path,
+                              stim_path=stim_path, **parameters)
+        if getattr(agent, 'stimulus_classes', False) is None:
+            # the experiment has worked out its stimulus files by now
+            agent.stimulus_classes = stimulus_classes(experiment.parameters)
+        if getattr(agent, 'ports', False) is None:
+            agent.ports = class_ports(experiment.parameters, panel)
+        if before_run is not None:
+            before_run(experiment)
+        try:
+            experiment.run()
+        except SimulationEnd:
+            pass
+        finally:
+            experiment.heartbeat.stop()
+            if isinstance(getattr(experiment, 'trial_q', None), queues.PrefetchQueue):
+                experiment.trial_q.close()
+    return experiment
+
+
+def main(arg_str=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Run a pyoperant experiment on a simulated box and subject')
+    parser.add_argument('config', help='experiment config file (as used by behave)')
+    parser.add_argument('--protocol', default='GoNoGoInterruptExp')
+    parser.add_argument('--days', type=float, default=7.0, help='simulated days (default: %(default)s)')
+    parser.add_argument('--start', default=None, help='simulated start date, YYYY-MM-DD (default: today)')
+    parser.add_argument('--experiment-path', default=None, help='folder for data (default: new temporary folder)')
+    parser.add_argument('--stim-path', default=None, help='stimulus folder (default: <experiment path>/stims)')
+    parser.add_argument('--hit-rate', type=float, default=0.8)
+    parser.add_argument('--fa-rate', type=float, default=0.2)
+    parser.add_argument('--accuracy', type=float, default=0.8, help='two-alternative choice protocols only')
+    parser.add_argument('--trial-interval', type=float, default=20.0, help='mean s between trials')
+    parser.add_argument('--seed', type=int, default=None,
+                        help="the subject's random seed (set blocks' seed for a repeatable trial order)")
+    args = parser.parse_args(arg_str)
+
+    from pyoperant import behavior
+    with open(args.config, 'rb') as f:
+        parameters = json.load(f, object_pairs_hook=collections.OrderedDict)
+    for key in ['subject', 'panel_name', 'experiment_path', 'stim_path']:
+        parameters.pop(key, None)
+    experimentPath = args.experiment_path or tempfile.mkdtemp(prefix='pyoperant_simulation_')
+    stimPath = args.stim_path or os.path.join(experimentPath, 'stims')
+    placeholder_stimuli(parameters, stimPath)
+    # TwoAltChoiceExp isn't run by behave, but can be simulated
+    modules = dict(behavior.PROTOCOLS, TwoAltChoiceExp='pyoperant.behavior.two_alt_choice')
+    protocol = getattr(importlib.import_module(modules.get(args.protocol, 'pyoperant.behavior')), args.protocol)
+    start = _real_datetime.strptime(args.start, '%Y-%m-%d') if args.start else None
+    if args.protocol in TWO_ALT_CHOICE_PROTOCOLS:
+        agent = TwoAltChoiceAgent(accuracy=args.accuracy, trial_interval=args.trial_interval, seed=args.seed)
+    else:
+        agent = GoNoGoAgent(hit_rate=args.hit_rate, fa_rate=args.fa_rate, trial_interval=args.trial_interval,
+                            seed=args.seed)
+
+    realStart = _real_time()
+    experiment = simulate(protocol, parameters, experimentPath, args.days, start, agent, stimPath, seed=args.seed)
+    elapsed = _real_time() - realStart
+
+    print('%s days simulated in %.1f s: %i trials, %i rewarded, %i punished\n  data in %s' % (
+        args.days, elapsed, len(experiment.trials), sum(bool(trial.reward) for trial in experiment.trials),
+        sum(bool(trial.punish) for trial in experiment.trials), experimentPath))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import errno
+import select
+import socket
+import tempfile
+import time
+import threading
+import collections
+import logging
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    from pyoperant.local import STATUS_PATH
+except ImportError:
+    STATUS_PATH = os.path.join(tempfile.gettempdir(), 'pyoperant_status')
+
+# Live box status, pushed from each running experiment to any listening process (e.g. the GUI)
+#
+# Every listener binds a Unix datagram socket ('<name>.sock') in STATUS_PATH. Publishers send each status change to
+# every socket in that folder, so there's no server to run and a publisher with no listeners costs almost nothing.
+# Sends never block: if a listener is gone or its queue is full the message is just dropped for that listener.
+#
+# Messages are json objects with 'subject', 'panel', 'pid', 'seq' (per publisher, increases by 1 with each message)
+# and 'type':
+#   'full' -- 'state' (the complete status dict), 'errors' (list of the latest error messages), 'ready' and 'heartbeat'
+#   'delta' -- 'set' (dict of changed status fields) and 'unset' (list of removed status fields)
+#   'error' -- 'error' (one new error message, shortened to MAX_ERROR_LENGTH)
+#   'ready' -- no other fields. Handshake sent once the experiment has started up (hardware connected, settings saved)
+#   'heartbeat' -- 'heartbeat' (dict of Heartbeat fields). Sent every few seconds while the experiment runs
+# A listener that misses a message (gap in 'seq') ignores deltas from that publisher until the next full snapshot,
+# which is sent periodically, and to any listener that wasn't there (or dropped a message) at the last send
+
+SOCKET_EXTENSION = '.sock'
+MAX_MESSAGE_SIZE = 65536
+MAX_ERRORS = 20  # latest errors kept for full snapshots
+MAX_ERROR_LENGTH = 2000  # characters of an error message sent; the rest of the start is cut (tracebacks end usefully)
+DEFAULT_POLL_WITHIN = 60.0  # time (s) to the next poll, if the experiment doesn't say (see Heartbeat.poll)
+MAX_HEARTBEAT_STATES = 100  # most recent states sent with each heartbeat (about 10 kB), however many are kept
+
+
+class StatusPublisher(object):
+    """Publishes an experiment's status to all status listeners
+
+    Keyword arguments:
+    subject -- subject being run
+    panel -- panel (box) name
+    status_path -- folder of listener sockets (default STATUS_PATH)
+    snapshot_interval -- max time (s) between full snapshots (default 30)
+
+    Methods:
+    publish(state) -- replace the current status with dict state, sending only the changed fields
+    publish_error(message) -- send an error message
+    publish_ready() -- send the startup handshake
+    publish_heartbeat(fields) -- send a heartbeat (see Heartbeat)
+    """
+
+    def __init__(self, subject, panel, status_path=STATUS_PATH, snapshot_interval=30.0):
+        self.log = logging.getLogger(__name__)
+        self.subject = subject
+        self.panel = panel
+        self.status_path = status_path
+        self.snapshot_interval = snapshot_interval
+        self.state = {}
+        self.errors = collections.deque(maxlen=MAX_ERRORS)
+        self.ready = False
+        self.heartbeat = None
+        self.seq = 0
+        self._last_snapshot = None
+        self._listeners = set()  # listeners that have had every message since the last full snapshot
+        self._lock = threading.Lock()  # heartbeats are sent from their own thread
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def publish(self, state):
+        state = dict(state)
+        changed = dict((key, value) for key, value in state.items()
+                       if key not in self.state or self.state[key] != value)
+        removed = [key for key in self.state if key not in state]
+        self.state = state
+        if changed or removed:
+            self._send({'type': 'delta', 'set': changed, 'unset': removed})
+
+    def publish_error(self, message):
+        if len(message) > MAX_ERROR_LENGTH:
+            message = '...' + message[-(MAX_ERROR_LENGTH - 3):]
+        self.errors.append(message)
+        self._send({'type': 'error', 'error': message})
+
+    def publish_ready(self):
+        self.ready = True
+        self._send({'type': 'ready'})
+
+    def publish_heartbeat(self, fields):
+        self.heartbeat = fields
+        self._send({'type': 'heartbeat', 'heartbeat': fields})
+
+    def snapshot(self):
+        return {'type': 'full', 'state': self.state, 'errors': list(self.errors), 'ready': self.ready,
+                'heartbeat': self.heartbeat}
+
+    def _send(self, message):
+        with self._lock:
+            self._send_locked(message)
+
+    def _send_locked(self, message):
+        listeners = self._list_listeners()
+        now = time.time()
+        if self._last_snapshot is None or now - self._last_snapshot > self.snapshot_interval:
+            # everyone gets a full snapshot, which includes this change
+            current = set()
+            fullListeners = listeners
+            self._last_snapshot = now
+        else:
+            current = listeners & self._listeners
+            fullListeners = listeners - current
+
+        reached = set()
+        if current:
+            reached |= self._send_to(current, message, now)
+        if fullListeners:
+            reached |= self._send_to(fullListeners, self.snapshot(), now)
+        self._listeners = reached
+        self.seq += 1
+
+    def _send_to(self, listeners, message, now):
+        # a delta and the snapshot sent instead of it to some listeners share a seq
+        message = dict(message, subject=self.subject, panel=self.panel, pid=os.getpid(), seq=self.seq, time=now)
+        try:
+            data = json.dumps(message, ensure_ascii=True)
+            while len(data) > MAX_MESSAGE_SIZE and message['type'] == 'full' and message['errors']:
+                # leave out the oldest errors until the snapshot fits in a datagram
+                message['errors'] = message['errors'][1:]
+                data = json.dumps(message, ensure_ascii=True)
+        except (TypeError, ValueError):
+            self.log.debug('status not serializable: %s' % repr(message))
+            return set()
+        if len(data) > MAX_MESSAGE_SIZE:
+            # listeners would only get part of it, which they can't parse
+            self.log.debug('status message too large to send (%i bytes)' % len(data))
+            return set()
+
+        reached = set()
+        for listener in listeners:
+            listenerPath = os.path.join(self.status_path, listener)
+            try:
+                self.socket.sendto(data, listenerPath)
+            except socket.error as err:
+                if err.errno == errno.ECONNREFUSED:
+                    # socket file left behind by a listener that didn't close properly
+                    try:
+                        os.remove(listenerPath)
+                    except OSError:
+                        pass
+                # otherwise (e.g. EAGAIN: listener's queue is full) the listener gets a full snapshot next time
+            else:
+                reached.add(listener)
+        return reached
+
+    def _list_listeners(self):
+        try:
+            return set(fileName for fileName in os.listdir(self.status_path)
+                       if fileName.endswith(SOCKET_EXTENSION))
+        except OSError:
+            return set()
+
+    def close(self):
+        self.socket.close()
+
+
+class StatusHandler(logging.Handler):
+    """ Logging handler that publishes log records (e.g. errors) through a StatusPublisher """
+
+    def __init__(self, publisher, level=logging.ERROR):
+        super(StatusHandler, self).__init__(level)
+        self.publisher = publisher
+
+    def emit(self, record):
+        try:
+            self.publisher.publish_error(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class Heartbeat(object):
+    """Sends an experiment's heartbeat through a StatusPublisher every few seconds, from a background thread, so a
+    supervisor (see supervisor.py) can tell a running box from a hung one
+
+    The experiment only updates fields here, which is cheap enough to do on every pass of a polling loop. Heartbeat
+    fields:
+    state -- what the experiment is doing (e.g. 'idle', 'sleep', 'waiting', 'response')
+    last_poll -- time the experiment last polled its interface (or otherwise showed it's still running)
+    poll_deadline -- time by which the experiment expects to poll again, or None if it can't say (e.g. while shaping).
+        The experiment has stalled if it hasn't polled again by then
+    last_trial -- time of the last trial, or None
+    session_start -- time the current session started, or None outside of sessions
+    interface -- hardware interface state: 'ok', 'reconnecting' or 'error'
+    states -- only with state_stats: time spent in each state of the experiment's state machines, and up to
+        MAX_HEARTBEAT_STATES of the most recent states (see utils.StateStats.snapshot)
+
+    Keyword arguments:
+    publisher -- StatusPublisher to send heartbeats through
+    interval -- time (s) between heartbeats (default 2)
+    state_stats -- utils.StateStats to send with each heartbeat (default None)
+
+    Methods:
+    poll(state, within=DEFAULT_POLL_WITHIN) -- experiment polled its interface in state, and will poll again within
+        'within' s (None for no deadline)
+    trial() -- experiment ran a trial
+    session(running) -- session started (True) or ended (False)
+    set_interface(interface_state) -- hardware interface state changed
+    start() -- start sending heartbeats
+    stop() -- stop sending heartbeats
+    """
+
+    def __init__(self, publisher, interval=2.0, state_stats=None):
+        self.publisher = publisher
+        self.interval = interval
+        self.state_stats = state_stats
+        self.state = None
+        self.last_poll = time.time()
+        self.poll_deadline = None
+        self.last_trial = None
+        self.session_start = None
+        self.interface = 'ok'
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def poll(self, state, within=DEFAULT_POLL_WITHIN):
+        now = time.time()
+        self.state = state
+        self.last_poll = now
+        self.poll_deadline = None if within is None else now + within
+
+    def trial(self):
+        self.last_trial = time.time()
+
+    def session(self, running):
+        self.session_start = time.time() if running else None
+
+    def set_interface(self, interface_state):
+        self.interface = interface_state
+
+    def fields(self):
+        fields = {'state': self.state,
+                  'last_poll': self.last_poll,
+                  'poll_deadline': self.poll_deadline,
+                  'last_trial': self.last_trial,
+                  'session_start': self.session_start,
+                  'interface': self.interface}
+        if self.state_stats is not None:
+            fields['states'] = self.state_stats.snapshot(recent=MAX_HEARTBEAT_STATES)
+        return fields
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='heartbeat')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(1.0)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.publisher.publish_heartbeat(self.fields())
+            except Exception as err:  # never let the heartbeat take down the experiment
+                self.publisher.log.debug('heartbeat failed: %s' % err)
+            self._stop_event.wait(self.interval)
+
+
+class StatusListener(object):
+    """Receives status from all running experiments
+
+    Keyword arguments:
+    name -- listener name, unique among listeners (default 'listener-<pid>')
+    status_path -- folder of listener sockets (default STATUS_PATH)
+
+    Methods:
+    receive(timeout) -- wait up to timeout seconds for status messages. Returns list of (key, status, changed) for
+        every publisher whose status changed, where key is (subject, panel), status is a dict of 'state', 'errors',
+        'ready', 'heartbeat', 'subject', 'panel', 'pid' and 'time', and changed is the set of changed state fields
+        ('errors' if there's a new error, 'ready' after the startup handshake, 'heartbeat' for a new heartbeat, None
+        if the whole status was replaced)
+    statuses -- dict of the latest status of each publisher, by key
+    close() -- stop listening
+    """
+
+    def __init__(self, name=None, status_path=STATUS_PATH):
+        self.log = logging.getLogger(__name__)
+        if name is None:
+            name = 'listener-%i' % os.getpid()
+        self.status_path = status_path
+        if not os.path.exists(status_path):
+            os.makedirs(status_path)
+        self.socket_file = os.path.join(status_path, name + SOCKET_EXTENSION)
+        if os.path.exists(self.socket_file):
+            os.remove(self.socket_file)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.socket_file)
+        self.socket.setblocking(False)
+
+        self.statuses = {}
+        self._sequences = {}  # (key, pid): next seq expected, or None if waiting for a full snapshot
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def receive(self, timeout=None):
+        readable = select.select([self.socket], [], [], timeout)[0]
+        if not readable:
+            return []
+
+        updates = []
+        updateIndex = {}
+        while True:
+            try:
+                data = self.socket.recv(MAX_MESSAGE_SIZE)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            try:
+                message = json.loads(data)
+            except ValueError:
+                self.log.debug('invalid status message: %s' % data[:200])
+                continue
+
+            key, changed = self._apply(message)
+            if key is None:
+                continue
+            # merge multiple messages from the same publisher into one update
+            if key in updateIndex:
+                previous = updates[updateIndex[key]][2]
+                if previous is None or changed is None:
+                    changed = None
+                else:
+                    changed = previous | changed
+                updates[updateIndex[key]] = (key, self.statuses[key], changed)
+            else:
+                updateIndex[key] = len(updates)
+                updates.append((key, self.statuses[key], changed))
+        return updates
+
+    def _apply(self, message):
+        # update self.statuses from one message. Returns (key, changed), or (None, None) if nothing changed
+        key = (message.get('subject'), message.get('panel'))
+        sequenceKey = (key, message.get('pid'))
+        expected = self._sequences.get(sequenceKey)
+        messageType = message.get('type')
+
+        if messageType == 'full':
+            self.statuses[key] = {'state': message['state'], 'errors': message['errors'],
+                                  'ready': message.get('ready', False), 'heartbeat': message.get('heartbeat')}
+            changed = None
+        elif expected is None or message['seq'] != expected:
+            # missed a message; wait for the next full snapshot
+            self._sequences[sequenceKey] = None
+            return None, None
+        elif messageType == 'delta':
+            state = self.statuses[key]['state']
+            state.update(message['set'])
+            for field in message['unset']:
+                state.pop(field, None)
+            changed = set(message['set']) | set(message['unset'])
+        elif messageType == 'error':
+            self.statuses[key]['errors'].append(message['error'])
+            changed = set(['errors'])
+        elif messageType == 'ready':
+            self.statuses[key]['ready'] = True
+            changed = set(['ready'])
+        elif messageType == 'heartbeat':
+            self.statuses[key]['heartbeat'] = message['heartbeat']
+            changed = set(['heartbeat'])
+        else:
+            return None, None
+
+        self._sequences[sequenceKey] = message['seq'] + 1
+        self.statuses[key].update(subject=message['subject'], panel=message['panel'], pid=message['pid'],
+                                  time=message['time'])
+        return key, changed
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.remove(self.socket_file)
+        except OSError:
+            pass
@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import time
+import errno
+import select
+import threading
+import subprocess
+import collections
+import logging
+from pyoperant import status
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Starts, stops, monitors and restarts box processes without blocking the caller (e.g. the GUI event loop)
+#
+# Each box runs one child process (normally scripts/behave). A watcher thread follows the child after it's launched:
+# the box is 'ready' once the experiment sends its startup handshake (passed on with mark_ready, usually from a
+# status.StatusListener), and has 'failed' if the child exits or times out first. Hardware operations that have to be
+# kept off the caller's thread (e.g. opening a Teensy serial port) can be run with run_task, one at a time per box. A
+# task waits for a box process that's being stopped to exit first, since that process may still have the hardware open.
+#
+# Once ready, an experiment sends a heartbeat every few seconds (status.Heartbeat, passed on with heartbeat()). A box
+# has stalled if its heartbeats stop (process hung), if it misses the poll deadline given in its heartbeat (experiment
+# stuck, e.g. on a serial read), or if it has been in a session for idle_timeout without running a trial. Boxes that
+# never send heartbeats (older experiments) are only watched for exiting.
+#
+# Boxes started with restart=True are restarted when they fail, exit or stall, after restart_delay seconds, doubling
+# with each consecutive failure up to max_restart_delay. A box that stays up for stable_time has its failure count
+# reset; after max_failures consecutive failures it's left stopped.
+#
+# Results are reported through callback(box, event, detail), which is called from the supervisor's threads, so a GUI
+# should pass a function that only emits a (queued) Qt signal. Events:
+#   'ready' -- box started up. detail is the child's pid
+#   'failed' -- box exited or timed out before it was ready. detail is a description
+#   'exited' -- box exited on its own after it was ready. detail is the exit code
+#   'stalled' -- box stopped responding and is being killed. detail is a description
+#   'restarting' -- box will be restarted. detail is the delay (s)
+#   'restarted' -- box process was relaunched. detail is the new subprocess.Popen object
+#   'gave_up' -- box failed too many times in a row and won't be restarted. detail is the last failure
+#   'stopped' -- box stopped by stop(). detail is the exit code
+#   'done' -- run_task finished. detail is the task name
+#   'error' -- run_task raised an exception. detail is the task name and error
+#
+# Box output (stderr) is captured by an OutputReader: one thread reads every box's pipe, keeping the last few lines of
+# each in a fixed-size buffer, so memory and thread count don't depend on how much the boxes write
+
+# stderr lines that are always there and never matter, e.g. ALSA/PortAudio/JACK complaining about unused sound channels
+NOISE_PATTERNS = [re.compile(pattern) for pattern in (r'^ALSA',
+                                                      r'^Expression .* failed in .*pa_linux_alsa',
+                                                      r'^(bt_audio_service_open|Cannot connect to server|jack server)',
+                                                      r'^pydev',
+                                                      r'^debug',
+                                                      r'^\s*$',
+                                                      )]
+
+
+class _Box(object):
+    # everything the supervisor knows about one box. Only changed with BoxSupervisor._lock held
+    def __init__(self, command, handshake, restart, popen_kwargs):
+        self.command = command
+        self.handshake = handshake
+        self.restart = restart
+        self.popen_kwargs = popen_kwargs
+        self.process = None
+        self.generation = 0  # number of processes launched, so watchers of replaced processes can tell
+        self.ready_event = None  # set by mark_ready
+        self.ready_time = None
+        self.heartbeat = None  # latest heartbeat fields
+        self.heartbeat_time = None  # time the latest heartbeat was received
+        self.stopping = False  # stopped on purpose, so don't report or restart
+        self.replacing = False  # stalled process being killed, to be restarted
+        self.failures = 0  # consecutive failures
+        self.restart_due = None  # time of scheduled restart
+
+
+class BoxSupervisor(object):
+    """Supervises box processes, starting, stopping and restarting them on background threads
+
+    Keyword arguments:
+    callback -- function(box, event, detail) called (from a supervisor thread) when a box changes state
+    ready_timeout -- time (s) a box has to send its startup handshake before it's considered failed (default 60)
+    poll_interval -- how often (s) watcher threads check their process (default 0.1)
+    grace_period -- time (s) a box without a handshake has to stay up to be considered ready (default 2)
+    heartbeat_timeout -- time (s) without a heartbeat before a box is considered hung (default 15)
+    stall_grace -- time (s) a box can be late for its poll deadline before it's considered stalled (default 10)
+    idle_timeout -- time (s) in a session without a trial before a box is restarted, or None (default None)
+    restart_delay -- delay (s) before restarting a box after its first failure (default 2)
+    max_restart_delay -- longest delay (s) before restarting a box (default 600)
+    max_failures -- consecutive failures before a box is left stopped, or None to keep trying (default 10)
+    stable_time -- time (s) a box has to stay up for its failure count to be reset (default 600)
+
+    Methods:
+    start(box, command, handshake=True, restart=False, **popen_kwargs) -- launch a box process, returns the
+        subprocess.Popen object
+    mark_ready(box, pid=None) -- handshake received from box (pid is the sender's pid, to ignore stale handshakes)
+    heartbeat(box, fields, pid=None) -- heartbeat received from box
+    handle_status(box, box_status, changed) -- pass on the handshake and heartbeat in a status.StatusListener update
+    stop(box, timeout=5) -- terminate a box process, killing it if it hasn't exited after timeout seconds
+    run_task(box, name, function, *args) -- run function(*args) on a thread, serialized with the box's other tasks
+    is_running(box) -- whether a box process is running
+    shutdown(timeout=5) -- stop all box processes, waiting for them to exit (e.g. before the caller exits)
+    """
+
+    def __init__(self, callback, ready_timeout=60.0, poll_interval=0.1, grace_period=2.0, heartbeat_timeout=15.0,
+                 stall_grace=10.0, idle_timeout=None, restart_delay=2.0, max_restart_delay=600.0, max_failures=10,
+                 stable_time=600.0):
+        self.log = logging.getLogger(__name__)
+        self.callback = callback
+        self.ready_timeout = ready_timeout
+        self.poll_interval = poll_interval
+        self.grace_period = grace_period
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stall_grace = stall_grace
+        self.idle_timeout = idle_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_failures = max_failures
+        self.stable_time = stable_time
+
+        self.boxes = {}  # box: _Box
+        self._task_locks = {}
+        self._lock = threading.RLock()
+        self._monitor = None
+        self._shutdown = threading.Event()
+
+    def start(self, box, command, handshake=True, restart=False, **popen_kwargs):
+        # Popen itself only forks, so it's fine to call from the GUI thread; the wait for startup is what's slow
+        boxState = _Box(command, handshake, restart, popen_kwargs)
+        with self._lock:
+            previous = self.boxes.get(box)
+            if previous is not None:
+                boxState.generation = previous.generation
+            self.boxes[box] = boxState
+            process = self._launch(box, boxState)
+            if self._monitor is None:
+                self._monitor = self._spawn(self._monitor_boxes)
+        return process
+
+    def mark_ready(self, box, pid=None):
+        with self._lock:
+            boxState = self._current_sender(box, pid)
+            if boxState is None:
+                return False
+            boxState.ready_event.set()
+            return True
+
+    def heartbeat(self, box, fields, pid=None):
+        with self._lock:
+            boxState = self._current_sender(box, pid)
+            if boxState is None:
+                return False
+            boxState.heartbeat = fields
+            boxState.heartbeat_time = time.time()
+            boxState.ready_event.set()  # heartbeats only start once the experiment is up
+            return True
+
+    def handle_status(self, box, box_status, changed=None):
+        pid = box_status.get('pid')
+        if box_status.get('ready'):
+            self.mark_ready(box, pid)
+        if box_status.get('heartbeat') is not None and (changed is None or 'heartbeat' in changed):
+            self.heartbeat(box, box_status['heartbeat'], pid)
+
+    def stop(self, box, timeout=5.0):
+        with self._lock:
+            boxState = self.boxes.get(box)
+            if boxState is None:
+                return None
+            boxState.stopping = True
+            boxState.restart_due = None
+            process = boxState.process
+        self._spawn(self._terminate, box, boxState, process, timeout)
+        return process
+
+    def run_task(self, box, name, function, *args):
+        with self._lock:
+            taskLock = self._task_locks.setdefault(box, threading.Lock())
+            boxState = self.boxes.get(box)
+            if boxState is not None and (boxState.stopping or boxState.replacing):
+                stoppingProcess = boxState.process
+            else:
+                stoppingProcess = None
+        self._spawn(self._run_task, box, name, taskLock, stoppingProcess, function, args)
+
+    def is_running(self, box):
+        boxState = self.boxes.get(box)
+        return boxState is not None and boxState.process.poll() is None
+
+    def shutdown(self, timeout=5.0):
+        self._shutdown.set()
+        with self._lock:
+            processes = []
+            for boxState in self.boxes.values():
+                boxState.stopping = True
+                processes.append(boxState.process)
+            self.boxes.clear()
+        for process in processes:
+            if process.poll() is None:
+                try:
+                    process.terminate()
+                except OSError:
+                    pass
+        for process in processes:
+            _terminate_process(process, timeout)
+
+    # region Internals
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _launch(self, box, box_state):
+        # start (or restart) a box's process. Called with self._lock held
+        box_state.process = subprocess.Popen(box_state.command, **box_state.popen_kwargs)
+        box_state.generation += 1
+        box_state.ready_event = threading.Event()
+        box_state.ready_time = None
+        box_state.heartbeat = None
+        box_state.heartbeat_time = None
+        box_state.replacing = False
+        box_state.restart_due = None
+        self._spawn(self._watch, box, box_state, box_state.process, box_state.generation, box_state.ready_event)
+        return box_state.process
+
+    def _is_current(self, box, box_state, generation):
+        with self._lock:
+            return self.boxes.get(box) is box_state and box_state.generation == generation
+
+    def _current_sender(self, box, pid):
+        # box's state if a message from pid can be from its current process, otherwise None. Called with lock held
+        boxState = self.boxes.get(box)
+        if boxState is None or boxState.stopping:
+            return None
+        if pid is not None and not _is_process_or_child(pid, boxState.process.pid):
+            return None  # message from a previous run of this box
+        return boxState
+
+    def _watch(self, box, box_state, process, generation, ready_event):
+        timeout = self.ready_timeout if box_state.handshake else self.grace_period
+        deadline = time.time() + timeout
+        while process.poll() is None:
+            if box_state.handshake and ready_event.is_set():
+                break
+            if time.time() > deadline:
+                if box_state.handshake:
+                    _terminate_process(process, 5.0)
+                    self._failed(box, box_state, generation, 'no startup handshake after %g s' % timeout)
+                    return
+                break  # still running after the grace period
+            ready_event.wait(self.poll_interval)
+
+        if process.poll() is not None:
+            self._failed(box, box_state, generation, 'exited during startup (code %s)' % process.returncode)
+            return
+        with self._lock:
+            if not self._is_current(box, box_state, generation):
+                return
+            box_state.ready_time = time.time()
+        self.callback(box, 'ready', process.pid)
+
+        # follow the process until it exits, so unexpected exits are reported (and restarted)
+        while process.poll() is None:
+            time.sleep(self.poll_interval)
+        with self._lock:
+            unexpected = (self._is_current(box, box_state, generation) and
+                          not box_state.stopping and not box_state.replacing)
+        if unexpected:
+            self.log.warning('box %s exited (code %s)' % (box, process.returncode))
+            self.callback(box, 'exited', process.returncode)
+            self._schedule_restart(box, box_state, generation, 'exited (code %s)' % process.returncode)
+
+    def _failed(self, box, box_state, generation, description):
+        with self._lock:
+            if not self._is_current(box, box_state, generation) or box_state.stopping:
+                return
+        self.log.warning('box %s failed to start: %s' % (box, description))
+        self.callback(box, 'failed', description)
+        self._schedule_restart(box, box_state, generation, description)
+
+    def _schedule_restart(self, box, box_state, generation, reason):
+        with self._lock:
+            if not self._is_current(box, box_state, generation) or box_state.stopping or not box_state.restart:
+                return
+            if box_state.ready_time is not None and time.time() - box_state.ready_time > self.stable_time:
+                box_state.failures = 0  # ran fine for a while, so this is a new problem
+            box_state.failures += 1
+            giveUp = self.max_failures is not None and box_state.failures > self.max_failures
+            if not giveUp:
+                delay = min(self.restart_delay * 2 ** (box_state.failures - 1), self.max_restart_delay)
+                box_state.restart_due = time.time() + delay
+        if giveUp:
+            self.log.error('box %s failed %d times in a row, not restarting: %s' % (box, self.max_failures, reason))
+            self.callback(box, 'gave_up', reason)
+        else:
+            self.log.info('restarting box %s in %g s' % (box, delay))
+            self.callback(box, 'restarting', delay)
+
+    def _restart(self, box, box_state):
+        with self._lock:
+            if self.boxes.get(box) is not box_state or box_state.stopping or box_state.restart_due is None:
+                return
+            try:
+                process = self._launch(box, box_state)
+            except OSError as err:
+                box_state.restart_due = None
+                generation = box_state.generation
+                error = 'could not launch: %s' % err
+            else:
+                error = None
+        if error is not None:
+            self.callback(box, 'failed', error)
+            self._schedule_restart(box, box_state, generation, error)
+        else:
+            self.callback(box, 'restarted', process)
+
+    def _stall_reason(self, box_state, now):
+        # why a ready box has stalled, or None if it's fine. Called with lock held
+        if (box_state.ready_time is None or box_state.heartbeat_time is None or box_state.stopping or
+                box_state.replacing or box_state.restart_due is not None):
+            return None
+        if now - box_state.heartbeat_time > self.heartbeat_timeout:
+            return 'no heartbeat for %d s' % (now - box_state.heartbeat_time)
+        heartbeat = box_state.heartbeat
+        deadline = heartbeat.get('poll_deadline')
+        if deadline is not None and now > deadline + self.stall_grace:
+            return 'no interface poll for %d s (state %s, interface %s)' % (now - heartbeat.get('last_poll', now),
+                                                                          heartbeat.get('state'),
+                                                                          heartbeat.get('interface'))
+        sessionStart = heartbeat.get('session_start')
+        if self.idle_timeout is not None and sessionStart is not None:
+            lastActivity = max(sessionStart, heartbeat.get('last_trial') or 0, box_state.ready_time)
+            if now - lastActivity > self.idle_timeout:
+                return 'no trials for %.1f h' % ((now - lastActivity) / 3600)
+        return None
+
+    def _monitor_boxes(self):
+        # one thread for all boxes: starts due restarts and catches stalled boxes
+        while not self._shutdown.wait(min(1.0, self.heartbeat_timeout / 5.0)):
+            now = time.time()
+            restarts = []
+            stalls = []
+            with self._lock:
+                for box, boxState in self.boxes.items():
+                    if boxState.restart_due is not None:
+                        if now >= boxState.restart_due:
+                            restarts.append((box, boxState))
+                        continue
+                    reason = self._stall_reason(boxState, now)
+                    if reason is not None:
+                        boxState.replacing = True
+                        stalls.append((box, boxState, boxState.process, boxState.generation, reason))
+            for box, boxState in restarts:
+                self._restart(box, boxState)
+            for box, boxState, process, generation, reason in stalls:
+                self.log.warning('box %s stalled: %s' % (box, reason))
+                self.callback(box, 'stalled', reason)
+                self._spawn(self._replace, box, boxState, process, generation, reason)
+
+    def _replace(self, box, box_state, process, generation, reason):
+        _terminate_process(process, 5.0)
+        self._schedule_restart(box, box_state, generation, reason)
+
+    def _terminate(self, box, box_state, process, timeout):
+        returnCode = _terminate_process(process, timeout)
+        with self._lock:
+            current = self.boxes.get(box) is box_state and box_state.process is process
+            if current:
+                del self.boxes[box]
+        if current:
+            self.callback(box, 'stopped', returnCode)
+
+    def _run_task(self, box, name, task_lock, stopping_process, function, args):
+        if stopping_process is not None:
+            # returncode is set by the thread stopping it (polling here too could race with that thread)
+            while stopping_process.returncode is None:
+                time.sleep(self.poll_interval)
+        with task_lock:
+            try:
+                function(*args)
+            except Exception as err:
+                self.log.error('box %s: %s failed: %s' % (box, name, err))
+                self.callback(box, 'error', '%s: %s' % (name, err))
+            else:
+                self.callback(box, 'done', name)
+    # endregion
+
+
+class OutputReader(object):
+    """Reads the output pipes of all box processes on a single thread
+
+    Each box keeps its last buffer_lines lines (noise included, for context) and up to error_lines unread error lines
+    (lines that don't match NOISE_PATTERNS). Older lines are dropped. A pipe is closed and forgotten at end of file
+
+    Keyword arguments:
+    buffer_lines -- lines of output kept per box (default 200)
+    error_lines -- unread error lines kept per box (default 50)
+    max_line -- longest line (characters) kept; longer lines are split (default 4096)
+
+    Methods:
+    add(box, pipe) -- start reading a box's pipe (e.g. Popen.stderr). Replaces the box's previous output lines, but
+        keeps its unread errors
+    errors(box) -- list of error lines read since the last call (and clears them)
+    lines(box) -- list of the box's recent (line, is_noise) output
+    close() -- stop reading
+    """
+
+    def __init__(self, buffer_lines=200, error_lines=50, max_line=4096):
+        self.log = logging.getLogger(__name__)
+        self.buffer_lines = buffer_lines
+        self.error_lines = error_lines
+        self.max_line = max_line
+
+        self._lines = {}  # box: deque of (line, is_noise)
+        self._errors = {}  # box: deque of unread error lines
+        self._pipes = {}  # fd: (box, pipe, partial line)
+        self._lock = threading.Lock()
+        self._poller = select.poll()
+        self._wake_read, self._wake_write = os.pipe()  # written to when pipes are added, to restart poll()
+        self._poller.register(self._wake_read, select.POLLIN)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='box output')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, box, pipe):
+        fd = pipe.fileno()
+        with self._lock:
+            self._lines[box] = collections.deque(maxlen=self.buffer_lines)
+            if box not in self._errors:
+                # errors from a process that just failed haven't necessarily been read yet
+                self._errors[box] = collections.deque(maxlen=self.error_lines)
+            self._pipes[fd] = (box, pipe, '')
+            self._poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+        os.write(self._wake_write, 'x')
+
+    def errors(self, box):
+        with self._lock:
+            unread = self._errors.get(box)
+            if not unread:
+                return []
+            lines = list(unread)
+            unread.clear()
+            return lines
+
+    def lines(self, box):
+        with self._lock:
+            return list(self._lines.get(box, ()))
+
+    def close(self):
+        self._running = False
+        os.write(self._wake_write, 'x')
+        self._thread.join()
+        with self._lock:
+            for box, pipe, partial in self._pipes.values():
+                pipe.close()
+            self._pipes.clear()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _run(self):
+        while self._running:
+            try:
+                ready = self._poller.poll()
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in ready:
+                if fd == self._wake_read:
+                    os.read(fd, 512)
+                else:
+                    self._read(fd)
+
+    def _read(self, fd):
+        try:
+            data = os.read(fd, 65536)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        with self._lock:
+            box, pipe, partial = self._pipes[fd]
+            text = partial + data
+            lines = text.split('\n')
+            partial = lines.pop()  # incomplete last line (all of it at end of file)
+            if not data:
+                if partial:
+                    lines.append(partial)
+                partial = ''
+            elif len(partial) > self.max_line:
+                # pass on the whole pieces of a long incomplete line, and keep the rest for the next read
+                cut = (len(partial) - 1) // self.max_line * self.max_line
+                lines.append(partial[:cut])
+                partial = partial[cut:]
+            for line in lines:
+                line = line.rstrip('\r')
+                for start in xrange(0, max(len(line), 1), self.max_line):
+                    self._add_line(box, line[start:start + self.max_line])
+            if data:
+                self._pipes[fd] = (box, pipe, partial)
+                return
+            # end of file: process has exited
+            del self._pipes[fd]
+            self._poller.unregister(fd)
+        pipe.close()
+
+    def _add_line(self, box, line):
+        # called with lock held
+        isNoise = any(pattern.search(line) for pattern in NOISE_PATTERNS)
+        self._lines[box].append((line, isNoise))
+        if not isNoise:
+            self._errors[box].append(line)
+
+
+def _terminate_process(process, timeout):
+    # terminate, then kill if it's still running after timeout. Returns exit code
+    if process.poll() is None:
+        try:
+            process.terminate()
+        except OSError:
+            pass  # already gone
+        deadline = time.time() + timeout
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if process.poll() is None:
+            try:
+                process.kill()
+            except OSError:
+                pass
+            process.wait()
+    return process.returncode
+
+
+def _is_process_or_child(pid, parent_pid):
+    # Popen with shell=True runs the box under a shell, so messages come from the shell's child
+    if pid == parent_pid:
+        return True
+    try:
+        with open('/proc/%i/stat' % pid) as f:
+            stat = f.read()
+    except IOError:
+        return False
+    # fields after the command name (which is in parentheses and may contain spaces): state, ppid, ...
+    return int(stat.rsplit(')', 1)[1].split()[1]) == parent_pid
+
+
+def supervise(commands, status_path=status.STATUS_PATH, **kwargs):
+    """ Runs boxes without the GUI until interrupted, restarting them when they fail or stall
+    commands -- dict of panel name (as passed to behave with -P): command that runs that box (list of arguments)
+    Other keyword arguments are passed to BoxSupervisor """
+    log = logging.getLogger(__name__)
+
+    def report(box, event, detail):
+        if event == 'restarted':
+            detail = 'pid %i' % detail.pid
+        log.info('box %s: %s %s' % (box, event, detail))
+
+    boxSupervisor = BoxSupervisor(report, **kwargs)
+    listener = status.StatusListener('supervisor-%i' % os.getpid(), status_path)
+    try:
+        for panel, command in sorted(commands.items()):
+            boxSupervisor.start(panel, command, restart=True)
+        while True:
+            for key, boxStatus, changed in listener.receive(timeout=1.0):
+                if boxStatus['panel'] in commands:
+                    boxSupervisor.handle_status(boxStatus['panel'], boxStatus, changed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        boxSupervisor.shutdown()
+        listener.close()
+
+
+if __name__ == '__main__':
+    # usage: python -m pyoperant.supervisor <boxes json file>
+    # where the file holds {panel name: command, ...}, e.g. {"1": ["python", "scripts/behave", "-P", "1", ...]}
+    logging.basicConfig(level=logging.INFO, format='"%(asctime)s","%(levelname)s","%(message)s"')
+    with open(sys.argv[1], 'rb') as f:
+        supervise(json.load(f))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import csv
+import struct
+import datetime as dt
+import numpy as np
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Typed, append-only trial log written alongside the trial csv
+#
+# File layout:
+#   MAGIC (8 bytes)
+#   header length (little-endian uint32)
+#   header (json): {"version": 1, "fields": [[name, numpy dtype, kind], ...]}
+#   fixed-width records, packed, in the order given by the header
+#
+# Because every record is the same size the records can be memory-mapped directly as a numpy structured array, so
+# readers don't have to parse any text. A record that was only partially written (e.g. the process was killed
+# mid-write) is ignored by readers.
+
+MAGIC = 'PYOPTRL1'
+VERSION = 1
+EXTENSION = '.trl'
+
+# kind of value stored for each known trial field. 'bool' fields are stored as int8 so None can be kept (as -1)
+FIELD_KINDS = {'session': 'int',
+               'index': 'int',
+               'type_': 'str',
+               'stimulus': 'str',
+               'class_': 'str',
+               'response': 'str',
+               'correct': 'bool',
+               'rt': 'float',
+               'reward': 'bool',
+               'punish': 'bool',
+               'time': 'datetime',
+               'subject': 'str',
+               'block': 'str',
+               }
+
+# width (in bytes) of string fields; strings longer than this are truncated
+STRING_WIDTHS = {'stimulus': 256,
+                 'block': 64,
+                 }
+DEFAULT_STRING_WIDTH = 64
+
+KIND_DTYPES = {'int': '<i4',
+               'bool': '<i1',
+               'float': '<f8',
+               'datetime': '<M8[us]',
+               }
+
+
+def build_schema(fields):
+    """ Returns the schema ([name, dtype, kind] for each field) used to store the given trial fields. Fields not in
+    FIELD_KINDS (e.g. from add_fields_to_save) are stored as strings """
+    schema = []
+    for field in fields:
+        kind = FIELD_KINDS.get(field, 'str')
+        if kind == 'str':
+            dtype = 'S%i' % STRING_WIDTHS.get(field, DEFAULT_STRING_WIDTH)
+        else:
+            dtype = KIND_DTYPES[kind]
+        schema.append([field, dtype, kind])
+    return schema
+
+
+def schema_dtype(schema):
+    return np.dtype([(str(name), str(dtype)) for name, dtype, kind in schema])
+
+
+def read_header(f):
+    """ Reads the header from an open log file, returning (schema, header size in bytes) """
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise IOError('%s is not a trial log' % getattr(f, 'name', 'file'))
+    header_len = struct.unpack('<I', f.read(4))[0]
+    header = json.loads(f.read(header_len))
+    if header['version'] > VERSION:
+        raise IOError('trial log version %s is newer than supported (%s)' % (header['version'], VERSION))
+    return header['fields'], len(MAGIC) + 4 + header_len
+
+
+def _encode(value, kind):
+    # convert a single trial attribute to the value stored in the record
+    if kind == 'bool':
+        if value is True:
+            return 1
+        elif value is False:
+            return 0
+        return -1
+    elif kind == 'int':
+        return -1 if value is None else int(value)
+    elif kind == 'float':
+        return np.nan if value is None else float(value)
+    elif kind == 'datetime':
+        return np.datetime64('NaT') if value is None else np.datetime64(value, 'us')
+    else:
+        if value is None:
+            return ''
+        elif isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+
+class TrialLog(object):
+    """Appends trial records to a typed binary log
+
+    Keyword arguments:
+    filename -- path to log file. If it already exists, its schema must match the fields being saved
+    fields -- list of trial fields to save (same as fields_to_save for the csv)
+
+    Methods:
+    append(trial_dict) -- write one trial
+    """
+
+    def __init__(self, filename, fields):
+        self.filename = filename
+        self.schema = build_schema(fields)
+
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            with open(filename, 'rb') as f:
+                existing_schema, _ = read_header(f)
+            if [list(item) for item in existing_schema] != self.schema:
+                raise IOError('trial log %s has different fields than the current experiment' % filename)
+        else:
+            header = json.dumps({'version': VERSION, 'fields': self.schema})
+            with open(filename, 'wb') as f:
+                f.write(MAGIC)
+                f.write(struct.pack('<I', len(header)))
+                f.write(header)
+
+        self.dtype = schema_dtype(self.schema)
+        self._record = np.zeros(1, dtype=self.dtype)
+
+    def append(self, trial_dict):
+        for name, dtype, kind in self.schema:
+            self._record[name] = _encode(trial_dict.get(name), kind)
+        # single write of a whole record, opened per trial like the csv so nothing is lost if the process dies
+        with open(self.filename, 'ab') as f:
+            f.write(self._record.tostring())
+
+
+def read_trial_log(filename, offset=0):
+    """ Returns (schema, records, end offset), where records is a read-only memory-mapped numpy structured array with
+    one element per complete trial record after byte offset 'offset' (which should be an end offset returned by a
+    previous read), and end offset is the byte position just after the last complete record """
+    with open(filename, 'rb') as f:
+        schema, header_size = read_header(f)
+    dtype = schema_dtype(schema)
+    offset = max(offset, header_size)
+    count = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if count <= 0:
+        return schema, np.zeros(0, dtype=dtype), offset
+    records = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+    return schema, records, offset + count * dtype.itemsize
+
+
+def _decode(value, kind):
+    # convert a stored value back to the text the csv writer would have produced
+    if kind == 'bool':
+        return '' if value < 0 else str(value == 1)
+    elif kind == 'int':
+        return '' if value < 0 else str(value)
+    elif kind == 'float':
+        return '' if np.isnan(value) else repr(float(value))
+    elif kind == 'datetime':
+        if np.isnat(value):
+            return ''
+        return str(value.astype('M8[us]').astype(dt.datetime))
+    return value
+
+
+def export_csv(filename, csv_filename=None):
+    """ Writes a trial log out in the same csv format GoNoGoInterruptExp.save_trial produces. Returns csv path """
+    if csv_filename is None:
+        csv_filename = os.path.splitext(filename)[0] + '.csv'
+    schema, records = read_trial_log(filename)[:2]
+    with open(csv_filename, 'wb') as csv_fh:
+        trialWriter = csv.writer(csv_fh)
+        trialWriter.writerow([name for name, dtype, kind in schema])
+        for record in records:
+            trialWriter.writerow([_decode(record[name], kind) for name, dtype, kind in schema])
+    return csv_filename
+
+
+if __name__ == '__main__':
+    # usage: python -m pyoperant.triallog <log file> [output csv]
+    print export_csv(*sys.argv[1:3])
@@ -11,9 +11,9 @@ import os
 import string
 import random
 import datetime as dt
+import importlib
+import collections
 import numpy as np
-import scipy as sp
-import scipy.special
 from contextlib import closing
 from argparse import ArgumentParser
 
@@ -66,6 +66,29 @@ except ImportError:
 #             self.handleError(record)
 
 
+class LazyModule(object):
+    """ Stands in for a module that is only imported when one of its attributes is first used, for heavy optional
+    modules (pandas, scipy) that would otherwise slow down the start of every box process.
+
+    example usage:
+
+    >>> pd = LazyModule('pandas')
+    >>> frame = pd.DataFrame()  # pandas is imported here
+    """
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (self.__name, '' if self.__module is None else ' (imported)')
+
+
 class NumpyAwareJSONEncoder(json.JSONEncoder):
     """ this json encoder converts numpy arrays to lists so that json can write them.
 
@@ -124,6 +147,132 @@ class AuditoryStimulus(Stimulus):
             self.label = 'auditory_stimulus'
 
 
+def _load_monotonic():
+    # clock_gettime(CLOCK_MONOTONIC) through ctypes, as python 2 has no time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        library = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = library.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+        timespec = Timespec()
+        timespecPointer = ctypes.pointer(timespec)
+        if clock_gettime(1, timespecPointer) != 0:  # CLOCK_MONOTONIC on linux
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+    except (ImportError, OSError, AttributeError, TypeError):
+        return time.time
+
+    def clock():
+        clock_gettime(1, timespecPointer)
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    return clock
+
+
+_monotonic = None
+
+
+def monotonic():
+    """ seconds since an arbitrary start, from a clock that (unlike time.time) never jumps, e.g. when the system time
+    is set. Falls back to time.time where clock_gettime isn't available """
+    global _monotonic
+    if _monotonic is None:
+        _monotonic = _load_monotonic()
+    return _monotonic()
+
+
+_state_stats = None  # StateStats recording every state machine, if one is installed
+
+
+class StateStats(object):
+    """Records the states of every state machine run (see run_state_machine) once installed: the number of times each
+    state was entered, the total time spent in it, and a ring buffer of the most recent states.
+
+    States are named by their path through nested state machines, e.g. 'session' (the experiment's session state),
+    'session/main' (the session state machine's main state inside it) or 'block1/init' (shaping), and a state's time
+    includes the states nested in it. Only for state machines on one thread (an experiment's main thread).
+
+    Keyword arguments:
+    history -- number of recent states kept (default 256)
+    clock -- function returning the time (default monotonic)
+    on_enter -- optional function called with (state, time) when a state is entered
+    on_exit -- optional function called with (state, time, duration, next state) when it's left. The next state is
+        None if the state machine finished, or the state raised an exception
+
+    Methods:
+    install() -- start recording all state machines (replacing any other StateStats)
+    uninstall() -- stop recording
+    run(state, function) -- runs a state's function, recording it. Called by run_state_machine
+    totals() -- dict of state: {'count': times entered, 'seconds': total time}
+    recent(count=None) -- list of the last count (default all kept) states, oldest first, as dicts of 'state',
+        'start', 'duration' and 'next'
+    snapshot(recent=None) -- dict of 'time' (clock time now), 'totals', 'recent' (the last 'recent' states, default
+        all kept) and 'current' (path of the state running now), e.g. to send with a heartbeat
+    """
+
+    def __init__(self, history=256, clock=monotonic, on_enter=None, on_exit=None):
+        self.clock = clock
+        self.on_enter = on_enter
+        self.on_exit = on_exit
+        self._totals = {}  # state: [count, seconds]
+        self._history = collections.deque(maxlen=history)  # (state, start, duration, next state)
+        self._stack = []  # paths of the states running now, outermost first
+
+    def install(self):
+        global _state_stats
+        _state_stats = self
+
+    def uninstall(self):
+        global _state_stats
+        if _state_stats is self:
+            _state_stats = None
+
+    def run(self, state, function):
+        path = self._stack[-1] + '/' + state if self._stack else state
+        self._stack.append(path)
+        start = self.clock()
+        if self.on_enter is not None:
+            self.on_enter(path, start)
+        nextState = None
+        try:
+            nextState = function()
+            return nextState
+        finally:
+            end = self.clock()
+            self._stack.pop()
+            duration = end - start
+            total = self._totals.get(path)
+            if total is None:
+                total = self._totals[path] = [0, 0.0]
+            total[0] += 1
+            total[1] += duration
+            self._history.append((path, start, duration, nextState))
+            if self.on_exit is not None:
+                self.on_exit(path, end, duration, nextState)
+
+    # These are called from other threads (e.g. the heartbeat's), so they copy with a single call (dict.items(),
+    # list(deque)) that can't see the state machine's thread change things part way through
+    def totals(self):
+        return dict((state, {'count': total[0], 'seconds': total[1]}) for state, total in self._totals.items())
+
+    def recent(self, count=None):
+        history = list(self._history)
+        if count is not None:
+            history = history[-count:] if count > 0 else []
+        return [{'state': state, 'start': start, 'duration': duration, 'next': nextState}
+                for state, start, duration, nextState in history]
+
+    def snapshot(self, recent=None):
+        stack = list(self._stack)
+        return {'time': self.clock(),
+                'totals': self.totals(),
+                'recent': self.recent(recent),
+                'current': stack[-1] if stack else None}
+
+
 def run_state_machine(start_in='pre', error_state=None, error_callback=None, **state_functions):
     """runs a state machine defined by the keyword arguments
 
@@ -139,6 +288,8 @@ def run_state_machine(start_in='pre', error_state=None, error_callback=None, **s
     in 'run_start'
     in 'run_next'
     None
+
+    Each state is recorded by the installed StateStats, if there is one.
     """
     # make sure the start state has a function to run
     assert (start_in in state_functions.keys())
@@ -149,7 +300,10 @@ def run_state_machine(start_in='pre', error_state=None, error_callback=None, **s
     state = start_in
     while state is not None:
         try:
-            state = state_functions[state]()
+            if _state_stats is None:
+                state = state_functions[state]()
+            else:
+                state = _state_stats.run(state, state_functions[state])
         except Exception as e:
 
             if error_callback:
@@ -390,26 +544,54 @@ def wait(secs=1.0, final_countdown=0.0, waitfunc=None):
             pass
 
 
-def auditory_stim_from_wav(wav):
+_wav_params = {}  # wav file: ((modification time, size), params), see wav_params
+_wav_params_lock = threading.Lock()
+
+
+def wav_params(wav):
+    """ wave params (nchannels, sampwidth, framerate, nframes, comptype, compname) of a wav file, cached until the
+    file changes """
+    stat = os.stat(wav)
+    key = (stat.st_mtime, stat.st_size)
+    with _wav_params_lock:
+        cached = _wav_params.get(wav)
+    if cached is not None and cached[0] == key:
+        return cached[1]
     with closing(wave.open(wav, 'rb')) as wf:
-        (nchannels, sampwidth, framerate, nframes, comptype, compname) = wf.getparams()
-
-        duration = float(nframes) / sampwidth
-        duration = duration * 2.0 / framerate
-        stim = AuditoryStimulus(time=0.0,
-                                duration=duration,
-                                name=wav,
-                                label='wav',
-                                description='',
-                                file_origin=wav,
-                                annotations={'nchannels': nchannels,
-                                             'sampwidth': sampwidth,
-                                             'framerate': framerate,
-                                             'nframes': nframes,
-                                             'comptype': comptype,
-                                             'compname': compname,
-                                             }
-                                )
+        params = tuple(wf.getparams())
+    with _wav_params_lock:
+        _wav_params[wav] = (key, params)
+    return params
+
+
+def warm_wav(wav):
+    """ reads a wav file's params into the cache (see wav_params) and its data into the OS file cache, so that
+    loading it for a trial doesn't wait for the disk. Safe to call from a background thread """
+    wav_params(wav)
+    with open(wav, 'rb') as f:
+        while f.read(1 << 20):
+            pass
+
+
+def auditory_stim_from_wav(wav):
+    (nchannels, sampwidth, framerate, nframes, comptype, compname) = wav_params(wav)
+
+    duration = float(nframes) / sampwidth
+    duration = duration * 2.0 / framerate
+    stim = AuditoryStimulus(time=0.0,
+                            duration=duration,
+                            name=wav,
+                            label='wav',
+                            description='',
+                            file_origin=wav,
+                            annotations={'nchannels': nchannels,
+                                         'sampwidth': sampwidth,
+                                         'framerate': framerate,
+                                         'nframes': nframes,
+                                         'comptype': comptype,
+                                         'compname': compname,
+                                         }
+                            )
     return stim
 
 
@@ -512,7 +694,8 @@ def rand_from_log_shape_dist(alpha=10):
     """
     beta = (alpha + 1) * np.log(alpha + 1) - alpha
     t = random.random()
-    ret = ((beta * t - 1) / (sp.special.lambertw((beta * t - 1) / np.e)) - 1) / alpha
+    from scipy.special import lambertw  # imported here, so that importing utils doesn't load scipy
+    ret = ((beta * t - 1) / (lambertw((beta * t - 1) / np.e)) - 1) / alpha
     return max(min(np.real(ret), 1), 0)
 
 